@@ -0,0 +1 @@
+"""Benchmarks. Run them from the repository root, e.g. python3 -m benchmarks.bench_codec"""
@@ -0,0 +1,337 @@
+"""End-to-end throughput and latency of a cluster on one machine.
+
+Starts --nodes dynamo.py processes bound to consecutive loopback addresses
+(127.0.0.2, 127.0.0.3, ... Linux routes all of 127.0.0.0/8 to the loopback
+interface), adds them to the leader's ring and drives a YCSB style workload
+with --threads clients. The load phase inserts --records keys, the run phase
+does --operations reads and updates of them:
+
+    workload a  50% reads, 50% updates
+    workload b  95% reads,  5% updates
+    workload c  100% reads
+
+--read_pct overrides the mix of the workload. Keys are picked uniformly or
+from a zipfian distribution (YCSB's, constant 0.99), where a few keys get most
+of the requests. Updates carry the context of the last version the clients
+know of, so they replace it instead of adding a sibling.
+
+Clients are SmartClients that send every key to its coordinator (--client
+smart) or send text commands to a random node, which forwards them (--client
+command). Reports throughput and p50/p99/p999 latency per operation, --json
+writes the same as JSON to track regressions.
+
+    python3 -m benchmarks.bench_cluster [--nodes N] [--workload a|b|c] [--distribution uniform|zipfian]
+                                        [--threads N] [--records N] [--operations N] [--value_size BYTES]
+                                        [--node_args '--storage log ...'] [--json FILE]
+"""
+import argparse
+import json
+import math
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import messages
+from smartclient import SmartClient
+
+WORKLOADS = {'a': 50, 'b': 95, 'c': 100}  # percentage of reads
+
+DYNAMO = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dynamo.py')
+
+
+class ZipfianGenerator(object):
+    """Item numbers 0..items-1, item 0 the most popular (Gray et al., as in YCSB)"""
+
+    def __init__(self, items, theta=0.99):
+        self.items = items
+        self.theta = theta
+        self.zetan = sum(1.0 / (i ** theta) for i in range(1, items + 1))
+        self.alpha = 1.0 / (1.0 - theta)
+        self.eta = (1 - (2.0 / items) ** (1 - theta)) / (1 - (1 + 0.5 ** theta) / self.zetan)
+
+    def next(self, rng):
+        uz = rng.random() * self.zetan
+        if uz < 1.0:
+            return 0
+        if uz < 1.0 + 0.5 ** self.theta:
+            return 1
+        return min(self.items - 1, int(self.items * (self.eta * uz / self.zetan - self.eta + 1) ** self.alpha))
+
+
+class CommandClient(object):
+    """Sends get and put as text commands to one node, like client.py"""
+
+    def __init__(self, host, port, timeout=10.0):
+        self.socket = socket.create_connection((host, port), timeout=timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def put(self, key, value, context=None):
+        data = self._call('put %s %s %s' % (key, json.dumps(context or {}, separators=(',', ':')), value))
+        return data[1] if isinstance(data, tuple) else data
+
+    def get(self, key):
+        data = self._call('get %s' % key)
+        return data[1] if isinstance(data, tuple) else data
+
+    def _call(self, command):
+        self.socket.sendall(messages.client_message(command))
+        return recv_frame(self.socket)[1]
+
+    def close(self):
+        self.socket.close()
+
+
+def recv_frame(s):
+    """(message code, message) of the next frame read from socket s"""
+    header = SmartClient._recv_exactly(s, 5)
+    return messages._unpack_message(header + SmartClient._recv_exactly(s, messages._get_payload_len(header[1:5])))
+
+
+def command(host, port, text, timeout=10.0):
+    """Answer of a node to one client command"""
+    client = CommandClient(host, port, timeout)
+    try:
+        return client._call(text)
+    finally:
+        client.close()
+
+
+def start_cluster(hosts, port, directory, node_args):
+    """Start a node per host, the first one the leader, and add the others to its ring"""
+    processes = []
+    for host in hosts:
+        path = os.path.join(directory, host)
+        os.makedirs(path)
+        log = open(os.path.join(path, 'node.log'), 'w')
+        processes.append(subprocess.Popen([sys.executable, '-u', DYNAMO, '--hostname', host, '--leader', hosts[0],
+                                           '--port', str(port)] + node_args,
+                                          cwd=path, stdout=log, stderr=subprocess.STDOUT))
+        log.close()
+
+    try:
+        for (host, process) in zip(hosts, processes):
+            wait_for(lambda: listening(host, port, process, os.path.join(directory, host, 'node.log')),
+                     "%s to listen" % host)
+
+        for host in hosts[1:]:
+            answer = command(hosts[0], port, 'add-node %s' % host)
+            if not str(answer).startswith('Successfully'):
+                raise RuntimeError("Cannot add %s: %s" % (host, answer))
+
+        # every node has to know the whole ring before clients route by it
+        for host in hosts:
+            wait_for(lambda: len(ring_hosts(host, port)) == len(hosts), "%s to learn the ring" % host)
+    except Exception:
+        stop_cluster(processes)
+        raise
+
+    return processes
+
+
+def listening(host, port, process, log_path):
+    if process.poll() is not None:
+        with open(log_path) as f:
+            raise RuntimeError("Node %s exited:\n%s" % (host, ''.join(f.readlines()[-5:])))
+    socket.create_connection((host, port), 0.5).close()
+    return True
+
+
+def ring_hosts(host, port):
+    s = socket.create_connection((host, port), timeout=5.0)
+    try:
+        s.sendall(messages.ringRequest())
+        return recv_frame(s)[1][2]
+    finally:
+        s.close()
+
+
+def wait_for(ready, what, timeout=15.0):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            if ready():
+                return
+        except OSError:
+            pass
+        if time.time() > deadline:
+            raise RuntimeError("Timed out waiting for %s" % what)
+        time.sleep(0.1)
+
+
+def stop_cluster(processes):
+    for p in processes:
+        p.terminate()
+    for p in processes:
+        try:
+            p.wait(5)
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+
+class Worker(threading.Thread):
+    """A client thread running its share of a phase, recording the latency of every operation"""
+
+    def __init__(self, client, ring, ops, pick_key, read_pct, value, contexts, seed):
+        super(Worker, self).__init__(daemon=True)
+        self.client = client
+        self.ring = ring
+        self.ops = ops
+        self.pick_key = pick_key
+        self.read_pct = read_pct
+        self.value = value
+        self.contexts = contexts  # key : clock of the latest version the clients know of, shared
+        self.rng = random.Random(seed)
+        self.latencies = {'read': [], 'update': []}  # seconds
+        self.errors = {'read': 0, 'update': 0}
+
+    def run(self):
+        for _ in range(self.ops):
+            key = self.pick_key(self.rng)
+            op = 'read' if self.rng.random() * 100 < self.read_pct else 'update'
+            start = time.perf_counter()
+            try:
+                ok = self.read(key) if op == 'read' else self.update(key)
+            except (OSError, messages.ProtocolError):
+                ok = False
+            self.latencies[op].append(time.perf_counter() - start)
+            if not ok:
+                self.errors[op] += 1
+
+    def read(self, key):
+        versions = self.client.get(key)
+        if not isinstance(versions, list):
+            return versions is None  # a key without a value yet
+        context = {}
+        for (clock, _) in versions:
+            for (node, counter) in clock.items():
+                context[node] = max(context.get(node, 0), counter)
+        self.contexts[key] = context
+        return True
+
+    def update(self, key):
+        context = self.contexts.get(key, {})
+        if self.client.put(key, self.value, context) != self.value:
+            return False
+        # the coordinator stored it under the context plus one on its own counter
+        ip = self.ring.hostname_to_ip[self.ring.get_node_for_key(key)]
+        self.contexts[key] = dict(context, **{ip: context.get(ip, 0) + 1})
+        return True
+
+
+def run_phase(clients, ring, ops, pick_key, read_pct, value, contexts):
+    workers = [Worker(client, ring, ops // len(clients) + (1 if i < ops % len(clients) else 0), pick_key, read_pct,
+                      value, contexts, seed=i)
+               for (i, client) in enumerate(clients)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+
+    report = {'operations': ops, 'seconds': round(elapsed, 3), 'ops_per_sec': round(ops / elapsed, 1), 'by_operation': {}}
+    for op in ('read', 'update'):
+        latencies = sorted(l for w in workers for l in w.latencies[op])
+        if latencies:
+            report['by_operation'][op] = dict(count=len(latencies), errors=sum(w.errors[op] for w in workers),
+                                              ops_per_sec=round(len(latencies) / elapsed, 1),
+                                              **latency_report(latencies))
+    return report
+
+
+def latency_report(latencies):
+    """Mean and percentiles in milliseconds of sorted latencies in seconds"""
+    def percentile(p):
+        return round(latencies[max(0, int(math.ceil(p * len(latencies))) - 1)] * 1000, 3)
+
+    return {'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3), 'p50_ms': percentile(0.50),
+            'p99_ms': percentile(0.99), 'p999_ms': percentile(0.999), 'max_ms': round(latencies[-1] * 1000, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--nodes', default=3, type=int, help='Number of nodes')
+    parser.add_argument('--first_ip', default='127.0.0.2', help='Address of the leader, the others follow it')
+    parser.add_argument('--port', default=14337, type=int, help='TCP port of the nodes')
+    parser.add_argument('--qsize', default=3, type=int, help='Replicas of each key')
+    parser.add_argument('--sq_read_n', default=2, type=int, help='Replicas answering a get')
+    parser.add_argument('--sq_write_n', default=2, type=int, help='Replicas acknowledging a put')
+    parser.add_argument('--node_args', default='', help='More dynamo.py arguments for every node')
+    parser.add_argument('--workload', default='a', choices=sorted(WORKLOADS), help='YCSB core workload')
+    parser.add_argument('--read_pct', default=None, type=float, help='Percentage of reads, instead of the workload mix')
+    parser.add_argument('--distribution', default='zipfian', choices=['uniform', 'zipfian'], help='Key popularity')
+    parser.add_argument('--records', default=1000, type=int, help='Keys inserted by the load phase')
+    parser.add_argument('--operations', default=10000, type=int, help='Operations of the run phase')
+    parser.add_argument('--value_size', default=100, type=int, help='Size of the values in bytes')
+    parser.add_argument('--threads', default=8, type=int, help='Concurrent clients')
+    parser.add_argument('--client', default='smart', choices=['smart', 'command'],
+                        help='smart: send keys to their coordinator, command: send commands to any node')
+    parser.add_argument('--dir', default=None, help='Directory for the data and logs of the nodes')
+    parser.add_argument('--json', default=None, help='Write the results as JSON to this file, - for stdout')
+    args = parser.parse_args()
+
+    base = args.first_ip.rsplit('.', 1)
+    hosts = ['%s.%d' % (base[0], int(base[1]) + i) for i in range(args.nodes)]
+    read_pct = args.read_pct if args.read_pct is not None else WORKLOADS[args.workload]
+    node_args = ['--qsize', str(args.qsize), '--sq_read_n', str(args.sq_read_n),
+                 '--sq_write_n', str(args.sq_write_n)] + shlex.split(args.node_args)
+
+    if args.distribution == 'zipfian':
+        zipf = ZipfianGenerator(args.records)
+        pick_key = lambda rng: 'user%d' % zipf.next(rng)
+    else:
+        pick_key = lambda rng: 'user%d' % rng.randrange(args.records)
+
+    value = 'x' * args.value_size
+    results = {'config': dict(vars(args), hosts=hosts, read_pct=read_pct)}
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        processes = start_cluster(hosts, args.port, tmp, node_args)
+        try:
+            if args.client == 'smart':
+                clients = [SmartClient([hosts[0]], args.port) for _ in range(args.threads)]
+                ring = clients[0].ring
+            else:
+                clients = [CommandClient(hosts[i % len(hosts)], args.port) for i in range(args.threads)]
+                ring_client = SmartClient([hosts[0]], args.port)
+                ring = ring_client.ring  # where updates are coordinated, see Worker.update
+                ring_client.close()
+
+            contexts = {}
+            keys = iter(range(args.records))
+            lock = threading.Lock()
+
+            def next_key(rng):
+                with lock:
+                    return 'user%d' % next(keys)
+
+            results['load'] = run_phase(clients, ring, args.records, next_key, 0, value, contexts)
+            results['run'] = run_phase(clients, ring, args.operations, pick_key, read_pct, value, contexts)
+
+            for client in clients:
+                client.close()
+        finally:
+            stop_cluster(processes)
+
+    row = '%-8s %-8s %8s %10s %8s %9s %9s %9s'
+    print(row % ('phase', 'op', 'count', 'ops/s', 'errors', 'p50 ms', 'p99 ms', 'p999 ms'))
+    for phase in ('load', 'run'):
+        for (op, r) in sorted(results[phase]['by_operation'].items()):
+            print(row % (phase, op, r['count'], r['ops_per_sec'], r['errors'], r['p50_ms'], r['p99_ms'], r['p999_ms']))
+        print(row % (phase, 'total', results[phase]['operations'], results[phase]['ops_per_sec'], '', '', '', ''))
+
+    if args.json == '-':
+        print(json.dumps(results, indent=2))
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
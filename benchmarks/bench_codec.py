@@ -0,0 +1,79 @@
+"""Compare the binary wire format with the pickle frames it replaced.
+
+Reports encode and decode throughput and the frame size of typical messages.
+
+    python3 -m benchmarks.bench_codec [--seconds S]
+"""
+import argparse
+import pickle
+import struct
+import time
+
+import messages
+
+
+def pickle_frame(message_type, obj):
+    """Frame as built by messages.py before the binary format"""
+    data = pickle.dumps(obj)
+    return message_type + struct.pack('!i', len(data)) + data
+
+
+def pickle_unpack(data):
+    return bytes([data[0]]), pickle.loads(data[5:])
+
+
+def sample_messages():
+    clock = {'172.18.0.%d' % i: i for i in range(2, 5)}
+    versions = [[dict(clock, **{'172.18.0.9': i}), bytes([97 + i]) * 100] for i in range(10)]
+
+    return [
+        # name, (type, fields), binary encoder
+        ('storeFile', (b'\x07', ('user:1234', 'x' * 100, clock, 42)), messages.storeFile),
+        ('storeFileResponse', (b'\x70', ('user:1234', 'x' * 100, clock, 42)), messages.storeFileResponse),
+        ('getFile', (b'\x08', ('user:1234', 42)), messages.getFile),
+        ('getFileResponse x1', (b'\x80', ('user:1234', versions[:1], 42)), messages.getFileResponse),
+        ('getFileResponse x10', (b'\x80', ('user:1234', versions, 42)), messages.getFileResponse),
+        ('okMessage', (b'\xff', (3, 7)), messages.okMessage),
+        ('forwardedReq', (b'\x0A', (42, 1, 'user:1234', 'x' * 100, clock, 1700000000.0)), messages.forwardedReq),
+        ('responseForForwardedReq', (b'\xa0', (42, 0, versions[:1])), messages.responseForForwardedReq),
+    ]
+
+
+def rate(fn, seconds):
+    """Calls per second of fn, measured for about the given number of seconds"""
+    n = 0
+    batch = 100
+    start = time.perf_counter()
+    while True:
+        for _ in range(batch):
+            fn()
+        n += batch
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return n / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--seconds', default=0.5, type=float, help='Time spent measuring each case')
+    args = parser.parse_args()
+
+    row = '%-24s %-7s %12s %12s %8s'
+    print(row % ('message', 'format', 'encode/s', 'decode/s', 'bytes'))
+
+    for (name, (message_type, fields), encode) in sample_messages():
+        obj = fields[0] if len(fields) == 1 else fields
+
+        frame = pickle_frame(message_type, obj)
+        enc = rate(lambda: pickle_frame(message_type, obj), args.seconds)
+        dec = rate(lambda: pickle_unpack(frame), args.seconds)
+        print(row % (name, 'pickle', '%.0f' % enc, '%.0f' % dec, len(frame)))
+
+        frame = encode(*fields)
+        enc = rate(lambda: encode(*fields), args.seconds)
+        dec = rate(lambda: messages._unpack_message(frame), args.seconds)
+        print(row % (name, 'binary', '%.0f' % enc, '%.0f' % dec, len(frame)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Run the SQLite and the log structured storage engine on the same workload.
+
+Both get the same sequence of operations: writes to random keys, most of them
+overwriting a key that was written before, and reads of random keys. Writes
+are committed in groups of --group, as with group commit. Reports operations
+per second, the disk space used, and for the log engine the space left after
+a compaction.
+
+    python3 -m benchmarks.bench_engines [--keys N] [--ops N] [--writes PCT] [--synchronous LEVEL] [--dir DIR]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from logstore import LogStorage
+from storage import Storage, SYNCHRONOUS_LEVELS
+
+WRITERS = ('172.18.0.2', '172.18.0.3', '172.18.0.4')
+
+
+def workload(keys, ops, write_pct, seed=1):
+    rng = random.Random(seed)
+    return [('put' if rng.random() * 100 < write_pct else 'get', 'key%d' % rng.randrange(keys), rng.choice(WRITERS))
+            for _ in range(ops)]
+
+
+def disk_bytes(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return sum(os.path.getsize(path + suffix) for suffix in ('', '-wal') if os.path.exists(path + suffix))
+
+
+def run(db, path, ops, group, value):
+    writes = reads = 0
+    start = time.perf_counter()
+    for (i, (op, key, writer)) in enumerate(ops):
+        if op == 'put':
+            # a coordinator writing on top of what it read
+            versions = db.getFile(key)
+            db.storeFile(key, writer, versions[0][0] if versions else None, value, commit=False)
+            writes += 1
+            if writes % group == 0:
+                db.commit()
+        else:
+            db.getFile(key)
+            reads += 1
+    db.flush()
+    elapsed = time.perf_counter() - start
+    return len(ops) / elapsed, disk_bytes(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--keys', default=10000, type=int, help='Number of distinct keys')
+    parser.add_argument('--ops', default=100000, type=int, help='Number of operations')
+    parser.add_argument('--writes', default=90, type=float, help='Percentage of operations that are writes')
+    parser.add_argument('--value_size', default=100, type=int, help='Size of the written values')
+    parser.add_argument('--group', default=16, type=int, help='Writes per commit')
+    parser.add_argument('--synchronous', default='NORMAL', choices=SYNCHRONOUS_LEVELS, help='Durability setting')
+    parser.add_argument('--dir', default=None, help='Directory for the data, on the disk to measure')
+    args = parser.parse_args()
+
+    ops = workload(args.keys, args.ops, args.writes)
+    value = 'x' * args.value_size
+
+    row = '%-8s %12s %14s %18s'
+    print(row % ('engine', 'ops/s', 'disk bytes', 'after compaction'))
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        db = Storage(path, synchronous=args.synchronous)
+        rate, size = run(db, path, ops, args.group, value)
+        db.close()
+        print(row % ('sqlite', '%.0f' % rate, size, '-'))
+
+        path = os.path.join(tmp, 'bench.segments')
+        # small segments, so compaction has sealed segments to work on
+        db = LogStorage(path, synchronous=args.synchronous, segment_bytes=4 << 20)
+        rate, size = run(db, path, ops, args.group, value)
+        db.compact(force=True)
+        print(row % ('log', '%.0f' % rate, size, disk_bytes(path)))
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
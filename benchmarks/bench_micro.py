@@ -0,0 +1,223 @@
+"""Microbenchmarks of the hot paths of a node, one layer at a time.
+
+    storage   Storage.storeFile and getFile on tables of --rows keys (sqlite,
+              synchronous OFF, stores committed in groups of 64 as batches are)
+    versions  Storage.sortData and Node.coalesce_responses of --siblings
+              concurrent versions, returned by 3 replicas
+    ring      Ring.get_node_for_key and get_replicas_for_key on rings of
+              --ring_sizes nodes of 32 tokens
+    codec     encoding and _unpack_message decoding of every message type
+
+Every case reports calls per second, the best of --repeat measurements so
+other processes disturb it less, and the bytes allocated by one call (the
+tracemalloc peak above what was allocated before it). --save writes them to a
+JSON file, --baseline compares with such a file and exits with status 1 when
+a case got slower or allocates more by more than --threshold percent.
+
+    python3 -m benchmarks.bench_micro [--seconds S] [--repeat N] [--only storage,versions,ring,codec]
+                                      [--rows 1000,10000,100000] [--siblings 1,4,16,64] [--ring_sizes 4,16,64]
+                                      [--save FILE] [--baseline FILE] [--threshold PCT]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+from types import SimpleNamespace
+
+import messages
+from benchmarks.bench_codec import rate
+from node import Node
+from request import Request
+from ring import Ring
+from storage import Storage
+
+HOSTS = ['172.18.0.%d' % i for i in range(2, 5)]
+
+
+def best_rate(fn, seconds, repeat):
+    return max(rate(fn, seconds / repeat) for _ in range(repeat))
+
+
+def allocated_bytes(fn, calls=200):
+    """Median over calls of the bytes allocated while fn runs"""
+    sizes = []
+    tracemalloc.start()
+    try:
+        for _ in range(calls):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            fn()
+            sizes.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    return sorted(sizes)[len(sizes) // 2]
+
+
+def storage_cases(rows_list, directory):
+    value = 'x' * 100
+    rng = random.Random(1)
+    for rows in rows_list:
+        path = os.path.join(directory, 'micro%d.db' % rows)
+        db = Storage(path, synchronous='OFF')
+        for n in range(rows):
+            db.storeFile('key%d' % n, HOSTS[0], None, value, commit=False)
+        db.flush()
+
+        clocks = {}  # key : counter of its stored version
+        stored = [0]
+
+        def store():
+            # overwrite a key with the next version, as a coordinator does
+            n = rng.randrange(rows)
+            counter = clocks.get(n, 1)
+            db.storeFile('key%d' % n, HOSTS[0], {HOSTS[0]: counter}, value, commit=False)
+            clocks[n] = counter + 1
+            stored[0] += 1
+            if stored[0] % 64 == 0:
+                db.commit()
+
+        yield ('storage storeFile rows=%d' % rows, store, lambda: db.flush())
+        yield ('storage getFile rows=%d' % rows, lambda: db.getFile('key%d' % rng.randrange(rows)), db.close)
+
+
+def versions_cases(siblings_list, directory):
+    db = Storage(os.path.join(directory, 'versions.db'), synchronous='OFF')
+    node = SimpleNamespace(sloppy_R=2, db=db)  # what coalesce_responses uses of a Node
+    for siblings in siblings_list:
+        # concurrent versions: every writer advanced a common ancestor
+        base = {HOSTS[0]: 3, HOSTS[1]: 2}
+        versions = [[dict(base, **{'10.0.%d.%d' % (i // 250, i % 250): 1}), b'x' * 100] for i in range(siblings)]
+        request = Request('get', 'key', None)
+        for host in HOSTS:
+            request.responses[host] = ('key', versions, 1)
+
+        yield ('versions sortData siblings=%d' % siblings, lambda v=versions: db.sortData(v), None)
+        yield ('versions coalesce_responses siblings=%d' % siblings,
+               lambda r=request: Node.coalesce_responses(node, r), None)
+
+
+def ring_cases(sizes):
+    keys = ['user%d' % i for i in range(1000)]
+    for size in sizes:
+        ring = Ring(vnode_count=32, replica_count=2)
+        for i in range(size):
+            name = 'node%d' % i
+            ring[name] = name  # no DNS lookups, see the __main__ block of ring.py
+        it = iter(range(1 << 62))
+
+        yield ('ring get_node_for_key nodes=%d' % size,
+               lambda r=ring: r.get_node_for_key(keys[next(it) % 1000]), None)
+        yield ('ring get_replicas_for_key nodes=%d' % size,
+               lambda r=ring: r.get_replicas_for_key(keys[next(it) % 1000]), None)
+
+
+# a value of each field kind, see codec.py
+SAMPLE_FIELDS = {
+    'u8': 1,
+    'u32': 7,
+    'u64': 42,
+    'u128': 2 ** 100,
+    'f64': 1700000000.0,
+    'u32s': list(range(16)),
+    'u128s': [2 ** 100 + i for i in range(16)],
+    'str': 'user:1234',
+    'bytes': b'x' * 100,
+    'strs': HOSTS,
+    'blobs': [messages.getFile('user:1234', 42)] * 8,
+    'clock': {host: 2 for host in HOSTS},
+    'versions': [[{HOSTS[0]: 2, HOSTS[1]: 1}, b'x' * 100]],
+    'result': [[{HOSTS[0]: 2, HOSTS[1]: 1}, b'x' * 100]],
+    'any': [['user:1234', [[{HOSTS[0]: 2}, b'x' * 100]]]],
+}
+
+
+def codec_cases():
+    for (message_type, schema) in sorted(messages.MESSAGE_SCHEMAS.items()):
+        fields = [SAMPLE_FIELDS[kind] for kind in schema]
+        frame = messages._pack_message(message_type, *fields)
+        name = '%s(%s)' % (message_type.hex(), ','.join(schema))
+        yield ('codec encode %s' % name, lambda t=message_type, f=fields: messages._pack_message(t, *f), None)
+        yield ('codec decode %s' % name, lambda f=frame: messages._unpack_message(f), None)
+
+
+def compare(results, baseline, threshold):
+    """Cases slower or allocating more than the baseline by more than threshold percent"""
+    regressions = []
+    for (case, r) in results.items():
+        b = baseline.get(case)
+        if b is None:
+            continue
+        if r['ops_per_sec'] < b['ops_per_sec'] * (1 - threshold / 100.0):
+            regressions.append('%s: %.0f ops/s, baseline %.0f' % (case, r['ops_per_sec'], b['ops_per_sec']))
+        # a few bytes more are noise, e.g. a larger int or a longer key
+        if r['alloc_bytes'] > b['alloc_bytes'] * (1 + threshold / 100.0) + 64:
+            regressions.append('%s: %d bytes allocated, baseline %d' % (case, r['alloc_bytes'], b['alloc_bytes']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--seconds', default=1.0, type=float, help='Time spent measuring each case')
+    parser.add_argument('--repeat', default=5, type=int, help='Measurements of each case, the fastest counts')
+    parser.add_argument('--only', default='storage,versions,ring,codec', help='Groups of cases to run')
+    parser.add_argument('--rows', default='1000,10000,100000', help='Table sizes of the storage cases')
+    parser.add_argument('--siblings', default='1,4,16,64', help='Concurrent versions of the versions cases')
+    parser.add_argument('--ring_sizes', default='4,16,64', help='Node counts of the ring cases')
+    parser.add_argument('--dir', default=None, help='Directory for the databases of the storage cases')
+    parser.add_argument('--save', default=None, help='Write the results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='JSON file written by --save to compare with')
+    parser.add_argument('--threshold', default=20.0, type=float, help='Percentage of slowdown or growth that fails')
+    args = parser.parse_args()
+
+    groups = args.only.split(',')
+    sizes = lambda s: [int(n) for n in s.split(',')]
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    row = '%-52s %12s %12s %10s'
+    print(row % ('case', 'ops/s', 'alloc B/op', 'vs base'))
+
+    results = {}
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        cases = []
+        if 'storage' in groups:
+            cases.append(storage_cases(sizes(args.rows), tmp))
+        if 'versions' in groups:
+            cases.append(versions_cases(sizes(args.siblings), tmp))
+        if 'ring' in groups:
+            cases.append(ring_cases(sizes(args.ring_sizes)))
+        if 'codec' in groups:
+            cases.append(codec_cases())
+
+        for group in cases:
+            for (case, fn, done) in group:
+                ops = best_rate(fn, args.seconds, args.repeat)
+                alloc = allocated_bytes(fn)
+                if done is not None:
+                    done()
+
+                results[case] = {'ops_per_sec': round(ops, 1), 'alloc_bytes': alloc}
+                change = ''
+                if case in baseline:
+                    change = '%+.1f%%' % (100.0 * (ops / baseline[case]['ops_per_sec'] - 1))
+                print(row % (case, '%.0f' % ops, alloc, change))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print("\nRegressions beyond %g%%:" % args.threshold)
+        for r in regressions:
+            print("  " + r)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Write throughput of Storage under each durability setting, and get latency
+as the database grows.
+
+Every case writes to a fresh database in a temporary directory. The first row
+is the setup before WAL mode (rollback journal, commit per write). Group
+commit rows commit once per group of writes, as concurrent writes within a
+commit window would.
+
+    python3 -m benchmarks.bench_storage [--seconds S] [--dir DIR] [--read_rows 1000,100000,1000000]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from scheduler import Scheduler
+from storage import Storage, SYNCHRONOUS_LEVELS, h
+
+
+def writes_per_second(path, synchronous, group, seconds, journal_mode=None):
+    # the window is never reached here, groups are closed by commit_count
+    db = Storage(path, synchronous=synchronous, commit_window=60 if group > 1 else 0, commit_count=group,
+                 scheduler=Scheduler())
+    if journal_mode is not None:
+        db.db.execute('PRAGMA journal_mode=%s;' % journal_mode)
+
+    acked = [0]
+
+    def ack():
+        acked[0] += 1
+
+    value = 'x' * 100
+    clock = {'172.18.0.2': 1}
+    n = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for _ in range(group):
+            db.storeFile(h('key%d' % n), '172.18.0.3', clock, value, on_commit=ack)
+            n += 1
+
+    db.flush()
+    elapsed = time.perf_counter() - start
+    db.db.close()
+    return acked[0] / elapsed
+
+
+def get_latency(path, rows, reads=2000):
+    """Mean getFile time in microseconds on a database of the given number of keys, each written 3 times"""
+    db = Storage(path, synchronous='OFF')
+    for n in range(rows):
+        clock = None
+        for writer in ('172.18.0.2', '172.18.0.3', '172.18.0.4'):
+            db.storeFile('key%d' % n, writer, clock, 'x' * 100, commit=False)
+            clock = {writer: 1}
+    db.flush()
+
+    keys = ['key%d' % random.randrange(rows) for _ in range(reads)]
+    start = time.perf_counter()
+    for key in keys:
+        db.getFile(key)
+    elapsed = time.perf_counter() - start
+    db.db.close()
+    return elapsed / reads * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--seconds', default=1.0, type=float, help='Time spent measuring each case')
+    parser.add_argument('--dir', default=None, help='Directory for the databases, on the disk to measure')
+    parser.add_argument('--read_rows', default='1000,100000', help='Comma separated database sizes for get latency')
+    args = parser.parse_args()
+
+    cases = [('DELETE', 'FULL', 1)]
+    cases += [('WAL', level, group) for level in SYNCHRONOUS_LEVELS for group in (1, 16, 64)]
+
+    row = '%-8s %-12s %6s %12s'
+    print(row % ('journal', 'synchronous', 'group', 'writes/s'))
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        for (i, (journal, level, group)) in enumerate(cases):
+            path = os.path.join(tmp, '%d.db' % i)
+            rate = writes_per_second(path, level, group, args.seconds, journal_mode=None if journal == 'WAL' else journal)
+            print(row % (journal, level, group, '%.0f' % rate))
+
+        print()
+        row = '%10s %12s'
+        print(row % ('keys', 'get us'))
+        for rows in [int(r) for r in args.read_rows.split(',') if r]:
+            print(row % (rows, '%.1f' % get_latency(os.path.join(tmp, 'read%d.db' % rows), rows)))
+
+
+if __name__ == '__main__':
+    main()
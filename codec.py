@@ -0,0 +1,451 @@
+"""Binary encoding of message fields.
+
+Every field kind has a pack function that appends to a bytearray and an
+unpack function that reads from a memoryview at an offset and returns
+(value, new offset). Integers are big endian, strings and blobs are length
+prefixed.
+
+    str       u32 length + utf-8
+    bytes     u32 length + data
+    u8/u32/u64/u128
+    f64       IEEE 754 double
+    u32s/u128s u32 count + the integers
+    strs      u32 count + str per item
+    blobs     u32 count + bytes per item
+    clock     u16 count (0xFFFF for None), u16 length + NUL separated node ids, u32 counter per entry
+    versions  u32 count, u8 flags, u16 node id count, the node ids like a clock's,
+              u16 entry count per version, the table indexes of the entries of
+              every version, then their counters, the u32 length of every value
+              and the values. Indexes are u8 and counters u16 unless the flags
+              say they need u16 and u32.
+    result    u8 kind (0 None, 1 str, 2 versions) + the value, for a put or get result
+    any       one tag byte + the value, for fields whose type varies, lists,
+              tuples, sets and dicts nested at most MAX_DEPTH deep
+"""
+import struct
+from itertools import chain
+
+
+class ProtocolError(Exception):
+    pass
+
+
+_U8 = struct.Struct('!B')
+_U16 = struct.Struct('!H')
+_U32 = struct.Struct('!I')
+_U64 = struct.Struct('!Q')
+_I64 = struct.Struct('!q')
+_F64 = struct.Struct('!d')
+_NO_CLOCK = 0xFFFF
+
+_COUNTERS = {}  # n : Struct of n u32 counters
+
+
+def _counters(n):
+    s = _COUNTERS.get(n)
+    if s is None:
+        s = _COUNTERS[n] = struct.Struct('!%dI' % n)
+    return s
+
+
+def pack_u8(out, value):
+    out += _U8.pack(value)
+
+
+def unpack_u8(mv, offset):
+    return mv[offset], offset + 1
+
+
+def pack_u32(out, value):
+    out += _U32.pack(value)
+
+
+def unpack_u32(mv, offset):
+    return _U32.unpack_from(mv, offset)[0], offset + 4
+
+
+def pack_u64(out, value):
+    out += _U64.pack(value)
+
+
+def unpack_u64(mv, offset):
+    return _U64.unpack_from(mv, offset)[0], offset + 8
+
+
+def pack_f64(out, value):
+    out += _F64.pack(value)
+
+
+def unpack_f64(mv, offset):
+    return _F64.unpack_from(mv, offset)[0], offset + 8
+
+
+def pack_u128(out, value):
+    out += value.to_bytes(16, 'big')
+
+
+def unpack_u128(mv, offset):
+    return int.from_bytes(mv[offset:offset + 16], 'big'), offset + 16
+
+
+def pack_u32s(out, values):
+    out += _U32.pack(len(values))
+    out += struct.pack('!%dI' % len(values), *values)
+
+
+def unpack_u32s(mv, offset):
+    n, offset = unpack_u32(mv, offset)
+    return list(struct.unpack_from('!%dI' % n, mv, offset)), offset + 4 * n
+
+
+def pack_u128s(out, values):
+    out += _U32.pack(len(values))
+    out += b''.join(v.to_bytes(16, 'big') for v in values)
+
+
+def unpack_u128s(mv, offset):
+    n, offset = unpack_u32(mv, offset)
+    return [int.from_bytes(mv[i:i + 16], 'big') for i in range(offset, offset + 16 * n, 16)], offset + 16 * n
+
+
+def pack_bytes(out, value):
+    out += _U32.pack(len(value))
+    out += value
+
+
+def unpack_bytes(mv, offset):
+    n = _U32.unpack_from(mv, offset)[0]
+    offset += 4
+    return bytes(mv[offset:offset + n]), offset + n
+
+
+def pack_str(out, value):
+    pack_bytes(out, value.encode('utf-8'))
+
+
+def unpack_str(mv, offset):
+    n = _U32.unpack_from(mv, offset)[0]
+    offset += 4
+    return str(mv[offset:offset + n], 'utf-8'), offset + n
+
+
+def pack_strs(out, values):
+    values = list(values)
+    out += _U32.pack(len(values))
+    for v in values:
+        pack_str(out, v)
+
+
+def unpack_strs(mv, offset):
+    n, offset = unpack_u32(mv, offset)
+    values = []
+    for _ in range(n):
+        v, offset = unpack_str(mv, offset)
+        values.append(v)
+    return values, offset
+
+
+def pack_blobs(out, values):
+    out += _U32.pack(len(values))
+    for v in values:
+        pack_bytes(out, v)
+
+
+def unpack_blobs(mv, offset):
+    n, offset = unpack_u32(mv, offset)
+    values = []
+    for _ in range(n):
+        v, offset = unpack_bytes(mv, offset)
+        values.append(v)
+    return values, offset
+
+
+def _pack_ids(out, ids):
+    blob = '\x00'.join(ids).encode('utf-8')
+    out += _U16.pack(len(blob))
+    out += blob
+
+
+def _unpack_ids(mv, offset, n):
+    length = _U16.unpack_from(mv, offset)[0]
+    offset += 2
+    if not n:
+        return [], offset + length
+    return str(mv[offset:offset + length], 'utf-8').split('\x00'), offset + length
+
+
+# counters are u32, a writer adds 1 to its own one
+MAX_COUNTER = 0xFFFFFFFF
+
+
+def valid_clock(clock):
+    """True if clock can be the context of a put: None or a dict of node id : counter
+    that still encodes once the writer's counter is incremented. Contexts come from
+    clients, a bad one has to be refused before it reaches pack_clock."""
+    if clock is None:
+        return True
+    if not isinstance(clock, dict) or len(clock) >= _NO_CLOCK - 1:
+        return False
+    for (node_id, counter) in clock.items():
+        if not isinstance(node_id, str) or '\x00' in node_id:
+            return False
+        if type(counter) is not int or not 0 <= counter < MAX_COUNTER:
+            return False
+    try:
+        return len('\x00'.join(clock).encode('utf-8')) <= 0xFFFF
+    except UnicodeEncodeError:  # a lone surrogate, json.loads lets them through
+        return False
+
+
+_CLOCK_HEAD = struct.Struct('!HH')  # count, length of the node ids
+_NO_CLOCK_BYTES = _U16.pack(_NO_CLOCK)
+
+
+def encode_clock(clock):
+    """A clock field as bytes"""
+    if clock is None:
+        return _NO_CLOCK_BYTES
+
+    n = len(clock)
+    ids = '\x00'.join(clock).encode('utf-8')
+    return _CLOCK_HEAD.pack(n, len(ids)) + ids + _counters(n).pack(*clock.values())
+
+
+def pack_clock(out, clock):
+    out += encode_clock(clock)
+
+
+def unpack_clock(mv, offset):
+    n = _U16.unpack_from(mv, offset)[0]
+    if n == _NO_CLOCK:
+        return None, offset + 2
+
+    ids, offset = _unpack_ids(mv, offset + 2, n)
+    counters = _counters(n).unpack_from(mv, offset)
+    return dict(zip(ids, counters)), offset + 4 * n
+
+
+_VERSIONS_HEAD = struct.Struct('!IBH')  # count, flags, table size
+_WIDE_INDEXES = 1  # table indexes are u16, else u8
+_WIDE_COUNTERS = 2  # counters are u32, else u16
+_SIZES = {}  # count : Struct of the entry counts
+_ENTRIES = {}  # (entries, count, flags) : Struct of the indexes, counters and value lengths
+
+
+def _sizes_struct(count):
+    s = _SIZES.get(count)
+    if s is None:
+        s = _SIZES[count] = struct.Struct('!%dH' % count)
+    return s
+
+
+def _entries_struct(entries, count, flags):
+    s = _ENTRIES.get((entries, count, flags))
+    if s is None:
+        if len(_ENTRIES) >= 4096:  # sizes vary without bound, keep the common ones
+            _ENTRIES.clear()
+        s = _ENTRIES[(entries, count, flags)] = struct.Struct('!%d%s%d%s%dI' % (
+            entries, 'H' if flags & _WIDE_INDEXES else 'B', entries, 'I' if flags & _WIDE_COUNTERS else 'H', count))
+    return s
+
+
+def pack_versions(out, versions):
+    if len(versions) == 1:  # most keys have one version, its node ids are the table in clock order
+        (clock, value) = versions[0]
+        n = len(clock)
+        flags = (_WIDE_INDEXES if n > 0xFF else 0) | (_WIDE_COUNTERS if n and max(clock.values()) > 0xFFFF else 0)
+        out += _VERSIONS_HEAD.pack(1, flags, n)
+        _pack_ids(out, clock)
+        out += _U16.pack(n)
+        out += _entries_struct(n, 1, flags).pack(*range(n), *clock.values(), len(value))
+        out += value
+        return
+
+    # node ids repeat across versions, they are written once
+    clocks = [clock for (clock, _) in versions]
+    ids = list(dict.fromkeys(chain.from_iterable(clocks)))
+    table = dict(zip(ids, range(len(ids))))
+    indexes = list(map(table.__getitem__, chain.from_iterable(clocks)))
+    counters = list(chain.from_iterable(map(dict.values, clocks)))
+    flags = (_WIDE_INDEXES if len(ids) > 0xFF else 0) | (_WIDE_COUNTERS if max(counters, default=0) > 0xFFFF else 0)
+
+    out += _VERSIONS_HEAD.pack(len(versions), flags, len(ids))
+    _pack_ids(out, ids)
+    out += _sizes_struct(len(clocks)).pack(*map(len, clocks))
+    out += _entries_struct(len(indexes), len(clocks), flags).pack(*indexes, *counters, *[len(value) for (_, value) in versions])
+    for (_, value) in versions:
+        out += value
+
+
+def unpack_versions(mv, offset):
+    count, flags, table_size = _VERSIONS_HEAD.unpack_from(mv, offset)
+    table, offset = _unpack_ids(mv, offset + 7, table_size)
+    s = _sizes_struct(count)
+    sizes = s.unpack_from(mv, offset)
+    offset += s.size
+    entries = sum(sizes)
+    s = _entries_struct(entries, count, flags)
+    fields = s.unpack_from(mv, offset)
+    offset += s.size
+
+    names = list(map(table.__getitem__, fields[:entries]))
+    versions = []
+    i = entries
+    for (n, length) in zip(sizes, fields[2 * entries:]):
+        end = offset + length
+        versions.append([dict(zip(names[i - entries:i - entries + n], fields[i:i + n])), bytes(mv[offset:end])])
+        offset = end
+        i += n
+    return versions, offset
+
+
+def unpack_versions_v1(mv, offset):
+    """versions of protocol version 1: u16 table indexes and u32 counters, the entry count before each version"""
+    count, table_size = struct.unpack_from('!IH', mv, offset)
+    table, offset = _unpack_ids(mv, offset + 6, table_size)
+
+    versions = []
+    for _ in range(count):
+        n = _U16.unpack_from(mv, offset)[0]
+        entries = struct.unpack_from('!%dH%dI' % (n, n), mv, offset + 2)
+        offset += 2 + 6 * n
+        value, offset = unpack_bytes(mv, offset)
+        versions.append([{table[i]: c for (i, c) in zip(entries[:n], entries[n:])}, value])
+    return versions, offset
+
+
+# a result field: u8 kind, then nothing, a str or versions
+_RESULT_NONE, _RESULT_STR, _RESULT_VERSIONS = 0, 1, 2
+
+
+def pack_result(out, value):
+    if value is None:
+        out += b'\x00'
+    elif isinstance(value, str):
+        out += b'\x01'
+        pack_str(out, value)
+    else:
+        out += b'\x02'
+        pack_versions(out, value)
+
+
+def unpack_result(mv, offset):
+    kind = mv[offset]
+    if kind == _RESULT_NONE:
+        return None, offset + 1
+    if kind == _RESULT_STR:
+        return unpack_str(mv, offset + 1)
+    if kind == _RESULT_VERSIONS:
+        return unpack_versions(mv, offset + 1)
+    raise ProtocolError("Unknown result kind %d" % kind)
+
+
+def pack_any(out, value):
+    if value is None:
+        out += b'N'
+    elif value is True:
+        out += b'T'
+    elif value is False:
+        out += b'F'
+    elif isinstance(value, int):
+        out += b'i'
+        out += _I64.pack(value)
+    elif isinstance(value, float):
+        out += b'f'
+        out += _F64.pack(value)
+    elif isinstance(value, str):
+        out += b's'
+        pack_str(out, value)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        out += b'b'
+        pack_bytes(out, value)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        out += b'l' if isinstance(value, list) else (b't' if isinstance(value, tuple) else b'S')
+        out += _U32.pack(len(value))
+        for item in value:
+            pack_any(out, item)
+    elif isinstance(value, dict):
+        out += b'd'
+        out += _U32.pack(len(value))
+        for (k, v) in value.items():
+            pack_any(out, k)
+            pack_any(out, v)
+    else:
+        raise ProtocolError("Cannot encode %r" % type(value))
+
+
+MAX_DEPTH = 32  # nesting of any values, deeper frames are rejected instead of exhausting the stack
+
+
+def unpack_any(mv, offset, depth=0):
+    tag = mv[offset]
+    offset += 1
+
+    if tag == 0x4E:  # N
+        return None, offset
+    if tag == 0x54:  # T
+        return True, offset
+    if tag == 0x46:  # F
+        return False, offset
+    if tag == 0x69:  # i
+        return _I64.unpack_from(mv, offset)[0], offset + 8
+    if tag == 0x66:  # f
+        return _F64.unpack_from(mv, offset)[0], offset + 8
+    if tag == 0x73:  # s
+        return unpack_str(mv, offset)
+    if tag == 0x62:  # b
+        return unpack_bytes(mv, offset)
+    if depth == MAX_DEPTH and tag in (0x6C, 0x74, 0x53, 0x64):
+        raise ProtocolError("Values nested more than %d deep" % MAX_DEPTH)
+    if tag in (0x6C, 0x74, 0x53):  # l, t, S
+        n, offset = unpack_u32(mv, offset)
+        items = []
+        for _ in range(n):
+            item, offset = unpack_any(mv, offset, depth + 1)
+            items.append(item)
+        return (items if tag == 0x6C else (tuple(items) if tag == 0x74 else set(items))), offset
+    if tag == 0x64:  # d
+        n, offset = unpack_u32(mv, offset)
+        d = {}
+        for _ in range(n):
+            k, offset = unpack_any(mv, offset, depth + 1)
+            d[k], offset = unpack_any(mv, offset, depth + 1)
+        return d, offset
+    raise ProtocolError("Unknown value tag %#x" % tag)
+
+
+PACKERS = {
+    'u8': pack_u8,
+    'u32': pack_u32,
+    'u64': pack_u64,
+    'u128': pack_u128,
+    'f64': pack_f64,
+    'u32s': pack_u32s,
+    'u128s': pack_u128s,
+    'str': pack_str,
+    'bytes': pack_bytes,
+    'strs': pack_strs,
+    'blobs': pack_blobs,
+    'clock': pack_clock,
+    'versions': pack_versions,
+    'result': pack_result,
+    'any': pack_any,
+}
+
+UNPACKERS = {
+    'u8': unpack_u8,
+    'u32': unpack_u32,
+    'u64': unpack_u64,
+    'u128': unpack_u128,
+    'f64': unpack_f64,
+    'u32s': unpack_u32s,
+    'u128s': unpack_u128s,
+    'str': unpack_str,
+    'bytes': unpack_bytes,
+    'strs': unpack_strs,
+    'blobs': unpack_blobs,
+    'clock': unpack_clock,
+    'versions': unpack_versions,
+    'result': unpack_result,
+    'any': unpack_any,
+}
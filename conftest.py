@@ -0,0 +1,2 @@
+# test_cases.py drives a running cluster from the command line, it is not a unit test module
+collect_ignore = ['test_cases.py']
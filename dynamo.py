@@ -1,3 +1,4 @@
+import asyncio
 import socket
 import argparse
 
@@ -6,15 +7,37 @@ from node import Node
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(add_help=False)
     parser.add_argument('--leader', help='Hostname of leader')
+    parser.add_argument('--hostname', default=socket.gethostname(),
+                        help='Hostname or IP this node listens on and is known by in the ring, e.g. 127.0.0.2 for several nodes on one machine')
     parser.add_argument('--port', default=13337, type=int, help='TCP port number for server socket')
     parser.add_argument('--qsize', default=5, type=int, help='Fraction of peers on which data will be replicated')
     parser.add_argument('--sq_write_n', default=3, type=int, help='Min number of confirmed peers in a put operation with sloppy quorum')
     parser.add_argument('--sq_read_n', default=3, type=int, help='Number of polled peers in a get operation')
+    parser.add_argument('--max_requests', default=10000, type=int, help='Max number of requests in flight on this node')
+    parser.add_argument('--batch_window_ms', default=1.0, type=float, help='How long replica operations wait to be batched, 0 disables batching')
+    parser.add_argument('--batch_size', default=64, type=int, help='Max number of replica operations in one batch')
+    parser.add_argument('--synchronous', default='FULL', choices=['OFF', 'NORMAL', 'FULL', 'EXTRA'], help='SQLite synchronous level of the database')
+    parser.add_argument('--commit_window_ms', default=0.0, type=float, help='How long writes wait to share a commit, 0 commits every write')
+    parser.add_argument('--commit_count', default=64, type=int, help='Max number of writes sharing a commit')
+    parser.add_argument('--cache_bytes', default=0, type=int, help='Size of the cache of recently read keys in bytes, 0 disables it')
+    parser.add_argument('--storage', default='sqlite', choices=['sqlite', 'log'], help='Storage engine of the node')
+    parser.add_argument('--anti_entropy_interval', default=10, type=float,
+                        help='Seconds between Merkle tree comparisons with other replicas, 0 disables anti-entropy')
+    parser.add_argument('--rebalance_rate', default=4 << 20, type=int,
+                        help='Max bytes per second sent when moving data after a membership change')
+    parser.add_argument('--rebalance_chunk', default=256 << 10, type=int,
+                        help='Bytes of values sent at a time when moving data after a membership change')
+    parser.add_argument('--handoff_max_bytes', default=256 << 20, type=int,
+                        help='Max bytes of hints kept for unreachable replicas, the oldest are dropped beyond it')
+    parser.add_argument('--read_repair_rate', default=1000, type=int,
+                        help='Max versions per second sent to replicas that answered a get with stale data, 0 disables read repair')
+    parser.add_argument('--vnodes', default=1, type=int, help='Number of tokens of each node on the ring, the same on every node')
+    parser.add_argument('--event_loop', default='select', choices=['select', 'asyncio'], help='Server loop used to handle connections')
 
     args = parser.parse_args()
 
     is_leader = False  # is the current node the leader
-    hostname = socket.gethostname()
+    hostname = args.hostname
 
     leader_hostname = args.leader
     if not leader_hostname or (leader_hostname == hostname):
@@ -22,6 +45,16 @@ if __name__ == '__main__':
         leader_hostname = hostname
 
     n = Node(is_leader, leader_hostname, hostname, tcp_port=args.port,
-             sloppy_Qsize=args.qsize, sloppy_R=args.sq_read_n, sloppy_W=args.sq_write_n)
+             sloppy_Qsize=args.qsize, sloppy_R=args.sq_read_n, sloppy_W=args.sq_write_n,
+             max_requests=args.max_requests, batch_window=args.batch_window_ms / 1000.0,
+             batch_size=args.batch_size, synchronous=args.synchronous,
+             commit_window=args.commit_window_ms / 1000.0, commit_count=args.commit_count,
+             cache_bytes=args.cache_bytes, storage_engine=args.storage, vnodes=args.vnodes,
+             anti_entropy_interval=args.anti_entropy_interval, rebalance_bytes_per_sec=args.rebalance_rate,
+             rebalance_chunk_bytes=args.rebalance_chunk, handoff_max_bytes=args.handoff_max_bytes,
+             read_repair_rate=args.read_repair_rate)
 
-    n.accept_connections()
+    if args.event_loop == 'asyncio':
+        asyncio.run(n.accept_connections_async())
+    else:
+        n.accept_connections()
@@ -0,0 +1,338 @@
+"""Hinted handoff.
+
+A hint is a version a replica missed because it did not answer in time. A
+node holding hints keeps one append-only log per target host in a directory,
+<host>.log, and the offset up to which the target acknowledged them in
+<host>.offset. A record is a crc32 of the rest (u32), the body length (u32),
+the time the hint was written (f64) and the body, fields encoded as in
+codec.py:
+
+    key (str), clock, value (bytes)
+
+Hints are the exact versions the coordinator stored, they are delivered as
+0x05 transfer messages of up to batch_size hints and stored as they are.
+Only one batch per host is in flight. After an acknowledgement the offset is
+checkpointed and the next batch goes out at once; after a failed or timed
+out delivery the host is retried with exponential backoff, so a host that is
+down costs one attempt per backoff period and every hint is written and read
+once. A log is truncated when all of it was delivered, or rewritten from the
+offset once the delivered part is most of a large file.
+
+All logs together hold at most max_bytes of pending hints, beyond that the
+oldest hints of any host are dropped. At startup the logs are read
+sequentially from their offsets, up to the first torn or corrupt record.
+"""
+import os
+import pickle
+import random
+import struct
+import time
+import zlib
+
+import codec
+import messages
+
+_RECORD = struct.Struct('!IId')  # crc32, body length, time written
+
+
+class HintLog(object):
+    """Pending hints for one host"""
+
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.offset_path = path[:-len('.log')] + '.offset'
+        self.fsync = fsync
+
+        try:
+            with open(self.offset_path, 'r') as f:
+                self.offset = int(f.read())
+        except (FileNotFoundError, ValueError):
+            self.offset = 0
+
+        self.count, self.size = 0, self.offset
+        self.oldest = None  # time of the first pending hint
+        with open(path, 'ab+') as f:
+            if self.offset > f.seek(0, os.SEEK_END):  # the log was emptied after the offset was saved
+                self.offset = self.size = 0
+            f.seek(self.offset)
+            for (written, _, end) in self._records(f):
+                if self.oldest is None:
+                    self.oldest = written
+                self.count += 1
+                self.size = end
+            if self.size < f.seek(0, os.SEEK_END):
+                print("Truncating %s at %d, the rest is torn or corrupt" % (path, self.size))
+                f.truncate(self.size)
+
+        self._file = open(path, 'ab', buffering=0)
+
+    @staticmethod
+    def _records(f):
+        """(time written, body, end offset) of the records from the position of f on"""
+        offset = f.tell()
+        while True:
+            head = f.read(_RECORD.size)
+            if len(head) < _RECORD.size:
+                return
+            crc, length, written = _RECORD.unpack(head)
+            body = f.read(length)
+            if len(body) < length or zlib.crc32(head[4:] + body) != crc:
+                return
+            offset += _RECORD.size + length
+            yield written, body, offset
+
+    @property
+    def pending_bytes(self):
+        return self.size - self.offset
+
+    def append(self, key, clock, value):
+        body = bytearray()
+        codec.pack_str(body, key)
+        codec.pack_clock(body, clock)
+        codec.pack_bytes(body, value)
+
+        now = time.time()
+        record = bytearray(_RECORD.pack(0, len(body), now)) + body
+        struct.pack_into('!I', record, 0, zlib.crc32(memoryview(record)[4:]))
+        self._file.write(record)
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+        self.size += len(record)
+        self.count += 1
+        if self.oldest is None:
+            self.oldest = now
+
+    def read(self, max_hints):
+        """Up to max_hints pending [key, [[clock, value]]] items and the offset after them"""
+        items, end = [], self.offset
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            for (_, body, end) in self._records(f):
+                mv = memoryview(body)
+                key, offset = codec.unpack_str(mv, 0)
+                clock, offset = codec.unpack_clock(mv, offset)
+                value = codec.unpack_bytes(mv, offset)[0]
+                items.append([key, [[clock, value]]])
+                if len(items) == max_hints or end >= self.size:
+                    break
+        return items, end
+
+    def drop_oldest(self):
+        """Skip the first pending hint"""
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            for (_, _, end) in self._records(f):
+                self.checkpoint(end, 1)
+                return
+
+    def checkpoint(self, offset, count):
+        """The hints before offset, count of them, are done with.
+
+        The offset is saved before the log is truncated or rewritten, a crash
+        in between delivers hints again, which stores nothing new."""
+        self.count -= count
+        if offset >= self.size:
+            self._save_offset(0)
+            self._file.truncate(0)
+            self.offset = self.size = self.count = 0
+            self.oldest = None
+            return
+
+        if offset > 4 << 20 and offset > self.size // 2:
+            self._rewrite(offset)
+        else:
+            self.offset = offset
+            self._save_offset(offset)
+
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            self.oldest = _RECORD.unpack(f.read(_RECORD.size))[2]
+
+    def _save_offset(self, offset):
+        tmp = self.offset_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(offset))
+        os.replace(tmp, self.offset_path)
+
+    def _rewrite(self, offset):
+        """Replace the log with a copy of the hints from offset on"""
+        tmp = self.path + '.tmp'
+        with open(self.path, 'rb') as src, open(tmp, 'wb') as dst:
+            src.seek(offset)
+            while True:
+                chunk = src.read(1 << 20)
+                if not chunk:
+                    break
+                dst.write(chunk)
+
+        self._save_offset(0)
+        self._file.close()
+        os.replace(tmp, self.path)
+        self._file = open(self.path, 'ab', buffering=0)
+        self.size -= offset
+        self.offset = 0
+
+    def close(self):
+        self._file.close()
+
+    def remove(self):
+        self._file.close()
+        for path in (self.path, self.offset_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class HandoffStore(object):
+    """The hint logs of every host and their delivery"""
+
+    def __init__(self, directory, scheduler, send, fsync=True, max_bytes=256 << 20, batch_size=256,
+                 ack_timeout=5.0, min_backoff=1.0, max_backoff=60.0):
+        """
+        :param send: send(hosts, frame), returns the hosts it failed to send to
+        """
+        self.directory = directory
+        self.scheduler = scheduler
+        self.send = send
+        self.fsync = fsync
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.ack_timeout = ack_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self.logs = {}  # host : HintLog
+        self._backoff = {}  # host : seconds to wait after the next failure
+        self._timers = {}  # host : timer of the next delivery or of the ack timeout
+        self._in_flight = {}  # host : (seq, end offset, hints)
+        self._transfer_id = random.getrandbits(63)
+        self._seq = 0
+        self.shed = 0
+
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.log'):
+                log = HintLog(os.path.join(directory, name), fsync)
+                if log.count:
+                    self.logs[name[:-len('.log')]] = log
+                    print("Restored %d hints for %s" % (log.count, name[:-len('.log')]))
+                    self._schedule(name[:-len('.log')], 0)
+                else:
+                    log.remove()
+
+    def migrate(self, pickle_path, writer):
+        """Move the hints of the old pickle file (host : set of storeFile frames) to the logs.
+
+        Those frames are in the format of the first protocol, a 5 byte header and
+        a pickled (name, value, context, req_id) tuple.
+        """
+        try:
+            with open(pickle_path, 'rb') as f:
+                old = pickle.loads(f.read())
+        except FileNotFoundError:
+            return
+
+        count = 0
+        for (host, frames) in old.items():
+            for frame in frames:
+                try:
+                    (key, value, context, _) = pickle.loads(frame[5:])
+                except Exception as e:  # anything can come out of a damaged pickle
+                    print("Skipping a hand off message for %s: %s" % (host, e))
+                    continue
+                self._add_store(key, value, context, writer, [host])
+                count += 1
+        os.remove(pickle_path)
+        print("Moved %d hand off messages from %s" % (count, pickle_path))
+
+    def add_frame(self, frame, writer, hosts):
+        """Keep the version a storeFile frame led writer to store for hosts"""
+        message_type, data = messages._unpack_message(frame)
+        if message_type != b'\x07':
+            raise messages.ProtocolError("A hand off holds a storeFile frame, not %r" % message_type)
+        (key, value, context, _) = data
+        self._add_store(key, value, context, writer, hosts)
+
+    def _add_store(self, key, value, context, writer, hosts):
+        clock = dict(context) if context else {}
+        clock[writer] = clock.get(writer, 0) + 1
+        self.add(key, clock, value.encode('utf-8') if isinstance(value, str) else value, hosts)
+
+    def add(self, key, clock, value, hosts):
+        for host in hosts:
+            log = self.logs.get(host)
+            if log is None:
+                log = self.logs[host] = HintLog(os.path.join(self.directory, host + '.log'), self.fsync)
+            log.append(key, clock, value)
+            if host not in self._timers:
+                self._schedule(host, 0)
+
+        self._enforce_cap()
+
+    def _enforce_cap(self):
+        total = sum(log.pending_bytes for log in self.logs.values())
+        while total > self.max_bytes:
+            host = min((log.oldest, host) for (host, log) in self.logs.items() if log.count)[1]
+            log = self.logs[host]
+            before = log.pending_bytes
+            if host in self._in_flight:  # being delivered, drop it with the batch
+                self._timers.pop(host).cancel()
+                del self._in_flight[host]
+                self._schedule(host, 0)
+            log.drop_oldest()
+            total -= before - log.pending_bytes
+            self.shed += 1
+
+    def _schedule(self, host, delay):
+        self._timers[host] = self.scheduler.call_later(delay, self._deliver, host)
+
+    def _deliver(self, host):
+        log = self.logs.get(host)
+        if log is None or not log.count:  # all of it was shed
+            self._timers.pop(host, None)
+            if log is not None:
+                log.remove()
+                del self.logs[host]
+            return
+
+        items, end = log.read(self.batch_size)
+        self._seq += 1
+        self._in_flight[host] = (self._seq, end, len(items))
+        self._timers[host] = self.scheduler.call_later(self.ack_timeout, self._failed, host)
+        if self.send([host], messages.transfer(self._transfer_id, self._seq, items)):
+            self._timers[host].cancel()
+            self._failed(host)
+
+    def _failed(self, host):
+        self._in_flight.pop(host, None)
+        backoff = self._backoff.get(host, self.min_backoff)
+        self._backoff[host] = min(backoff * 2, self.max_backoff)
+        print("Could not hand off hints to %s, retrying in %.0fs" % (host, backoff))
+        self._schedule(host, backoff)
+
+    def handle_ack(self, transfer_id, seq, host):
+        """host stored batch seq, returns False if that is not one of ours"""
+        in_flight = self._in_flight.get(host)
+        if transfer_id != self._transfer_id or in_flight is None or in_flight[0] != seq:
+            return False
+
+        del self._in_flight[host]
+        self._timers.pop(host).cancel()
+        self._backoff.pop(host, None)
+
+        log = self.logs[host]
+        log.checkpoint(in_flight[1], in_flight[2])
+        print("Handed off %d hints to %s, %d left" % (in_flight[2], host, log.count))
+        if log.count:
+            self._schedule(host, 0)
+        else:
+            log.remove()
+            del self.logs[host]
+        return True
+
+    def stats(self):
+        return {'hosts': {host: {'hints': log.count, 'bytes': log.pending_bytes, 'backoff': self._backoff.get(host, 0)}
+                          for (host, log) in self.logs.items()},
+                'shed': self.shed}
@@ -0,0 +1,390 @@
+"""Log structured storage engine.
+
+Writes are appended to segment files (segment-<number>.log) in a directory.
+Once the active segment reaches segment_bytes a new one is started, older
+segments are never written again. An in-memory index maps the hash of each key
+to its live versions: their clocks and where the value is. Values are read
+through mmap.
+
+A record is a crc32 of the rest of the record (u32), the body length (u32),
+the record kind (u8) and the body, with fields encoded as in codec.py:
+
+    PUT     key (str), clock, value (bytes)
+    DELETE  key (str)
+    MARK    number of the first segment replaced (u32), first record of a compacted segment
+
+At startup the segments are replayed in order to rebuild the index. A torn or
+corrupt record ends its segment, the file is truncated there.
+
+Writes keep only the frontier of a key, like the SQLite engine, so superseded
+versions are dead bytes in their segment. A background thread compacts all
+sealed segments into one once dead bytes make up compaction_ratio of them: the
+live records are copied into a new file that replaces the last sealed segment
+and starts with a MARK, then the other sealed segments are removed. If that is
+interrupted, the MARK tells the next startup which segments are obsolete.
+"""
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+import codec
+from storage import StorageEngine, SYNCHRONOUS_LEVELS, h
+
+_RECORD = struct.Struct('!IIB')  # crc32, body length, kind
+
+PUT = 1
+DELETE = 2
+MARK = 3
+
+
+class _Version(object):
+    """Index entry of one live version"""
+    __slots__ = ('key', 'clock', 'segment', 'record', 'size', 'value', 'length')
+
+    def __init__(self, key, clock, segment, record, size, value, length):
+        self.key = key
+        self.clock = clock
+        self.segment = segment
+        self.record = record  # offset and size of the record in the segment
+        self.size = size
+        self.value = value  # offset and length of the value in the segment
+        self.length = length
+
+
+class LogStorage(StorageEngine):
+
+    def __init__(self, path, synchronous='FULL', commit_window=0, commit_count=64, scheduler=None, cache_bytes=0,
+                 segment_bytes=64 << 20, compaction_ratio=0.5):
+        """Open or create the log in directory path.
+
+        :param synchronous: OFF never fsyncs, the other levels fsync on every commit
+        :param segment_bytes: size at which the active segment is sealed
+        :param compaction_ratio: share of dead bytes in sealed segments that starts a compaction
+        """
+        StorageEngine.__init__(self, commit_window=commit_window, commit_count=commit_count, scheduler=scheduler,
+                               cache_bytes=cache_bytes)
+
+        if synchronous.upper() not in SYNCHRONOUS_LEVELS:
+            raise ValueError("synchronous must be one of %s" % ", ".join(SYNCHRONOUS_LEVELS))
+
+        self.path = path
+        self.fsync = synchronous.upper() != 'OFF'
+        self.segment_bytes = segment_bytes
+        self.compaction_ratio = compaction_ratio
+
+        self._index = {}  # key hash : [_Version]
+        self._sizes = {}  # segment : bytes written
+        self._dead = {}  # segment : bytes of records that are not in the index
+        self._maps = {}  # segment : mmap of it, remapped when the segment grew
+        self._lock = threading.RLock()  # index, sizes and maps are shared with the compaction thread
+
+        os.makedirs(path, exist_ok=True)
+        self._replay()
+
+        self._active_number = max(self._sizes) if self._sizes else 1
+        self._active = self._open_segment(self._active_number)
+
+        self._closed = False
+        self._compact_wanted = threading.Event()
+        self._compactor = threading.Thread(target=self._compact_loop, daemon=True)
+        self._compactor.start()
+        self._compact_wanted.set()
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, 'segment-%08d.log' % number)
+
+    def _open_segment(self, number):
+        self._sizes.setdefault(number, 0)
+        self._dead.setdefault(number, 0)
+        return open(self._segment_path(number), 'ab', buffering=0)
+
+    @staticmethod
+    def _parse(m, offset, size):
+        """(kind, body offset, end) of the record at offset, None if it is torn or corrupt"""
+        if offset + _RECORD.size > size:
+            return None
+
+        crc, length, kind = _RECORD.unpack_from(m, offset)
+        end = offset + _RECORD.size + length
+        if end > size or zlib.crc32(m[offset + 4:end]) != crc:
+            return None
+        return kind, offset + _RECORD.size, end
+
+    @staticmethod
+    def _read_put(m, body):
+        """key, clock and value offset and length of a PUT record body"""
+        key, offset = codec.unpack_str(m, body)
+        clock, offset = codec.unpack_clock(m, offset)
+        length = codec.unpack_u32(m, offset)[0]
+        return key, clock, offset + 4, length
+
+    def _segment_numbers(self):
+        return sorted(int(name[8:16]) for name in os.listdir(self.path)
+                      if name.startswith('segment-') and name.endswith('.log'))
+
+    def _replay(self):
+        for name in os.listdir(self.path):
+            if name.endswith('.compact'):  # unfinished compaction
+                os.remove(os.path.join(self.path, name))
+
+        numbers = self._segment_numbers()
+
+        # a compacted segment replaces the segments from its MARK up to itself,
+        # they are still there if the last compaction was interrupted
+        replaced = set()
+        for number in numbers:
+            with open(self._segment_path(number), 'rb') as f:
+                head = f.read(_RECORD.size + 4)
+            if len(head) == _RECORD.size + 4 and head[8] == MARK:
+                first = struct.unpack_from('!I', head, _RECORD.size)[0]
+                replaced.update(n for n in numbers if first <= n < number)
+
+        for number in sorted(replaced):
+            print("Removing segment %d, it was compacted" % number)
+            os.remove(self._segment_path(number))
+
+        for number in numbers:
+            if number not in replaced:
+                self._replay_segment(number)
+
+        if self._index:
+            print("Restored %d keys from %d segments in %s" % (len(self._index), len(self._sizes), self.path))
+
+    def _replay_segment(self, number):
+        path = self._segment_path(number)
+        size = os.path.getsize(path)
+        self._sizes[number] = size
+        self._dead[number] = 0
+        if not size:
+            return
+
+        with open(path, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        offset = 0
+        while offset < size:
+            record = self._parse(m, offset, size)
+            if record is None:
+                print("Truncating %s at %d of %d bytes, the rest is torn or corrupt" % (path, offset, size))
+                break
+
+            kind, body, end = record
+            if kind == PUT:
+                key, clock, value, length = self._read_put(m, body)
+                key_hash = h(key)
+                versions = self._index.get(key_hash, [])
+                stale = self._supersede(clock, [v.clock for v in versions])
+                if stale is None:
+                    self._dead[number] += end - offset
+                else:
+                    self._replace(key_hash, versions, stale,
+                                  _Version(key, clock, number, offset, end - offset, value, length))
+            elif kind == DELETE:
+                self._drop(h(codec.unpack_str(m, body)[0]))
+                self._dead[number] += end - offset
+            else:  # MARK
+                self._dead[number] += end - offset
+
+            offset = end
+
+        m.close()
+        if offset < size:
+            os.truncate(path, offset)
+            self._sizes[number] = offset
+
+    def _replace(self, key_hash, versions, stale, version):
+        for i in stale:
+            self._dead[versions[i].segment] += versions[i].size
+        self._index[key_hash] = [v for (i, v) in enumerate(versions) if i not in stale] + [version]
+
+    def _drop(self, key_hash):
+        for v in self._index.pop(key_hash, ()):
+            self._dead[v.segment] += v.size
+
+    def _append(self, kind, body):
+        """Write a record to the active segment. Returns (segment, offset, size)."""
+        if self._sizes[self._active_number] >= self.segment_bytes:
+            self._rotate()
+
+        record = bytearray(_RECORD.pack(0, len(body), kind))
+        record += body
+        struct.pack_into('!I', record, 0, zlib.crc32(memoryview(record)[4:]))
+
+        number = self._active_number
+        offset = self._sizes[number]
+        self._active.write(record)
+        self._sizes[number] += len(record)
+        return number, offset, len(record)
+
+    def _rotate(self):
+        if self.fsync:  # writes waiting for a group commit may be in it
+            os.fsync(self._active.fileno())
+        self._active.close()
+
+        self._active_number += 1
+        self._active = self._open_segment(self._active_number)
+        self._compact_wanted.set()
+
+    def _map(self, number, end):
+        m = self._maps.get(number)
+        if m is None or len(m) < end:
+            if m is not None:
+                m.close()
+            with open(self._segment_path(number), 'rb') as f:
+                m = self._maps[number] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return m
+
+    def _write(self, key, key_hash, version, data):
+        with self._lock:
+            versions = self._index.get(key_hash, [])
+            stale = self._supersede(version, [v.clock for v in versions])
+            if stale is None:
+                return None
+
+            body = bytearray()
+            codec.pack_str(body, key)
+            codec.pack_clock(body, version)
+            value = _RECORD.size + len(body) + 4
+            codec.pack_bytes(body, data)
+
+            number, offset, size = self._append(PUT, body)
+            self._replace(key_hash, versions, stale,
+                          _Version(key, version, number, offset, size, offset + value, len(data)))
+            return [versions[i].clock for i in stale]
+
+    def _read(self, key, key_hash):
+        with self._lock:
+            return [[dict(v.clock), self._map(v.segment, v.value + v.length)[v.value:v.value + v.length]]
+                    for v in self._index.get(key_hash, ())]
+
+    def _delete(self, key, key_hash):
+        with self._lock:
+            versions = self._index.get(key_hash)
+            if not versions:
+                return []
+
+            self._drop(key_hash)
+            body = bytearray()
+            codec.pack_str(body, key)
+            number, _, size = self._append(DELETE, body)
+            self._dead[number] += size
+            return [v.clock for v in versions]
+
+    def _scan(self):
+        with self._lock:
+            entries = list(self._index.values())
+        return [(v.key, v.clock, v.length) for versions in entries for v in versions]
+
+    def _sync(self):
+        if self.fsync:
+            with self._lock:
+                os.fsync(self._active.fileno())
+
+    def stats(self):
+        with self._lock:
+            return {'keys': len(self._index), 'segments': len(self._sizes),
+                    'bytes': sum(self._sizes.values()), 'dead_bytes': sum(self._dead.values())}
+
+    def _compact_loop(self):
+        while True:
+            self._compact_wanted.wait()
+            self._compact_wanted.clear()
+            if self._closed:
+                return
+
+            try:
+                self.compact()
+            except OSError as e:
+                print("Compaction of %s failed: %s" % (self.path, e))
+
+    def compact(self, force=False):
+        """Rewrite the live records of all sealed segments into one. Unless forced
+        only done when dead bytes make up compaction_ratio of the sealed segments.
+        Returns the number of bytes reclaimed."""
+        with self._lock:
+            sealed = sorted(n for n in self._sizes if n != self._active_number)
+            total = sum(self._sizes[n] for n in sealed)
+            dead = sum(self._dead[n] for n in sealed)
+            if not dead or (not force and dead < self.compaction_ratio * total):
+                return 0
+            entries = list(self._index.items())
+
+        # sealed segments are not written anymore, copy from them without holding the lock
+        sealed_set = set(sealed)
+        moving = [(key_hash, v) for (key_hash, versions) in entries for v in versions if v.segment in sealed_set]
+        moving.sort(key=lambda entry: (entry[1].segment, entry[1].record))
+
+        target = sealed[-1]
+        tmp_path = self._segment_path(target) + '.compact'
+        maps = {}
+        moved = []
+        try:
+            with open(tmp_path, 'wb') as out:
+                mark = bytearray()
+                codec.pack_u32(mark, sealed[0])
+                record = bytearray(_RECORD.pack(0, len(mark), MARK)) + mark
+                struct.pack_into('!I', record, 0, zlib.crc32(memoryview(record)[4:]))
+                out.write(record)
+                offset = len(record)
+
+                for (key_hash, v) in moving:
+                    if v.segment not in maps:
+                        with open(self._segment_path(v.segment), 'rb') as f:
+                            maps[v.segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    out.write(maps[v.segment][v.record:v.record + v.size])
+                    moved.append((key_hash, v, offset))
+                    offset += v.size
+
+                out.flush()
+                os.fsync(out.fileno())
+        finally:
+            for m in maps.values():
+                m.close()
+
+        with self._lock:
+            # versions superseded while copying are dead in the new segment
+            new_dead = len(record)
+            for (key_hash, v, new_offset) in moved:
+                if any(x is v for x in self._index.get(key_hash, ())):
+                    v.value += new_offset - v.record
+                    v.record = new_offset
+                    v.segment = target
+                else:
+                    new_dead += v.size
+
+            for n in sealed:
+                m = self._maps.pop(n, None)
+                if m is not None:
+                    m.close()
+
+            os.replace(tmp_path, self._segment_path(target))
+            for n in sealed[:-1]:
+                os.remove(self._segment_path(n))
+                del self._sizes[n]
+                del self._dead[n]
+
+            dir_fd = os.open(self.path, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+            self._sizes[target] = offset
+            self._dead[target] = new_dead
+
+        print("Compacted %d segments of %s, reclaimed %d bytes" % (len(sealed), self.path, total - offset))
+        return total - offset
+
+    def close(self):
+        self._closed = True
+        self._compact_wanted.set()
+        self._compactor.join()
+
+        with self._lock:
+            self._sync()
+            self._active.close()
+            for m in self._maps.values():
+                m.close()
+            self._maps = {}
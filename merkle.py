@@ -0,0 +1,148 @@
+"""Merkle trees of the versions a node holds, for anti-entropy.
+
+A node keeps one MerkleTree per token range it replicates. The range is cut
+into 2**depth equal slices of the hash space (the leaves), a key falls in the
+slice its ring position lands in. The hash of a leaf is the XOR of the digests
+of the versions stored in its slice, the hash of an inner node the XOR of its
+children's, so storing or removing a version updates depth + 1 hashes and
+never rescans the range.
+
+A version's digest covers its key and clock, not its value: two replicas with
+versions of equal clocks and different values look the same. Every leaf also
+keeps the digest of each of its keys, the XOR of the digests of the key's
+versions. Replicas compare those for the leaves that differ, so only the
+versions of the keys that differ are sent, however many keys a leaf holds.
+
+The nodes of a tree are kept in one list, heap style: node i has children
+2i + 1 and 2i + 2, the root is node 0 and the leaves are the last 2**depth.
+"""
+import bisect
+import json
+from hashlib import md5
+
+from ring import HASH_SPACE
+
+
+def version_digest(key, clock):
+    """128 bit digest of a version"""
+    blob = key + '\x00' + json.dumps(clock, sort_keys=True, separators=(',', ':'))
+    return int.from_bytes(md5(blob.encode('utf-8')).digest(), 'big')
+
+
+class MerkleTree(object):
+    """Tree of the versions of the keys in the ring range [start, end)"""
+
+    def __init__(self, start, end, depth=8):
+        self.start = start
+        self.end = end
+        self.depth = depth
+        self.size = (end - start) % HASH_SPACE or HASH_SPACE  # a single token owns the whole ring
+
+        self.first_leaf = (1 << depth) - 1
+        self.hashes = [0] * (2 * self.first_leaf + 1)
+        self.keys = [{} for _ in range(1 << depth)]  # per leaf, key : [number of versions, digest of the key]
+
+    def leaf_of(self, position):
+        """Leaf number of a ring position"""
+        return ((position - self.start) % HASH_SPACE) * len(self.keys) // self.size
+
+    def update(self, key, position, clock, added):
+        """Add (added=True) or remove a version"""
+        leaf = self.leaf_of(position)
+        digest = version_digest(key, clock)
+        keys = self.keys[leaf]
+        entry = keys.setdefault(key, [0, 0])
+        entry[0] += 1 if added else -1
+        entry[1] ^= digest
+        if entry[0] <= 0:
+            del keys[key]
+
+        index = self.first_leaf + leaf
+        while True:
+            self.hashes[index] ^= digest
+            if not index:
+                break
+            index = (index - 1) // 2
+
+    def is_leaf(self, index):
+        return index >= self.first_leaf
+
+    def children(self, index):
+        return 2 * index + 1, 2 * index + 2
+
+    def leaf_keys(self, index):
+        """Keys with versions in the slice of tree node index, a leaf"""
+        return list(self.keys[index - self.first_leaf])
+
+    def key_digests(self, leaves):
+        """key : digest of the keys in the slices of the tree nodes leaves"""
+        return {key: entry[1] for leaf in leaves for (key, entry) in self.keys[leaf - self.first_leaf].items()}
+
+    def diff_keys(self, leaves, keys, digests):
+        """Keys of the slices of leaves whose digest differs in another replica,
+        keys and digests are that replica's for the same leaves"""
+        listed = dict(zip(keys, digests))
+        mine = self.key_digests(leaves)
+        return [key for key in set(listed).union(mine) if listed.get(key, 0) != mine.get(key, 0)]
+
+    def diff(self, indexes, hashes):
+        """Compare the hashes of another replica's tree nodes with ours.
+        Returns the differing inner nodes and the differing leaves."""
+        inner, leaves = [], []
+        for (index, other) in zip(indexes, hashes):
+            if index < len(self.hashes) and self.hashes[index] != other:
+                (leaves if self.is_leaf(index) else inner).append(index)
+        return inner, leaves
+
+
+class MerkleIndex(object):
+    """The MerkleTrees of every range a host replicates.
+
+    Set apply as the on_change hook of the host's storage engine so the trees
+    follow its writes, and call rebuild after the ring changes.
+    """
+
+    def __init__(self, ring, hostname, depth=8):
+        self.ring = ring
+        self.hostname = hostname
+        self.depth = depth
+
+        self.trees = {}  # (start, end) : MerkleTree
+        self.preference = {}  # (start, end) : preference list of the range
+        self._ends = []  # sorted ends of the ranges, to find the tree of a position
+        self._by_end = []
+
+    def rebuild(self, stored):
+        """Recompute every tree from stored, an iterable of (key, [clocks], size) like Storage.scan()"""
+        self.trees, self.preference = {}, {}
+        for (start, end, preference) in self.ring.get_replicated_ranges(self.hostname):
+            self.trees[(start, end)] = MerkleTree(start, end, self.depth)
+            self.preference[(start, end)] = preference
+
+        self._by_end = sorted(self.trees.values(), key=lambda tree: tree.end)
+        self._ends = [tree.end for tree in self._by_end]
+
+        for (key, clocks, _) in stored:
+            self.apply(key, clocks, [])
+
+    def tree_of(self, position):
+        """The tree of a ring position, None if the host does not replicate it"""
+        if not self._ends:
+            return None
+
+        # same rule as Ring.lookup, the range of the first end past the position
+        index = bisect.bisect(self._ends, position)
+        tree = self._by_end[index if index < len(self._ends) else 0]
+        return tree if (position - tree.start) % HASH_SPACE < tree.size else None
+
+    def apply(self, key, added, removed):
+        """Storage on_change hook"""
+        position = self.ring.key_position(key)
+        tree = self.tree_of(position)
+        if tree is None:
+            return
+
+        for clock in removed:
+            tree.update(key, position, clock, False)
+        for clock in added:
+            tree.update(key, position, clock, True)
@@ -1,6 +1,8 @@
-import pickle
 import struct
 
+import codec
+from codec import ProtocolError, valid_clock
+
 ############################################
 '''	Message Codes (first byte of message)
 
@@ -20,6 +22,15 @@ import struct
 
     40 -- clientGetResponse
 
+    05 -- transfer
+          versions sent to a replica: to a new owner when membership changes
+          (rebalance.py) or hints for a replica that missed writes (handoff.py)
+
+          transfer id 0 is a read repair (readrepair.py), it is not acknowledged
+
+    50 -- transferAck
+          the chunk of a transfer was stored
+
     06 -- clientRemoveNode
 
     07 -- storeFile
@@ -33,114 +44,456 @@ import struct
     09 -- peerList 
 
     0A -- forwardedClientReq 
-          contents is the bytestring of the client message
+          a client's get or put for the key's coordinator: the request id at the
+          forwarding node, operation, name, value, context and creation time
+
+    A0 -- responseForForwardedReq
+          request id at the forwarding node, operation and the result: the stored
+          value or "Error" for a put, the coalesced versions, None or "Error" for a get
+
+    0B -- clientResponse
+          answer to a client command, any value
+
+    0C -- handoff
+
+    0D -- batch
+          storeFile/getFile frames for one replica, applied in one transaction
+
+    D0 -- batchResponse
+          the response frames of a batch, in the same order
+
+    12 -- mget
+          the keys of a multi-key get that one coordinator handles
 
-    0B -- ResponseForForwardedClientReq
-          contents is the bytestring to be sent to client
+    21 -- mgetResponse
+          the versions of each key, or an error
+
+    13 -- mput
+          [key, value, context] items of a multi-key put that one coordinator handles
+
+    31 -- mputResponse
+          the stored value of each key, or an error
+
+    14 -- ringRequest
+          a client asks for the membership ring
+
+    41 -- ring
+          vnode count, replica count and hosts of the ring, the client hashes keys
+          with them to send clientPut/clientGet to the coordinator (smartclient.py)
+
+    15 -- redirect
+          answer to a clientPut/clientGet sent to a node that does not coordinate
+          the key, the client fetches the ring again
+
+    0E -- merkleHashes
+          hashes of Merkle tree nodes of a replicated range, see merkle.py
+
+    0F -- merkleVersions
+          the versions of the keys in differing Merkle tree leaves
+
+    1E -- merkleKeys
+          the digests of the keys in differing Merkle tree leaves
+
+    1F -- merkleWant
+          keys whose versions the sender of a merkleKeys should send
 
     FF -- OK!
 
+    Frame layout: message code (1 byte), payload length (4 bytes), payload.
+    The payload starts with the protocol version (1 byte), followed by the
+    fields of the message encoded as listed in MESSAGE_SCHEMAS (see codec.py).
+
 '''
 
+# Messages only sent by clients. Replies to these go back over the connection they came in on.
+CLIENT_MESSAGE_TYPES = (b'\x00', b'\x02', b'\x03', b'\x04', b'\x06', b'\x14')
+
+# Version written into every frame. Decoders for older versions stay in
+# _DECODERS so a cluster can be upgraded one node at a time.
+# 2: compact versions fields, the result of a forwarded request is a result field
+PROTOCOL_VERSION = 2
+
+# Field kinds of each message. Messages with one field decode to the bare value,
+# the others to a tuple of their fields.
+MESSAGE_SCHEMAS = {
+    b'\x00': ('str',),  # user input
+    b'\x01': ('u32', 'u32', 'u8', 'str'),  # view_id, req_id, operation, address
+    b'\xff': ('u32', 'u32'),  # view_id, req_id
+    b'\x10': ('u32', 'u8', 'strs'),  # view_id, operation, addresses
+    b'\x02': (),
+    b'\x03': ('str', 'str', 'clock'),  # name, value, context
+    b'\x30': ('str', 'str', 'clock'),  # name, value or "Error", context
+    b'\x04': ('str',),  # name
+    b'\x40': ('str', 'any'),  # name, versions, None or "Error"
+    b'\x05': ('u64', 'u32', 'any'),  # transfer id, chunk number, [key, versions] items
+    b'\x50': ('u64', 'u32'),  # transfer id, chunk number
+    b'\x06': ('str',),  # name
+    b'\x07': ('str', 'str', 'clock', 'u64'),  # name, value, context, req_id
+    b'\x70': ('str', 'str', 'clock', 'u64'),  # name, value, context, req_id
+    b'\x08': ('str', 'u64'),  # name, req_id
+    b'\x80': ('str', 'versions', 'u64'),  # name, versions, req_id
+    b'\x09': ('strs',),  # peers
+    b'\x0A': ('u64', 'u8', 'str', 'str', 'clock', 'f64'),  # req_id, operation, name, value, context, time created
+    b'\xa0': ('u64', 'u8', 'result'),  # req_id, operation, result
+    b'\x0B': ('any',),  # answer to a client command
+    b'\x0C': ('bytes', 'strs'),  # storeFile frame, replicas
+    b'\x0D': ('blobs',),  # storeFile/getFile frames
+    b'\xd0': ('blobs',),  # storeFile/getFile response frames
+    b'\x12': ('u64', 'strs'),  # id, keys
+    b'\x21': ('u64', 'any'),  # id, {key: versions or error}
+    b'\x13': ('u64', 'any'),  # id, [key, value, context] items
+    b'\x31': ('u64', 'any'),  # id, {key: value or error}
+    b'\x14': (),
+    b'\x41': ('u32', 'u32', 'strs'),  # vnode count, replica count, hosts
+    b'\x15': ('str', 'str'),  # name, coordinator
+    b'\x0E': ('u128', 'u128', 'u32s', 'u128s'),  # range start, range end, tree node indexes, their hashes
+    b'\x0F': ('u128', 'u128', 'u32s', 'u8', 'any'),  # range start, range end, leaf indexes, reply wanted, [key, versions] items
+    b'\x1E': ('u128', 'u128', 'u32s', 'strs', 'u128s'),  # range start, range end, leaf indexes, keys, their digests
+    b'\x1F': ('u128', 'u128', 'strs'),  # range start, range end, keys
+}
+
+_HEADER = struct.Struct('!ciB')  # code, payload length, protocol version
+
+# Largest payload accepted from a connection, a longer or empty one ends the connection
+MAX_FRAME = 64 << 20
+_LENGTH = struct.Struct('!I')
+
+
+# packers and unpackers of each message, in field order
+_PACKERS = {t: tuple(codec.PACKERS[kind] for kind in schema) for (t, schema) in MESSAGE_SCHEMAS.items()}
+_UNPACKERS = {t: tuple(codec.UNPACKERS[kind] for kind in schema) for (t, schema) in MESSAGE_SCHEMAS.items()}
+
+# version 1 had another versions layout and sent the result of a forwarded request as an any field
+_V1_UNPACKERS = {t: tuple(codec.unpack_versions_v1 if kind == 'versions' else codec.UNPACKERS[kind] for kind in schema)
+                 for (t, schema) in {**MESSAGE_SCHEMAS, b'\xa0': ('u64', 'u8', 'any')}.items()}
+
+
+def _pack_message(message_type, *fields):
+    fast = _FAST_PACKERS.get(message_type)
+    if fast is not None:
+        return fast(*fields)
+    return _pack_fields(message_type, fields)
+
+
+def _pack_fields(message_type, fields):
+    out = bytearray(_HEADER.size)
+    for (pack, value) in zip(_PACKERS[message_type], fields):
+        pack(out, value)
+
+    _HEADER.pack_into(out, 0, message_type, len(out) - 5, PROTOCOL_VERSION)
+    return bytes(out)
+
+
+def _decode_v2(message_type, mv):
+    # the messages of _FAST_UNPACKERS do not get here, see _unpack_message
+    return _decode_fields(_UNPACKERS, message_type, mv)
+
+
+def _decode_v1(message_type, mv):
+    return _decode_fields(_V1_UNPACKERS, message_type, mv)
+
+
+def _decode_fields(unpackers, message_type, mv):
+    unpackers = unpackers.get(message_type)
+    if unpackers is None:
+        raise ProtocolError("Unknown message type %r" % message_type)
+
+    if len(unpackers) == 1:
+        return unpackers[0](mv, 6)[0]
+
+    offset = 6
+    fields = []
+    for unpack in unpackers:
+        value, offset = unpack(mv, offset)
+        fields.append(value)
+
+    return tuple(fields) if fields else None
+
+
+_DECODERS = {
+    1: _decode_v1,
+    2: _decode_v2,
+}
+
 
 ############################################
 def _unpack_message(data):
-    message_type = data[0]
-    message = pickle.loads(data[5:])
+    """Decode a whole frame. Returns (message code, message)."""
+    if len(data) < 6:
+        raise ProtocolError("Truncated frame")
+    message_type = bytes(data[0:1])
+    version = data[5]
+
+    try:
+        fast = _FAST_UNPACKERS.get(message_type) if version == PROTOCOL_VERSION else None
+        if fast is not None:
+            return message_type, fast(data)
 
-    return bytes([message_type]), message
+        decoder = _DECODERS.get(version)
+        if decoder is None:
+            raise ProtocolError("Unsupported protocol version %d" % version)
+        return message_type, decoder(message_type, memoryview(data))
+    except (struct.error, IndexError, TypeError, ValueError) as e:  # e.g. an unhashable dict key, bad utf-8
+        raise ProtocolError("Malformed %r message: %s" % (message_type, e))
 
 
 def client_message(user_input):
-    data = pickle.dumps(user_input)
-    return b'\x00' + struct.pack('!i', len(data)) + data
+    return _pack_message(b'\x00', user_input)
 
 
 # Operation: 1 - add peer, 2 - delete peer
 def reqMessage(view_id, req_id, operation, address):
-    data = pickle.dumps((view_id, req_id, operation, address))
-    return b'\x01' + struct.pack('!i', len(data)) + data
+    return _pack_message(b'\x01', view_id, req_id, operation, address)
 
 
 def okMessage(view_id, req_id):
-    data = pickle.dumps((view_id, req_id))
-    return b'\xff' + struct.pack('!i', len(data)) + data
+    return _pack_message(b'\xff', view_id, req_id)
 
 
 def membershipChange(view_id, operation, address):
-    data = pickle.dumps((view_id, operation, address))
-    return b'\x10' + struct.pack('!i', len(data)) + data
+    return _pack_message(b'\x10', view_id, operation, address)
 
 
 def clientConnectReq():
-    return b'\x02' + struct.pack('!i', 0)
+    return _pack_message(b'\x02')
 
 
 def putMessage(name, value, context):
-    data = pickle.dumps((name, value, context))
-    return b'\x03' + struct.pack('!i', len(data)) + data
+    return _pack_message(b'\x03', name, value, context)
 
 
 def putResponse(name, value, context):
-    data = pickle.dumps((name, value, context))
-    return b'\x30' + struct.pack('!i', len(data)) + data
+    return _pack_message(b'\x30', name, value, context)
 
 
 def getMessage(name):
-    data = pickle.dumps(name)
-    return b'\x04' + struct.pack('!i', len(data)) + data
+    return _pack_message(b'\x04', name)
 
 
 # send back the file name and the combined list of values
 def getResponse(name, result):
-    data = pickle.dumps((name, result))
-    return b'\x40' + struct.pack('!i', len(data)) + data
+    return _pack_message(b'\x40', name, result)
+
+
+def transfer(transfer_id, seq, items):
+    return _pack_message(b'\x05', transfer_id, seq, items)
+
+
+def transferAck(transfer_id, seq):
+    return _pack_message(b'\x50', transfer_id, seq)
 
 
 def clientRemNode(name):
-    data = pickle.dumps(name)
-    return b'\x06' + struct.pack('!i', len(data)) + data
+    return _pack_message(b'\x06', name)
+
+
+# The messages of every replica operation and forwarded request are built and
+# read by the functions below instead of field by field. They write the same
+# bytes as _pack_fields, with one precompiled Struct for the fixed part.
+_U32 = struct.Struct('!I')
+_U64 = struct.Struct('!Q')
+_HEAD_STR = struct.Struct('!ciBI')  # header, length of the first str field
+
+
+def _store(message_type, name, value, context, req_id):
+    name = name.encode('utf-8')
+    value = value.encode('utf-8')
+    clock = codec.encode_clock(context)
+    return b''.join((_HEAD_STR.pack(message_type, 17 + len(name) + len(value) + len(clock), PROTOCOL_VERSION, len(name)),
+                     name, _U32.pack(len(value)), value, clock, _U64.pack(req_id)))
 
 
-def storeFile(name, value, context, stamp):
-    data = pickle.dumps((name, value, context, stamp))
-    return b'\x07' + struct.pack('!i', len(data)) + data
+def _unpack_store(data):
+    n = _U32.unpack_from(data, 6)[0]
+    offset = 10 + n
+    name = str(data[10:offset], 'utf-8')
+    m = _U32.unpack_from(data, offset)[0]
+    offset += 4
+    value = str(data[offset:offset + m], 'utf-8')
+    context, offset = codec.unpack_clock(data, offset + m)
+    return name, value, context, _U64.unpack_from(data, offset)[0]
 
 
-def storeFileResponse(name, value, context, stamp):
-    data = pickle.dumps((name, value, context, stamp))
-    return b'\x70' + struct.pack('!i', len(data)) + data
+def storeFile(name, value, context, req_id):
+    return _store(b'\x07', name, value, context, req_id)
 
 
-def getFile(name, stamp):
-    data = pickle.dumps((name, stamp))
-    return b'\x08' + struct.pack('!i', len(data)) + data
+def storeFileResponse(name, value, context, req_id):
+    return _store(b'\x70', name, value, context, req_id)
 
 
-def getFileResponse(name, result, stamp):
-    data = pickle.dumps((name, result, stamp))
-    return b'\x80' + struct.pack('!i', len(data)) + data
+def getFile(name, req_id):
+    name = name.encode('utf-8')
+    return _HEAD_STR.pack(b'\x08', 13 + len(name), PROTOCOL_VERSION, len(name)) + name + _U64.pack(req_id)
+
+
+def _unpack_getFile(data):
+    n = _U32.unpack_from(data, 6)[0]
+    return str(data[10:10 + n], 'utf-8'), _U64.unpack_from(data, 10 + n)[0]
+
+
+def getFileResponse(name, result, req_id):
+    name = name.encode('utf-8')
+    out = bytearray(_HEAD_STR.size)
+    out += name
+    codec.pack_versions(out, result)
+    out += _U64.pack(req_id)
+    _HEAD_STR.pack_into(out, 0, b'\x80', len(out) - 5, PROTOCOL_VERSION, len(name))
+    return bytes(out)
+
+
+def _unpack_getFileResponse(data):
+    n = _U32.unpack_from(data, 6)[0]
+    versions, offset = codec.unpack_versions(data, 10 + n)
+    return str(data[10:10 + n], 'utf-8'), versions, _U64.unpack_from(data, offset)[0]
 
 
 def peerList(peers):
-    data = pickle.dumps(peers)
-    return b'\x09' + struct.pack('!i', len(data)) + data
+    return _pack_message(b'\x09', peers)
+
+
+# Operation of a forwarded request: 0 - get, 1 - put
+FORWARD_OPERATIONS = ('get', 'put')
+
 
+_HEAD_FORWARD = struct.Struct('!ciBQBI')  # header, req_id, operation, length of the name
+_F64 = struct.Struct('!d')
 
-def forwardedReq(msg):
-    data = pickle.dumps(msg)
-    return b'\x0A' + struct.pack('!i', len(data)) + data
+
+def forwardedReq(req_id, operation, name, value, context, time_created):
+    name = name.encode('utf-8')
+    value = value.encode('utf-8')
+    clock = codec.encode_clock(context)
+    return b''.join((_HEAD_FORWARD.pack(b'\x0A', 26 + len(name) + len(value) + len(clock), PROTOCOL_VERSION,
+                                       req_id, operation, len(name)),
+                     name, _U32.pack(len(value)), value, clock, _F64.pack(time_created)))
+
+
+def _unpack_forwardedReq(data):
+    (req_id, operation, n) = _HEAD_FORWARD.unpack_from(data, 0)[3:]
+    offset = 19 + n
+    name = str(data[19:offset], 'utf-8')
+    m = _U32.unpack_from(data, offset)[0]
+    offset += 4
+    value = str(data[offset:offset + m], 'utf-8')
+    context, offset = codec.unpack_clock(data, offset + m)
+    return req_id, operation, name, value, context, _F64.unpack_from(data, offset)[0]
+
+
+_HEAD_FORWARD_RESPONSE = struct.Struct('!ciBQB')  # header, req_id, operation
+
+
+def responseForForwardedReq(req_id, operation, result):
+    out = bytearray(_HEAD_FORWARD_RESPONSE.size)
+    codec.pack_result(out, result)
+    _HEAD_FORWARD_RESPONSE.pack_into(out, 0, b'\xa0', len(out) - 5, PROTOCOL_VERSION, req_id, operation)
+    return bytes(out)
+
+
+def _unpack_responseForForwardedReq(data):
+    (req_id, operation) = _HEAD_FORWARD_RESPONSE.unpack_from(data, 0)[3:]
+    return req_id, operation, codec.unpack_result(data, 15)[0]
 
 
 def handoff(command, replicas):
-    data = pickle.dumps((command, replicas))
-    return b'\x0C' + struct.pack('!i', len(data)) + data
+    return _pack_message(b'\x0C', command, replicas)
+
+
+def clientResponse(msg):
+    return _pack_message(b'\x0B', msg)
+
+
+def batch(frames):
+    return _pack_message(b'\x0D', frames)
+
+
+def batchResponse(frames):
+    return _pack_message(b'\xd0', frames)
+
+
+def mget(multi_id, keys):
+    return _pack_message(b'\x12', multi_id, keys)
+
+
+def mgetResponse(multi_id, results):
+    return _pack_message(b'\x21', multi_id, results)
+
+
+def mput(multi_id, items):
+    return _pack_message(b'\x13', multi_id, items)
+
+
+def mputResponse(multi_id, results):
+    return _pack_message(b'\x31', multi_id, results)
+
+
+def ringRequest():
+    return _pack_message(b'\x14')
+
+
+def ring(vnode_count, replica_count, hosts):
+    return _pack_message(b'\x41', vnode_count, replica_count, hosts)
+
+
+def redirect(name, coordinator):
+    return _pack_message(b'\x15', name, coordinator)
+
+
+def merkleHashes(start, end, indexes, hashes):
+    return _pack_message(b'\x0E', start, end, indexes, hashes)
+
+
+def merkleVersions(start, end, leaves, reply, items):
+    return _pack_message(b'\x0F', start, end, leaves, reply, items)
+
+
+def merkleKeys(start, end, leaves, keys, digests):
+    return _pack_message(b'\x1E', start, end, leaves, keys, digests)
+
+
+def merkleWant(start, end, keys):
+    return _pack_message(b'\x1F', start, end, keys)
+
 
+# builders and readers of the messages above, used for frames of the current version
+_FAST_PACKERS = {
+    b'\x07': storeFile,
+    b'\x70': storeFileResponse,
+    b'\x08': getFile,
+    b'\x80': getFileResponse,
+    b'\x0A': forwardedReq,
+    b'\xa0': responseForForwardedReq,
+}
 
-def responseForForward(msg):
-    data = pickle.dumps(msg)
-    return b'\x0B' + struct.pack('!i', len(data)) + data
+_FAST_UNPACKERS = {
+    b'\x07': _unpack_store,
+    b'\x70': _unpack_store,
+    b'\x08': _unpack_getFile,
+    b'\x80': _unpack_getFileResponse,
+    b'\x0A': _unpack_forwardedReq,
+    b'\xa0': _unpack_responseForForwardedReq,
+}
 
 
 def _get_payload_len(len_str):
-    return struct.unpack('!i', len_str)[0]
+    """Payload length of a frame header, raises ProtocolError if it is not 1 to MAX_FRAME"""
+    length = _LENGTH.unpack(len_str)[0]
+    if not 0 < length <= MAX_FRAME:
+        raise ProtocolError("Invalid frame length %d" % length)
+    return length
+
+
+def _split_frames(buf):
+    """Remove and return all complete frames from the bytearray buf. Partial frames are left in buf.
+    Raises ProtocolError for a header with an invalid length, the connection cannot be read any further."""
+    frames = []
+    offset = 0
+    while len(buf) - offset >= 5:
+        end = offset + 5 + _get_payload_len(bytes(buf[offset + 1:offset + 5]))
+        if end > len(buf):
+            break
+        frames.append(bytes(buf[offset:end]))
+        offset = end
+
+    del buf[:offset]
+    return frames
@@ -1,32 +1,50 @@
+import asyncio
+import itertools
 import logging
 import os
-import pickle
+import random
 import socket
 import struct
 import select
 import time
 import json
-from threading import Timer
+import traceback
 
 import messages
+import vclock
+from handoff import HandoffStore
+from logstore import LogStorage
+from merkle import MerkleIndex
+from readrepair import ReadRepair
+from rebalance import Rebalancer
 from ring import Ring
-from request import Request
+from pool import AsyncConnectionPool, ConnectionPool
+from request import MultiRequest, RegistryFull, Request, RequestRegistry
+from scheduler import Scheduler
 from storage import Storage
 from collections import defaultdict
 
 
+# answer to a put whose context is not a clock that can be stored and sent, see codec.valid_clock
+INVALID_CONTEXT = "Error: invalid context"
+
+
 class Node(object):
 
-    def __init__(self, is_leader, leader_hostname, my_hostname, tcp_port=13337, sloppy_Qsize=5, sloppy_R=3, sloppy_W=3):
+    def __init__(self, is_leader, leader_hostname, my_hostname, tcp_port=13337, sloppy_Qsize=5, sloppy_R=3, sloppy_W=3,
+                 max_requests=10000, batch_window=0.001, batch_size=64, synchronous='FULL', commit_window=0,
+                 commit_count=64, cache_bytes=0, storage_engine='sqlite', vnodes=1, anti_entropy_interval=10,
+                 rebalance_bytes_per_sec=4 << 20, rebalance_chunk_bytes=256 << 10, handoff_max_bytes=256 << 20,
+                 read_repair_rate=1000):
 
-        self.ongoing_requests = []
+        self.ongoing_requests = RequestRegistry(max_in_flight=max_requests)
         self.is_leader = is_leader
         self.leader_hostname = leader_hostname
         self.hostname = my_hostname
         self.tcp_port = tcp_port
         self.my_address = (self.hostname, self.tcp_port)
 
-        self.membership_ring = Ring(replica_count=sloppy_Qsize - 1)  # Other nodes in the membership
+        self.membership_ring = Ring(vnode_count=vnodes, replica_count=sloppy_Qsize - 1)  # Other nodes in the membership
         if self.is_leader:
             self.membership_ring.add_node(leader_hostname)
 
@@ -51,16 +69,18 @@ class Node(object):
         self.current_view = 0  # increment this on every leader election
         self.membership_request_id = 0  # increment this on every request sent to peers
 
-        # Maintains handoff messages to be sent
-        # IP : set(handoff messages)
-        self._handoff_messages = defaultdict(set)
-        self.handoff_timer = None
-        self.create_handoff_timer = lambda: Timer(5, self.try_sending_handoffs)
+        # every timeout of this node, run on the thread that processes messages
+        self.scheduler = Scheduler()
+        self._timer_handle = None  # asyncio mode: loop callback armed for the earliest deadline
 
         self.log_prefix = os.getcwd()
         self.ring_log_file = os.path.join(self.log_prefix, self.hostname + '.ring')
-        self.db_path = os.path.join(self.log_prefix, self.hostname + '.db')
-        self.handoff_log = os.path.join(self.log_prefix, self.hostname + '.pickle')
+        self.db_path = os.path.join(self.log_prefix, self.hostname + ('.segments' if storage_engine == 'log' else '.db'))
+        self.handoff_log = os.path.join(self.log_prefix, self.hostname + '.pickle')  # hints of older versions
+        self.handoff_dir = os.path.join(self.log_prefix, self.hostname + '.hints')
+        self.rebalance_log = os.path.join(self.log_prefix, self.hostname + '.rebalance')
+        self.vnodes_file = os.path.join(self.log_prefix, self.hostname + '.vnodes')
+        self._check_vnodes(vnodes)
 
         try:
             with open(self.ring_log_file, 'r') as f:
@@ -71,69 +91,191 @@ class Node(object):
         except FileNotFoundError:
             pass
 
-        try:
-            with open(self.handoff_log, 'rb') as f:
-                self._handoff_messages = pickle.loads(f.read())
-
-            if len(self._handoff_messages) > 0:
-                self.handoff_timer = self.create_handoff_timer()
-                self.handoff_timer.start()
-
-            print("Restored hand off messages from %s" % self.handoff_log)
-        except FileNotFoundError:
-            pass
+        # hints for replicas that missed writes, one log per host, delivered in batches with backoff
+        self.handoffs = HandoffStore(self.handoff_dir, self.scheduler, self.broadcast_message,
+                                     fsync=synchronous.upper() != 'OFF', max_bytes=handoff_max_bytes)
+        self.handoffs.migrate(self.handoff_log, socket.gethostbyname(self.hostname))
 
         self.request_timelimit = 2.0
         self.req_message_timers = {}
 
-        self.db = Storage(self.db_path)  # set up sqlite table
+        # multi-key requests waiting for other coordinators, sub-request id : MultiRequest
+        self._multi = {}
+        self._multi_ids = itertools.count(1)
+
+        # storeFile/getFile frames waiting to be sent to a replica as one batch
+        # node : [frames], flushed after batch_window seconds or at batch_size frames
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self._batches = {}
+        self._batch_timer = None
+
+        # set up the storage engine, writes are group committed when commit_window is set
+        engine = LogStorage if storage_engine == 'log' else Storage
+        self.db = engine(self.db_path, synchronous=synchronous, commit_window=commit_window,
+                         commit_count=commit_count, scheduler=self.scheduler, cache_bytes=cache_bytes)
+
+        # anti-entropy: Merkle trees of the replicated ranges, kept up to date by every write,
+        # roots compared with a random replica of each range every anti_entropy_interval seconds
+        self.anti_entropy_interval = anti_entropy_interval
+        self.merkle = None
+        if anti_entropy_interval > 0:
+            self.merkle = MerkleIndex(self.membership_ring, self.hostname)
+            self.db.on_change = self.merkle.apply
+            self.merkle.rebuild(self.db.scan())
+            self.scheduler.call_later(anti_entropy_interval, self.anti_entropy)
+
+        # moves data to the hosts that gain ranges on membership changes, picks up where a previous run stopped
+        self.rebalancer = Rebalancer(self.db, self.scheduler, self.broadcast_message, self.hostname, vnodes,
+                                     sloppy_Qsize - 1, self.rebalance_log, chunk_bytes=rebalance_chunk_bytes,
+                                     bytes_per_sec=rebalance_bytes_per_sec)
+        self.scheduler.call_later(0, self.rebalancer.resume)  # once the server loop and its pool run
+
+        # sends replicas the versions they were missing in their answer to a get, at most read_repair_rate rows/s
+        self.read_repair = None
+        if read_repair_rate > 0:
+            self.read_repair = ReadRepair(self.scheduler, self.broadcast_message, self.db.storeVersions,
+                                          socket.gethostbyname(self.hostname), rows_per_sec=read_repair_rate)
 
         # create tcp socket for communication with peers and clients
         self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.tcp_socket.setblocking(False)  # Non-blocking socket
+        # a restarted node can listen again while connections of the previous run are in TIME_WAIT
+        self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.tcp_socket.bind((self.hostname, self.tcp_port))
         self.tcp_socket.listen(10)
 
-        # has hostnames mapped to open sockets
-        self.connections = {}
+        # open connections to peers and clients, created by the server loop: a ConnectionPool with
+        # writer threads in select mode, an AsyncConnectionPool with writer tasks in asyncio mode
+        self.pool = None
         self.client_list = set()
 
+        # Set when running on an asyncio event loop (see accept_connections_async)
+        self._loop = None
+
     def accept_connections(self):
-        incoming_connections = {self.tcp_socket}
+        self.pool = ConnectionPool(self.tcp_port, self._peer_identity, source_ip=self.tcp_socket.getsockname()[0])
         print("Accepting connections...")
 
         while True:
-            readable, _, _ = select.select(incoming_connections, [], [], 0)
+            # Block until something is readable instead of polling
+            sockets = [self.tcp_socket, self.pool.wakeup_socket] + [c.transport for c in self.pool.connections()]
+            readable, _, _ = select.select(sockets, [], [], self.scheduler.next_timeout())
+            self.scheduler.run_due()
+
             for s in readable:
                 if s is self.tcp_socket:
                     connection, client_address = s.accept()
-                    connection.setblocking(False)
-
-                    incoming_connections.add(connection)
-                    self.connections[client_address[0]] = connection
-
-                else:
-                    try:
-                        header = s.recv(5)
-                    except:
-                        print("Connection reset.")
-                        continue
-
-                    if not header:  # remove for connection pool and close socket
-                        incoming_connections.remove(s)
-                        # del self.connections[s.getpeername()[0]]
-                        s.close()
-                    else:
-                        message_len = struct.unpack('!i', header[1:5])[0]
-
-                        data = b''
-                        while len(data) < message_len:
-                            try:
-                                data += s.recv(message_len - len(data))
-                            except socket.error as err:
-                                pass
-
-                        self._process_message(header + data, s.getpeername()[0])  # addr is a tuple of hostname and port
+                    connection.settimeout(self.pool.send_timeout)
+                    # answers are small frames, do not hold them back for the ack of the previous one (asyncio does the same)
+                    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.pool.add(connection, client_address)
+                    continue
+
+                if s is self.pool.wakeup_socket:  # a writer opened a connection, read from it too
+                    s.recv(4096)
+                    continue
+
+                conn = self.pool.get(s)
+                if conn is None:  # evicted while handling an earlier socket
+                    continue
+
+                try:
+                    chunk = s.recv(65536)
+                except BlockingIOError:
+                    continue
+                except socket.error:
+                    print("Connection reset.")
+                    chunk = b''
+
+                if not chunk:  # remove from connection pool and close socket
+                    self.pool.remove(conn)
+                    continue
+
+                # Partial frames stay in the buffer until the rest arrives
+                conn.read_buffer += chunk
+                try:
+                    frames = messages._split_frames(conn.read_buffer)
+                except messages.ProtocolError as e:
+                    print("Closing connection from %s: %s" % (conn.peername[0], e))
+                    self.pool.remove(conn)
+                    continue
+                for frame in frames:
+                    self._receive(frame, conn)
+
+    async def accept_connections_async(self):
+        """Serve peers and clients on an asyncio event loop.
+
+        Every connection gets its own reader coroutine, so a slow peer only
+        stalls itself. Timer callbacks are run on the loop as well.
+        """
+        self._loop = asyncio.get_running_loop()
+        self.pool = AsyncConnectionPool(self._read_messages, self.tcp_port, self._peer_identity,
+                                        source_ip=self.tcp_socket.getsockname()[0])
+        self.scheduler.on_reschedule = self._arm_timers
+        self._run_timers()
+        server = await asyncio.start_server(self._handle_connection, sock=self.tcp_socket)
+        print("Accepting connections...")
+
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_connection(self, reader, writer):
+        conn = self.pool.add(writer, writer.get_extra_info('peername'))
+        await self._read_messages(reader, conn)
+
+    async def _read_messages(self, reader, conn):
+        """Reader coroutine for a single connection. Dispatches whole frames to _process_message."""
+        try:
+            while True:
+                header = await reader.readexactly(5)
+                data = await reader.readexactly(messages._get_payload_len(header[1:5]))
+                self._receive(header + data, conn)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except messages.ProtocolError as e:
+            print("Closing connection from %s: %s" % (conn.peername[0], e))
+        finally:
+            self.pool.remove(conn)
+
+    def _receive(self, frame, conn):
+        """Process a frame read from conn. Clients are addressed by their connection,
+        peers by IP, and a peer's connection is reused to talk back to it."""
+        if frame[0:1] in messages.CLIENT_MESSAGE_TYPES:
+            sender = conn.client_id
+        else:
+            sender = conn.peername[0]
+            self.pool.adopt(conn)
+
+        try:
+            self._process_message(frame, sender)
+        except messages.ProtocolError as e:
+            print("Dropping message from %s: %s" % (sender, e))
+        except (TypeError, ValueError, KeyError, IndexError, AttributeError):
+            # a frame that decodes but whose fields do not have the shape its handler expects
+            print("Dropping malformed %r message from %s:" % (frame[0:1], sender))
+            traceback.print_exc()
+
+    def _peer_identity(self, name):
+        """Node identity for a hostname or IP: its hostname if it is in the ring."""
+        if name in self.membership_ring.hostname_to_ip:
+            return name
+        return self.membership_ring.ip_to_hostname.get(name, name)
+
+    def _arm_timers(self, deadline):
+        """asyncio mode: run the scheduler when its earliest deadline is reached"""
+        if self._timer_handle is not None:
+            self._timer_handle.cancel()
+        # loop.time() and the scheduler both use the monotonic clock
+        self._timer_handle = self._loop.call_at(deadline, self._run_timers)
+
+    def _run_timers(self):
+        self._timer_handle = None
+        self.scheduler.run_due()
+
+        deadline = self.scheduler.next_deadline()
+        if deadline is not None:
+            self._arm_timers(deadline)
 
     def _process_message(self, data, sender):
         message_type, data_tuple = messages._unpack_message(data)
@@ -147,13 +289,30 @@ class Node(object):
             b'\x08': self.perform_operation,
             b'\x70': self.update_request,
             b'\x80': self.update_request,
-            b'\x0B': self.update_request,
+            b'\xa0': self.handle_forward_response,
             b'\x0A': self.handle_forwarded_req,
-            b'\x0C': self.handle_handoff
+            b'\x0C': self.handle_handoff,
+            b'\x0D': self.perform_batch,
+            b'\xd0': self.handle_batch_response,
+            b'\x0E': self.handle_merkle_hashes,
+            b'\x0F': self.handle_merkle_versions,
+            b'\x1E': self.handle_merkle_keys,
+            b'\x1F': self.handle_merkle_want,
+            b'\x05': self.handle_transfer,
+            b'\x50': self.handle_transfer_ack,
+            b'\x12': self.handle_mget,
+            b'\x21': self.handle_multi_response,
+            b'\x13': self.handle_mput,
+            b'\x31': self.handle_multi_response,
+            b'\x03': self.handle_client_put,
+            b'\x04': self.handle_client_get,
+            b'\x14': self.handle_ring_request
         }
 
-        message_type_mapping[message_type](data_tuple, sender)
-        return
+        handler = message_type_mapping.get(message_type)
+        if handler is None:  # a valid message this node never receives, e.g. a client reply
+            raise messages.ProtocolError("No handler for message type %r" % message_type)
+        handler(data_tuple, sender)
 
     def _process_command(self, user_input, sendBackTo):
         """Process commands"""
@@ -167,61 +326,35 @@ class Node(object):
             "remove-node": self.remove_node,  # 2. remove node from membership
             "put": self.put_data,  # 3. put data
             "get": self.get_data,  # 4. get data
+            "mput": self.mput_data,  # put several keys
+            "mget": self.mget_data,  # get several keys
+            "stats": self.report_stats,  # 5. connection statistics
         }
 
         if not user_input:
-            self._send_req_response_to_client(sendBackTo, "User input empty")
+            return self._send_req_response_to_client(sendBackTo, "User input empty")
 
         # First word is command. Rest are then arguments.
         command, *data = user_input.split(" ")
         if command not in command_registry:
-            self._send_req_response_to_client(sendBackTo, "Invalid command")
+            return self._send_req_response_to_client(sendBackTo, "Invalid command")
 
         # Call the function associated with the command in command_registry
         return command_registry[command](data, sendBackTo)
 
-    def handle_handoff(self, data, sendBackTo):
-        # data should have (message, list of hosts to hand data off to)
-
-        for h in data[1]:
-            print("Storing hand off message for %s" % h)
-            self._handoff_messages[h].add(data[0])
-
-        # Save handoff messages to disk
-        self.sync_handoffs_to_disk()
-
-        # check and start timer
-        if not self.handoff_timer:
-            self.handoff_timer = self.create_handoff_timer()
-            self.handoff_timer.start()
+    def report_stats(self, data, sendBackTo):
+        """Send per-peer connection, storage cache, key space ownership, rebalancing, handoff and read repair statistics to the client"""
+        self._send_req_response_to_client(sendBackTo, {'connections': self.pool.report(), 'cache': self.db.cache_stats(),
+                                                       'ring': self.membership_ring.load_report(),
+                                                       'rebalance': self.rebalancer.stats(),
+                                                       'handoff': self.handoffs.stats(),
+                                                       'read_repair': self.read_repair.stats() if self.read_repair else None})
 
-    def try_sending_handoffs(self):
-        print("Attempting to send hand off messages...")
-
-        updated_handoff_messages = defaultdict(set)
-
-        for (host, msgs) in self._handoff_messages.items():
-            for msg in msgs:
-                fail = self.broadcast_message([host], msg)
-                if fail:
-                    updated_handoff_messages[host].add(msg)
-
-        self._handoff_messages = updated_handoff_messages
-        self.sync_handoffs_to_disk()
-
-        if len(self._handoff_messages) > 0:
-            print("Undelivered hand offs. Restarting timer")
-            self.handoff_timer = self.create_handoff_timer()
-            self.handoff_timer.start()
-            return
-
-        print("Sent all hand off messages.")
-        self.handoff_timer = None
-
-    def sync_handoffs_to_disk(self):
-        # Save hand off messages to disk
-        with open(self.handoff_log, 'wb') as f:
-            f.write(pickle.dumps(self._handoff_messages))
+    def handle_handoff(self, data, sendBackTo):
+        # data should have (storeFile message, list of hosts to hand data off to)
+        # sendBackTo coordinated the write, it is the writer of the stored version
+        print("Storing hand off message for %s" % ", ".join(data[1]))
+        self.handoffs.add_frame(data[0], sendBackTo, data[1])
 
     def add_node(self, data, sender):
         """Add node to membership. data[0] must be the hostname. Initiates 2PC."""
@@ -258,9 +391,8 @@ class Node(object):
 
         self.broadcast_message(nodes_to_broadcast, new_peer_message)
 
-        t = Timer(self.request_timelimit, self._req_timeout, args=[(self.current_view, self.membership_request_id)])
+        t = self.scheduler.call_later(self.request_timelimit, self._req_timeout, (self.current_view, self.membership_request_id))
         self.req_message_timers[(self.current_view, self.membership_request_id)] = t
-        t.start()
 
         self.membership_request_id += 1
 
@@ -297,9 +429,8 @@ class Node(object):
 
         self.broadcast_message(nodes_to_broadcast, new_peer_message)
 
-        t = Timer(self.request_timelimit, self._req_timeout, args=[(self.current_view, self.membership_request_id)])
+        t = self.scheduler.call_later(self.request_timelimit, self._req_timeout, (self.current_view, self.membership_request_id))
         self.req_message_timers[(self.current_view, self.membership_request_id)] = t
-        t.start()
 
         self.membership_request_id += 1
 
@@ -307,30 +438,29 @@ class Node(object):
 
     def put_data(self, data, sendBackTo):
         if len(data) != 3:
-            return "Error: Invalid operands\nInput: (<key>,<prev version>,<value>)"
+            return self._send_req_response_to_client(sendBackTo, "Error: Invalid operands\nInput: (<key>,<prev version>,<value>)")
 
-        data = [data[0], json.loads(data[1]), data[2]]
-        key = data[0]
-        prev = data[1]
-        value = data[2]
-        target_node = self.membership_ring.get_node_for_key(data[0])
-        if not self.is_leader:
-            # forward request to leader for client
-            return self._send_data_to_peer(self.leader_hostname, data, sendBackTo)
+        # (key, value, context), the order Request expects
+        try:
+            data = [data[0], data[2], json.loads(data[1])]
+        except ValueError:
+            return self._send_req_response_to_client(sendBackTo, "Error: prev version must be JSON")
+        if not messages.valid_clock(data[2]):
+            return self._send_req_response_to_client(sendBackTo, INVALID_CONTEXT)
 
-        else:  # I am the leader
-            if target_node == self.hostname:
-                # I'm processing a request for a client directly
-                self.start_request('put', data, sendBackTo=sendBackTo)
-                return
+        target_node = self.membership_ring.get_node_for_key(data[0])
+        # any node coordinates the keys it owns, the leader is only involved in membership changes
+        if target_node == self.hostname:
+            # I'm processing a request for a client directly
+            self.start_request('put', data, sendBackTo=sendBackTo)
 
-            else:  # I am forwarding a request from the client to the correct node
-                return self._send_data_to_peer(target_node, data, sendBackTo)
+        else:  # forward the client request to the peer incharge of req
+            self._send_data_to_peer(target_node, data, sendBackTo)
 
     def get_data(self, data, sendBackTo):
         """Retrieve V for given K from the database. data[0] must be the key"""
         if not data:
-            return "Error: key required"
+            return self._send_req_response_to_client(sendBackTo, "Error: key required")
 
         target_node = self.membership_ring.get_node_for_key(data[0])
         # if I can do it myself
@@ -341,6 +471,154 @@ class Node(object):
         else:  # forward the client request to the peer incharge of req
             self._request_data_from_peer(target_node, data[0], sendBackTo)
 
+    def handle_client_put(self, data, sendBackTo):
+        """clientPut from a client that routes by the ring, see smartclient.py"""
+        if not messages.valid_clock(data[2]):
+            self.client_list.add(sendBackTo)
+            self.broadcast_message([sendBackTo], messages.putResponse(data[0], INVALID_CONTEXT, None))
+        elif self._coordinates(data[0], sendBackTo):
+            self.start_request('put', data, sendBackTo=sendBackTo)
+
+    def handle_client_get(self, name, sendBackTo):
+        """clientGet from a client that routes by the ring, see smartclient.py"""
+        if self._coordinates(name, sendBackTo):
+            self.start_request('get', name, sendBackTo=sendBackTo)
+
+    def _coordinates(self, key, client):
+        """True if this node coordinates key, else the client is redirected to the coordinator"""
+        self.client_list.add(client)
+        coordinator = self.membership_ring.get_node_for_key(key)
+        if coordinator == self.hostname:
+            return True
+
+        self.broadcast_message([client], messages.redirect(key, coordinator))
+        return False
+
+    def _check_vnodes(self, vnodes):
+        """Refuse to start with a token count other than the one the stored data was placed with.
+
+        Changing it moves nearly every key to other hosts, so it is only done on an empty node.
+        Data from before the count was recorded was placed with one token per node.
+        """
+        try:
+            with open(self.vnodes_file, 'r') as f:
+                stored = int(f.read())
+        except FileNotFoundError:
+            stored = 1 if os.path.exists(self.db_path) else None
+
+        if stored is not None and stored != vnodes:
+            raise ValueError("%s holds data placed with --vnodes %d, not %d. Start with --vnodes %d, "
+                             "or move the data off this node and remove its files first"
+                             % (self.db_path, stored, vnodes, stored))
+        with open(self.vnodes_file, 'w') as f:
+            f.write('%d\n' % vnodes)
+
+    def handle_ring_request(self, data, sendBackTo):
+        """Send the membership ring and its hashing parameters to a client"""
+        ring = self.membership_ring
+        self.broadcast_message([sendBackTo], messages.ring(ring.vnode_count, ring.replica_count,
+                                                           sorted(ring.get_all_hosts())))
+
+    def mput_data(self, data, sendBackTo):
+        """Put several keys, data is <key> <prev version> <value> for each. Answers {key: value or error}."""
+        if not data or len(data) % 3:
+            return self._send_req_response_to_client(sendBackTo, "Error: Invalid operands\nInput: (<key> <prev version> <value>)...")
+
+        try:
+            items = [[data[i], data[i + 2], json.loads(data[i + 1])] for i in range(0, len(data), 3)]
+        except ValueError:
+            return self._send_req_response_to_client(sendBackTo, "Error: prev version must be JSON")
+        invalid = [item[0] for item in items if not messages.valid_clock(item[2])]
+        if invalid:
+            return self._send_req_response_to_client(sendBackTo, {key: INVALID_CONTEXT for key in invalid})
+        self._start_multi('put', items, lambda results: self._send_req_response_to_client(sendBackTo, results))
+
+    def mget_data(self, data, sendBackTo):
+        """Get several keys. Answers {key: versions or error}."""
+        if not data:
+            return self._send_req_response_to_client(sendBackTo, "Error: keys required")
+
+        self._start_multi('get', list(dict.fromkeys(data)), lambda results: self._send_req_response_to_client(sendBackTo, results))
+
+    def _start_multi(self, rtype, items, on_done):
+        """Split a multi-key request by coordinator: one mget/mput to each other
+        coordinator, the keys this node coordinates are started here.
+
+        A coordinator answers a sub-request within request_timelimit. If it
+        cannot be sent to or has not answered a little after that, the keys it
+        has no result for are coordinated here, the whole request gets another
+        request_timelimit for that."""
+        keys = [item[0] for item in items] if rtype == 'put' else items
+        multi = MultiRequest(keys, None)
+        multi.on_done = lambda results: self._finish_multi(multi, on_done, results)
+        multi.timer = self.scheduler.call_later(2 * self.request_timelimit + 1, multi.finish, "Error: timed out")
+
+        groups = {}
+        for (item, route) in zip(items, self.membership_ring.lookup_many(keys)):
+            groups.setdefault(route.coordinator, []).append(item)
+
+        mine = groups.pop(self.hostname, [])
+        for (coordinator, group) in groups.items():
+            multi_id = next(self._multi_ids)
+            msg = messages.mput(multi_id, group) if rtype == 'put' else messages.mget(multi_id, group)
+            if self.broadcast_message([coordinator], msg):
+                mine += group  # the coordinator is unreachable, coordinate its keys here
+            else:
+                self._multi[multi_id] = multi
+                timer = self.scheduler.call_later(self.request_timelimit + 0.5, self._multi_timed_out,
+                                                  rtype, multi, multi_id)
+                multi.sub_requests[multi_id] = (group, timer)
+
+        self._coordinate_multi(rtype, mine, multi.add)
+
+    def _multi_timed_out(self, rtype, multi, multi_id):
+        """A coordinator did not answer a sub-request, coordinate its keys here"""
+        self._multi.pop(multi_id, None)
+        group = multi.sub_requests.pop(multi_id)[0]
+        group = [item for item in group if (item[0] if rtype == 'put' else item) in multi.pending]
+        print("No answer to multi-key request %d, coordinating its %d keys here" % (multi_id, len(group)))
+        self._coordinate_multi(rtype, group, multi.add)
+
+    def _finish_multi(self, multi, on_done, results):
+        for (multi_id, (_, timer)) in multi.sub_requests.items():  # answers still on their way are dropped
+            self._multi.pop(multi_id, None)
+            timer.cancel()
+        multi.sub_requests.clear()
+        on_done(results)
+
+    def _coordinate_multi(self, rtype, items, add):
+        """Start a request per key, their results go to add(key, result). Puts share one commit
+        and all requests share the replica batches (see send_to_replicas)."""
+        for item in items:
+            self.start_request(rtype, item, None, callback=add, commit=False)
+        if rtype == 'put' and items:
+            self.db.commit()
+
+    def handle_mget(self, data, sender):
+        self._handle_multi('get', data, sender, messages.mgetResponse)
+
+    def handle_mput(self, data, sender):
+        self._handle_multi('put', data, sender, messages.mputResponse)
+
+    def _handle_multi(self, rtype, data, sender, response):
+        """Coordinate the keys of another node's multi-key request, answer with all their results at once"""
+        (multi_id, items) = data
+        keys = [item[0] for item in items] if rtype == 'put' else items
+        multi = MultiRequest(keys, lambda results: self.broadcast_message([sender], response(multi_id, results)))
+        multi.timer = self.scheduler.call_later(self.request_timelimit, multi.finish, "Error: timed out")
+        if rtype == 'put':
+            for item in [item for item in items if not messages.valid_clock(item[2])]:
+                items.remove(item)
+                multi.add(item[0], INVALID_CONTEXT)
+        self._coordinate_multi(rtype, items, multi.add)
+
+    def handle_multi_response(self, data, sender):
+        (multi_id, results) = data
+        multi = self._multi.pop(multi_id, None)
+        if multi is not None:
+            multi.sub_requests.pop(multi_id)[1].cancel()
+            multi.add_many(results)
+
     def _process_req_message(self, data, sender):
         # data = (view_id, req_id, operation, address)
         (view_id, req_id, operation, address) = data
@@ -349,7 +627,7 @@ class Node(object):
         # save the message type
         self._received_req_messages[(view_id, req_id)] = (address, operation)
         ok_message = messages.okMessage(view_id, req_id)
-        self.connections.get(sender, self._create_socket(sender)).sendall(ok_message)
+        self.broadcast_message([sender], ok_message)
 
     def _process_ok_message(self, data, sender):
         self._req_responses[data].add(sender)
@@ -368,6 +646,7 @@ class Node(object):
             # Send newViewMessage
             # self.current_view += 1
 
+            old_hosts = self.membership_ring.get_all_hosts()
             if operation == 1:   # adding new node
                 self.membership_ring.add_node(new_peer_hostname)
                 hosts_to_send = self.membership_ring.get_all_hosts()
@@ -377,6 +656,7 @@ class Node(object):
                 nodes_to_broadcast = self.membership_ring.get_all_hosts()
                 nodes_to_broadcast.remove(new_peer_hostname)
                 self.membership_ring.remove_node(new_peer_hostname)
+            self._ring_changed(old_hosts)
 
             membership_change_msg = messages.membershipChange(self.current_view, operation, hosts_to_send)
 
@@ -395,6 +675,7 @@ class Node(object):
         (view_id, operation, peers) = data
         # self.current_view = view_id
 
+        old_hosts = self.membership_ring.get_all_hosts()
         if operation == 1:  # add nodes
             for p in peers:
                 if p not in self.membership_ring:
@@ -404,6 +685,7 @@ class Node(object):
             for p in peers:
                 if p in self.membership_ring:
                     self.membership_ring.remove_node(p)
+        self._ring_changed(old_hosts)
 
         with open(self.ring_log_file, 'w') as f:
             for node in self.membership_ring.get_all_hosts():
@@ -411,7 +693,108 @@ class Node(object):
 
         print("Successfully modified membership ring. Total members: %d" % len(self.membership_ring.get_all_hosts()))
         print("Current members: %s" % ", ".join(self.membership_ring.get_all_hosts()))
-        print("Keys to manage: ", self.membership_ring.get_key_range(self.hostname))
+        load = self.membership_ring.load_report()[self.hostname]
+        print("Keys to manage: %.1f%% of the key space in %d ranges, %.1f%% with replicas" % (
+            load['owned'], load['tokens'], load['replicated']))
+
+    def _ring_changed(self, old_hosts):
+        """The ranges of the ring moved, recompute the Merkle trees and send
+        the keys that gained replicas to them"""
+        if self.merkle is not None:
+            self.merkle.rebuild(self.db.scan())
+
+        new_hosts = self.membership_ring.get_all_hosts()
+        if old_hosts and old_hosts != new_hosts:
+            self.rebalancer.start(old_hosts, new_hosts)
+
+    def handle_transfer(self, data, sender):
+        """Store a chunk of versions, acknowledge it once committed. Read repairs (transfer id 0) are not acknowledged."""
+        (transfer_id, seq, items) = data
+        for (key, versions) in items:
+            self.db.storeVersions(key, versions, commit=False)
+        if transfer_id:
+            self.db.commit(lambda: self.broadcast_message([sender], messages.transferAck(transfer_id, seq)))
+        else:
+            self.db.commit()
+
+    def handle_transfer_ack(self, data, sender):
+        if not self.handoffs.handle_ack(data[0], data[1], sender):
+            self.rebalancer.handle_ack(data[0], data[1], self._peer_identity(sender))
+
+    def anti_entropy(self):
+        """Send the root hash of every replicated range to a random other replica of the range"""
+        self.scheduler.call_later(self.anti_entropy_interval, self.anti_entropy)
+
+        for ((start, end), tree) in self.merkle.trees.items():
+            peers = [host for host in self.merkle.preference[(start, end)] if host != self.hostname]
+            if peers:
+                self.broadcast_message([random.choice(peers)], messages.merkleHashes(start, end, [0], tree.hashes[:1]))
+
+    def handle_merkle_hashes(self, data, sender):
+        """Compare a replica's tree nodes with ours. Send back the children of the
+        inner nodes that differ, and the digests of our keys in the leaves that differ."""
+        (start, end, indexes, hashes) = data
+        tree = self.merkle.trees.get((start, end)) if self.merkle is not None else None
+        if tree is None:  # the sender sees another ring
+            return
+
+        inner, leaves = tree.diff(indexes, hashes)
+        if inner:
+            children = [child for index in inner for child in tree.children(index)]
+            self.broadcast_message([sender], messages.merkleHashes(start, end, children,
+                                                                   [tree.hashes[child] for child in children]))
+        if leaves:
+            digests = tree.key_digests(leaves)
+            self.broadcast_message([sender], messages.merkleKeys(start, end, leaves, list(digests),
+                                                                 list(digests.values())))
+
+    def handle_merkle_keys(self, data, sender):
+        """Compare a replica's key digests of differing leaves with ours. Send it our
+        versions of the keys that differ, and ask for its versions of those it has."""
+        (start, end, leaves, keys, digests) = data
+        tree = self.merkle.trees.get((start, end)) if self.merkle is not None else None
+        if tree is None:
+            return
+
+        differ = tree.diff_keys(leaves, keys, digests)
+        mine = tree.key_digests(leaves)
+        items = [[key, self.db.getFile(key)] for key in differ if key in mine]
+        if items:
+            self.broadcast_message([sender], messages.merkleVersions(start, end, [], 0, items))
+        theirs = set(keys)
+        wanted = [key for key in differ if key in theirs]
+        if wanted:
+            self.broadcast_message([sender], messages.merkleWant(start, end, wanted))
+
+    def handle_merkle_want(self, data, sender):
+        """Send a replica our versions of the keys it asked for"""
+        (start, end, keys) = data
+        items = [[key, self.db.getFile(key)] for key in keys]
+        self.broadcast_message([sender], messages.merkleVersions(start, end, [], 0, items))
+
+    def handle_merkle_versions(self, data, sender):
+        """Store a replica's versions of differing leaves, and send ours back if asked"""
+        (start, end, leaves, reply, items) = data
+        for (key, versions) in items:
+            self.db.storeVersions(key, versions, commit=False)
+        self.db.commit()
+        if items:
+            print("Anti-entropy: %d keys from %s" % (len(items), sender))
+
+        tree = self.merkle.trees.get((start, end)) if self.merkle is not None else None
+        if reply and tree is not None:
+            # only the keys the sender does not have as we do
+            received = {key: self._version_set(versions) for (key, versions) in items}
+            mine = [item for item in self._leaf_versions(tree, leaves)
+                    if received.get(item[0]) != self._version_set(item[1])]
+            self.broadcast_message([sender], messages.merkleVersions(start, end, leaves, 0, mine))
+
+    def _leaf_versions(self, tree, leaves):
+        return [[key, self.db.getFile(key)] for leaf in leaves for key in tree.leaf_keys(leaf)]
+
+    @staticmethod
+    def _version_set(versions):
+        return {(json.dumps(clock, sort_keys=True), data) for (clock, data) in versions}
 
     def _req_timeout(self, req_id):
         print("Error adding node to network. One or more nodes is offline.")
@@ -423,7 +806,7 @@ class Node(object):
         self._membership_in_progress = False
 
     def _send_req_response_to_client(self, client, message):
-        msg = messages.responseForForward(message)
+        msg = messages.clientResponse(message)
         self.broadcast_message([client], msg)
 
     # request format:
@@ -431,10 +814,11 @@ class Node(object):
     # type
     # sendBackTo
     # forwardedTo =None if type is not for_*
+    # forward_id =None unless a peer forwarded the request to us
     # hash
     # value =None if type is get or forget
     # context =None if type is get or forget
-    # responses = { sender:msg, sender2:msg2... }
+    # responses = { sender:msg, sender2:msg2... }, for a for_* the forwarded result
 
     # args format is determined by type:
     #   type='get', args='hash'
@@ -445,106 +829,123 @@ class Node(object):
     # 'for_*' if for requests that must be handled by a different peer
     # then when the response is returned, complete_request will send the
     # output to the correct client or peer (or stdin)
-    def start_request(self, rtype, args, sendBackTo, prev_req=None):
+    # forward_id is the request id at the peer that forwarded the request, it gets the result
+    # callback(key, result) gets the result instead of sendBackTo, see MultiRequest
+    # commit=False leaves the coordinator's copy of a put to a later commit()
+    def start_request(self, rtype, args, sendBackTo, forward_id=None, callback=None, commit=True):
         print("%s request from %s: %s" % (rtype, sendBackTo, args))
-        req = Request(rtype, args, sendBackTo, previous_request=prev_req)  # create request obj
-        self.ongoing_requests.append(req)  # set as ongoing
+        req = Request(rtype, args, sendBackTo, forward_id=forward_id)  # create request obj
+        req.callback = callback
+        try:
+            self.ongoing_requests.add(req)  # set as ongoing
+        except RegistryFull as e:
+            print("Rejecting %s request: %s" % (rtype, e))
+            if callback is not None:
+                callback(req.hash, "Error: too many requests in flight")
+            elif sendBackTo in self.client_list:  # a forwarding peer falls back on its own timer
+                self._send_req_response_to_client(sendBackTo, "Error: too many requests in flight")
+            return
 
-        target_node = self.membership_ring.get_node_for_key(req.hash)
-        replica_nodes = self.membership_ring.get_replicas_for_key(req.hash)
+        route = self.membership_ring.lookup(req.hash)
+        target_node, replica_nodes = route.coordinator, route.replicas
+        if target_node != self.hostname and rtype in ('get', 'put'):
+            # coordinating for an unreachable node (multi-key requests): every other host of the preference list
+            replica_nodes = tuple(host for host in route.preference if host != self.hostname)
 
-        T = Timer(self.request_timelimit + (1 if rtype[:3] == 'for' else 0),
-                  self.complete_request, args=[req], kwargs={"timer_expired": True}
-                  )
-        T.start()
-        self.req_message_timers[req.time_created] = T
+        T = self.scheduler.call_later(self.request_timelimit + (1 if rtype[:3] == 'for' else 0),
+                                      self.complete_request, req, timer_expired=True)
+        self.req_message_timers[req.req_id] = T
 
         # Find out if you can respond to this request
         if rtype == 'get':
             # add my information to the request
             result = self.db.getFile(args)
-            my_resp = messages.getFileResponse(args, result, req.time_created)
+            my_resp = messages.getFileResponse(args, result, req.req_id)
             self.update_request(messages._unpack_message(my_resp)[1], socket.gethostbyname(self.hostname), req)
             # send the getFile message to everyone in the replication range
-            msg = messages.getFile(req.hash, req.time_created)
+            msg = messages.getFile(req.hash, req.req_id)
             # this function will need to handle hinted handoff
 
             print("Sending getFile message to %s" % ", ".join(replica_nodes))
-            fails = self.broadcast_message(replica_nodes, msg)
+            fails = self.send_to_replicas(replica_nodes, msg)
             if fails:
                 print("Failed to send get msg to %s" % ', '.join(fails))
 
         elif rtype == 'put':
-            self.db.storeFile(args[0], socket.gethostbyname(self.hostname), args[1], args[2])
-            my_resp = messages.storeFileResponse(args[0], args[1], args[2], req.time_created)
-            # add my information to the request
-            self.update_request(messages._unpack_message(my_resp)[1], socket.gethostbyname(self.hostname), req)
+            my_ip = socket.gethostbyname(self.hostname)
+            my_resp = messages.storeFileResponse(args[0], args[1], args[2], req.req_id)
+            # add my information to the request once my copy is committed
+            self.db.storeFile(args[0], my_ip, args[2], args[1], commit=commit,
+                              on_commit=lambda: self.update_request(messages._unpack_message(my_resp)[1], my_ip))
             # send the storeFile message to everyone in the replication range
-            msg = messages.storeFile(req.hash, req.value, req.context, req.time_created)
+            msg = messages.storeFile(req.hash, req.value, req.context, req.req_id)
             # this function will need to handle hinted handoff
             print("Sending storeFile message to %s" % ", ".join(replica_nodes))
-            fails = self.broadcast_message(replica_nodes, msg)
+            fails = self.send_to_replicas(replica_nodes, msg)
             if fails:
                 print("Failed to send put msg to %s" % ', '.join(fails))
 
         else:
-            msg = messages.forwardedReq(req)
+            # only what the coordinator needs to start the request, the result comes back under our req_id
+            msg = messages.forwardedReq(req.req_id, messages.FORWARD_OPERATIONS.index(rtype[4:]), req.hash,
+                                        req.value or '', req.context, req.time_created)
             # forward message to target node
             # self.connections[req.forwardedTo].sendall(msg)
             if self.broadcast_message([req.forwardedTo], msg):
-                self.leader_to_coord(req)
+                self.coordinate_forward(req)
             else:
                 print("Forwarded Request to %s" % req.forwardedTo)
 
-    def leader_to_coord(self, req):
-        print("Leader is assuming role of coordinator")
+    def coordinate_forward(self, req):
+        """The node a request was forwarded to did not answer, coordinate it here"""
+        print("Assuming role of coordinator for %s" % req.forwardedTo)
         replica_nodes = self.membership_ring.get_replicas_for_key(req.hash)
         req.type = req.type[4:]
 
         if req.type == 'get':
-            msg = messages.getFile(req.hash, req.time_created)
+            msg = messages.getFile(req.hash, req.req_id)
         else:
-            msg = messages.storeFile(req.hash, req.value, req.context, req.time_created)
+            msg = messages.storeFile(req.hash, req.value, req.context, req.req_id)
 
-        self.broadcast_message(replica_nodes, msg)
+        self.send_to_replicas(replica_nodes, msg)
 
-    def find_req_for_msg(self, req_ts):
-        return list(filter(
-            lambda r: r.time_created == req_ts, self.ongoing_requests
-        ))
+    def find_req_for_msg(self, req_id):
+        return self.ongoing_requests.get(req_id)
 
-    # after a \x70, \x80 or \x0B is encountered from a peer, this method is called
+    # after a \x70 or \x80 is encountered from a peer, this method is called
     def update_request(self, msg, sender, request=None):
         print("Updating Request with message ", msg, " from ", sender)
-        if isinstance(msg, tuple):
-            if not request:
-                request = self.find_req_for_msg(msg[-1])
-            min_num_resp = self.sloppy_R if len(msg) == 3 else self.sloppy_W
-        else:
-            request = self.find_req_for_msg(msg.previous_request.time_created)
-            min_num_resp = 1
+        if not request:
+            request = self.find_req_for_msg(msg[-1])
+        min_num_resp = self.sloppy_R if len(msg) == 3 else self.sloppy_W
 
         if not request:
             print("No request found, ", sender, " might have been too slow")
             return
-        elif isinstance(request, list):
-            request = request[0]
 
         request.responses[sender] = msg
         if len(request.responses) >= min_num_resp:
             self.complete_request(request)
 
+    def handle_forward_response(self, data, sender):
+        """The coordinator's result of a request we forwarded"""
+        (req_id, operation, result) = data
+        request = self.find_req_for_msg(req_id)
+        # a for_* we coordinated ourselves after a timeout has storeFile/getFile responses instead
+        if not request or request.type[:3] != 'for':
+            print("No forwarded request found, ", sender, " might have been too slow")
+            return
+
+        request.responses[sender] = result
+        self.complete_request(request)
+
     def coalesce_responses(self, request):
         resp_list = list(request.responses.values())
         # check if you got a sufficient number of responses
         if len(resp_list) < self.sloppy_R:
             return None
-        results = []
-        for resp in resp_list:
-            # print(resp)
-            results.extend([
-                tup for tup in resp[1] if tup not in results
-            ])
+        # versions of every replica, minus duplicates and versions another one descends from
+        results = vclock.frontier(version for resp in resp_list for version in resp[1])
         return self.db.sortData(results)
 
     def complete_request(self, request, timer_expired=False):
@@ -552,11 +953,11 @@ class Node(object):
         failed = False
 
         if request.type == 'get':
-            # if sendbackto is a peer
-            if request.sendBackTo not in self.client_list:
-                # this is a response to a for_*
-                # send the whole request object back to the peer
-                msg = messages.responseForForward(request)
+            if request.responded or request.callback is not None:
+                msg = None  # a late answer, only kept for read repair, or a key of a multi-key get
+            elif request.forward_id is not None:
+                # this is a response to a for_*, send back the coalesced result only
+                msg = messages.responseForForwardedReq(request.forward_id, 0, self.coalesce_responses(request))
             else:
                 # compile results from responses and send them to client
                 # send message to client
@@ -568,10 +969,12 @@ class Node(object):
             if len(request.responses) >= self.sloppy_W:
                 print("Successful put completed for ", request.sendBackTo)
 
-            if request.sendBackTo not in self.client_list:
-                # this is a response to a for_*
-                # send the whole request object back to the peer
-                msg = messages.responseForForward(request)
+            if request.callback is not None:
+                msg = None  # a key of a multi-key put
+            elif request.forward_id is not None:
+                # this is a response to a for_*, send back the stored value or "Error" only
+                msg = messages.responseForForwardedReq(request.forward_id, 1, (
+                    request.value if len(request.responses) >= self.sloppy_W else "Error"))
             else:
                 # send success message to client
                 # check if you were successful
@@ -581,115 +984,156 @@ class Node(object):
 
             # if len(request.responses) >= self.sloppy_W and timer_expired:
             if timer_expired and len(request.responses) < self.sloppy_Qsize:
-                target_node = self.membership_ring.get_node_for_key(request.hash)
-                replica_nodes = self.membership_ring.get_replicas_for_key(request.hash)
-
-                all_nodes = set([target_node] + replica_nodes)
+                all_nodes = self.membership_ring.get_preference_list(request.hash)
                 missing_reps = set([self.membership_ring.hostname_to_ip[r] for r in all_nodes]) - set(request.responses.keys())
+                if missing_reps:  # a ring smaller than Qsize has no more replicas
+                    handoff_store_msg = messages.storeFile(request.hash, request.value, request.context, request.req_id)
 
-                handoff_store_msg = messages.storeFile(request.hash, request.value, request.context, request.time_created)
-
-                handoff_msg = messages.handoff(
-                    handoff_store_msg,
-                    missing_reps
-                )
+                    handoff_msg = messages.handoff(
+                        handoff_store_msg,
+                        missing_reps
+                    )
 
-                hons = [
-                    self.membership_ring.get_handoff_node(r)
-                    for r in missing_reps
-                ]
+                    # the hosts after the preference list hold the hints, this node if there are not enough
+                    hons = self.membership_ring.get_handoff_nodes(request.hash, len(missing_reps))
+                    if len(hons) < len(missing_reps):
+                        hons.append(self.hostname)
 
-                print("Handing off messages for %s to %s" % (", ".join(missing_reps), ", ".join(hons)))
-                if self.hostname in hons:
-                    self.handle_handoff((handoff_store_msg, missing_reps), self.hostname)
-                    hons.remove(self.hostname)
-                self.broadcast_message(hons, handoff_msg)
+                    print("Handing off messages for %s to %s" % (", ".join(missing_reps), ", ".join(hons)))
+                    if self.hostname in hons:
+                        self.handle_handoff((handoff_store_msg, missing_reps), socket.gethostbyname(self.hostname))
+                        hons.remove(self.hostname)
+                    self.broadcast_message(hons, handoff_msg)
 
         else:  # request.type == for_*
-            # unpack the forwarded request object
+            # the result the coordinator sent back
             data = list(request.responses.values())
 
             if not data:
-                # del self.req_message_timers[request.time_created]
-                # request.time_created=time.time()
-                self.leader_to_coord(request)
-                T = Timer(self.request_timelimit,
-                          self.complete_request, args=[request], kwargs={"timer_expired": True}
-                          )
-                T.start()
-                self.req_message_timers[request.time_created] = T
+                self.coordinate_forward(request)
+                T = self.scheduler.call_later(self.request_timelimit, self.complete_request, request, timer_expired=True)
+                self.req_message_timers[request.req_id] = T
                 return
             else:
-                data = data[0]
-                # if sendbackto is a peer
-                if request.sendBackTo not in self.client_list:
-                    # unpickle the returned put request
-                    data.previous_request = data.previous_request.previous_request
-                    # send the response object you got back to the peer
-                    # from request.responses (it is the put or get they need)
-                    # if you need to, make req.prev_req = req.prev_req.prev_req
-                    # so it looks like you did the request yourself
-                    msg = messages.responseForForward(data)
-                elif request.type == 'for_put':
-                    msg = messages.putResponse(request.hash, (
-                        request.value if data and len(data.responses) >= self.sloppy_W and not failed else "Error"
-                    ), request.context)
+                # for_* requests are only started for clients
+                if request.type == 'for_put':
+                    msg = messages.putResponse(request.hash, data[0] if not failed else "Error", request.context)
                 else:  # for_get
-                    msg = messages.getResponse(request.hash, (
-                        self.coalesce_responses(data) if not failed else "Error"
-                    ))
+                    msg = messages.getResponse(request.hash, data[0] if not failed else "Error")
 
         # send msg to request.sendBackTo
         # if request.sendBackTo not in self.client_list:
-        if not request.responded:
+        if not request.responded and request.callback is not None:
+            if request.type == 'get':
+                result = self.coalesce_responses(request)
+            else:
+                result = request.value if len(request.responses) >= self.sloppy_W else None
+            request.callback(request.hash, "Error" if result is None else result)
+            request.responded = True
+        elif not request.responded:
             print("Sending response back to ", request.sendBackTo)
             self.broadcast_message([request.sendBackTo], msg)
             request.responded = True
 
-        if timer_expired:
-            # remove request from ongoing list
-            self.ongoing_requests = list(filter(
-                lambda r: r.time_created != request.time_created, self.ongoing_requests
-            ))
+        # Reclaim the request as soon as nothing more can come of it. Puts wait
+        # for every replica, the ones that did not answer get a hinted handoff.
+        # With read repair gets wait for every replica too, then the stale ones are repaired.
+        if request.type == 'get' and self.read_repair is not None:
+            done = timer_expired or len(request.responses) >= len(self.membership_ring.lookup(request.hash).preference)
+        else:
+            done = timer_expired or request.type != 'put' or len(request.responses) >= self.sloppy_Qsize
+
+        if done:
+            self.ongoing_requests.remove(request.req_id)
+            t = self.req_message_timers.pop(request.req_id, None)
+            if t and not timer_expired:
+                t.cancel()
+
+            if request.type == 'get' and self.read_repair is not None:
+                self.read_repair.check(request.hash, {host: resp[1] for (host, resp) in request.responses.items()})
 
     def perform_operation(self, data, sendBackTo):
+        msg = self._perform_operation(data, sendBackTo)
+        if len(data) == 2:
+            self.broadcast_message([sendBackTo], msg)
+        else:  # ack a store once it is committed
+            self.db.commit(lambda: self.broadcast_message([sendBackTo], msg))
+
+    def _perform_operation(self, data, sendBackTo):
+        """Apply a storeFile or getFile message and return the response frame. Stores are left uncommitted."""
         if len(data) == 2:  # this is a getFile msg
             print("%s is asking me to get %s" % (sendBackTo, data[0]))
-            msg = messages.getFileResponse(data[0], self.db.getFile(data[0]), data[1])
-        else:  # this is a storeFile
-            print("%s is asking me to store %s" % (sendBackTo, data[0]))
-            self.db.storeFile(data[0], sendBackTo, data[1], data[2])
-            msg = messages.storeFileResponse(*data)
-
-        self.broadcast_message([sendBackTo], msg)
-
-    def handle_forwarded_req(self, prev_req, sendBackTo):
-        target_node = self.membership_ring.get_node_for_key(prev_req.hash)
-        print("Handling a forwarded request [ %s, %f ]" % (prev_req.type, prev_req.time_created))
-
-        if time.time() - prev_req.time_created < self.request_timelimit:
-            # someone forwarded you a put request
-            # if you are the leader, check if you can takecare of it, else,
-            # start a new put request with this request as the previous one
-            if prev_req.type == 'put' or prev_req.type == 'for_put':
-                if self.is_leader:
-                    if target_node == self.hostname:
-                        args = (prev_req.hash, prev_req.value, prev_req.context)
-                        self.start_request('put', args, sendBackTo, prev_req=prev_req)
-                    else:
-                        args = (target_node, prev_req.hash,
-                                prev_req.value, prev_req.context
-                                )
-                        self.start_request('for_put', args, sendBackTo, prev_req)
-
-                else:  # the leader is forwarding you a put
-                    args = (prev_req.hash, prev_req.value, prev_req.context)
-                    self.start_request('put', args, sendBackTo, prev_req=prev_req)
-
-            # someone forwarded you a get request, you need to take care of it
-            # start new get request with this as the previous one
-            else:  # type is get or for_get
-                self.start_request('get', prev_req.hash, sendBackTo, prev_req)
+            return messages.getFileResponse(data[0], self.db.getFile(data[0]), data[1])
+
+        # this is a storeFile
+        print("%s is asking me to store %s" % (sendBackTo, data[0]))
+        self.db.storeFile(data[0], sendBackTo, data[2], data[1], commit=False)
+        return messages.storeFileResponse(*data)
+
+    def perform_batch(self, frames, sendBackTo):
+        """Apply a batch of storeFile/getFile frames in one transaction and ack them with one frame"""
+        responses = []
+        operations = [messages._unpack_message(frame) for frame in frames]
+        if any(message_type not in (b'\x07', b'\x08') for (message_type, _) in operations):
+            raise messages.ProtocolError("A batch holds storeFile and getFile frames only")
+        for (_, data) in operations:
+            responses.append(self._perform_operation(data, sendBackTo))
+
+        msg = messages.batchResponse(responses)
+        self.db.commit(lambda: self.broadcast_message([sendBackTo], msg))
+
+    def handle_batch_response(self, frames, sender):
+        if any(frame[0:1] not in (b'\x70', b'\x80') for frame in frames):
+            raise messages.ProtocolError("A batch response holds storeFile and getFile responses only")
+        for frame in frames:
+            self._process_message(frame, sender)
+
+    def send_to_replicas(self, nodes, msg):
+        """Queue a storeFile/getFile frame for each node, frames to the same node go out as one batch.
+        Returns the nodes the frame could not be queued for."""
+        if not self.batch_window:
+            return self.broadcast_message(nodes, msg)
+
+        fails = []
+        for node in nodes:
+            batch = self._batches.setdefault(node, [])
+            batch.append(msg)
+            if len(batch) >= self.batch_size:
+                fails += self._flush_batch(node)
+
+        if self._batches and self._batch_timer is None:
+            self._batch_timer = self.scheduler.call_later(self.batch_window, self._flush_batches)
+
+        return fails
+
+    def _flush_batch(self, node):
+        frames = self._batches.pop(node)
+        msg = frames[0] if len(frames) == 1 else messages.batch(frames)
+        return self.broadcast_message([node], msg)
+
+    def _flush_batches(self):
+        self._batch_timer = None
+        for node in list(self._batches):
+            self._flush_batch(node)
+
+    def handle_forwarded_req(self, data, sendBackTo):
+        (forward_id, operation, name, value, context, time_created) = data
+        rtype = messages.FORWARD_OPERATIONS[operation]
+        print("Handling a forwarded request [ %s, %d ]" % (rtype, forward_id))
+
+        if rtype == 'put' and not messages.valid_clock(context):
+            self.broadcast_message([sendBackTo], messages.responseForForwardedReq(forward_id, operation, INVALID_CONTEXT))
+            return
+
+        # the forwarding node coordinates the request itself once its timer expires
+        if time.time() - time_created < self.request_timelimit:
+            # someone forwarded you a put or get request, you need to take care of it
+            # start a new request, its result goes back under the forwarder's request id
+            if rtype == 'put':
+                self.start_request('put', (name, value, context), sendBackTo, forward_id=forward_id)
+
+            else:
+                self.start_request('get', name, sendBackTo, forward_id=forward_id)
 
     def _send_data_to_peer(self, target_node, data, sendBackTo):
         # create for_put request
@@ -698,30 +1142,8 @@ class Node(object):
     def _request_data_from_peer(self, target_node, data, sendBackTo):
         self.start_request('for_get', (target_node, data), sendBackTo=sendBackTo)
 
-    def _create_socket(self, hostname):
-        """Creates a socket to the host and adds it connections dict. Returns created socket object."""
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setblocking(False)
-        s.settimeout(1)  # 10 seconds
-        try:
-            s.connect((hostname, self.tcp_port))
-            self.connections[socket.gethostbyname(hostname)] = s
-            return s
-        except Exception as e:
-            if hostname not in self.client_list:
-                print("Error creating connection to %s: %s" % (hostname, e))
-            return None
-
     # this is where we need to handle hinted handoff if a
     # peer is not responsive by asking another peer to hold the
     # message until the correct node recovers
     def broadcast_message(self, nodes, msg):
-        fails = []
-        for node in nodes:
-            c = self.connections.get(node, self._create_socket(node))
-            if not c:
-                fails.append(node)
-                continue
-            c.sendall(msg)
-
-        return fails
+        return [node for node in nodes if not self.pool.send(node, msg)]
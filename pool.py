@@ -0,0 +1,417 @@
+import asyncio
+import queue
+import socket
+import threading
+import time
+from collections import defaultdict, deque
+
+
+class PeerStats(object):
+
+    def __init__(self):
+        self.connects = 0
+        self.sends = 0
+        self.errors = 0
+
+        # consecutive failed connects, drives the reconnect backoff
+        self.failures = 0
+        self.retry_at = 0
+
+    def as_dict(self):
+        return {'connects': self.connects, 'sends': self.sends, 'errors': self.errors}
+
+
+class Connection(object):
+
+    def __init__(self, transport, peername, outbound=False):
+        """Wrap an open connection.
+
+        :param transport: socket in select mode, StreamWriter in asyncio mode
+        :param peername: (ip, port) of the remote end
+        :param outbound: True if we opened the connection
+        """
+        self.transport = transport
+        self.peername = peername
+        self.client_id = '%s:%d' % peername[:2]  # identifies a single client connection
+        self.outbound = outbound
+        self.identity = None  # node identity, set once the connection is used for a peer
+        self.read_buffer = bytearray()
+        self.dead = False
+        self.pending = None  # replies waiting to be written to a client
+        self.writing = False  # select mode: the connection is with a client writer thread
+
+
+class ConnectionPool(object):
+    """Connections to peers and clients, keyed by node identity.
+
+    A connection is only opened when there is no live connection for the peer,
+    inbound connections from peers are reused for replies. Failed connects
+    are retried with exponential backoff instead of on every send.
+
+    Every peer has its own outbound queue drained by a writer thread, so send()
+    never blocks and a dead or slow peer only delays its own messages. Replies
+    to a client wait in a queue of its connection, a fixed set of client writer
+    threads takes turns on the connections with replies waiting.
+    """
+
+    def __init__(self, port, identify, source_ip=None, connect_timeout=1.0, send_timeout=5.0,
+                 backoff_base=0.5, backoff_max=30.0, queue_size=10000, client_writers=4):
+        """
+        :param port: TCP port of the peers
+        :param identify: maps a hostname or IP to the identity of the node
+        :param source_ip: outbound connections are bound to it, so peers see the IP we listen on
+        :param queue_size: max messages waiting for a single peer or client, more are dropped
+        :param client_writers: threads writing replies to clients, a client that stopped
+            reading holds one of them for up to send_timeout
+        """
+        self.port = port
+        self.identify = identify
+        self.source_ip = source_ip
+        self.connect_timeout = connect_timeout
+        self.send_timeout = send_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.queue_size = queue_size
+
+        self._peers = {}  # identity : Connection
+        self._clients = {}  # client_id : Connection, every open connection is in here
+        self._by_transport = {}  # socket or StreamWriter : Connection
+        self._queues = {}  # identity : outbound queue of the peer
+        self._lock = threading.Lock()
+
+        self.client_writers = client_writers
+        self._ready = None  # client connections with replies waiting, for the client writer threads
+
+        self.stats = defaultdict(PeerStats)
+
+        # Written to when a writer opens a connection, so the select loop picks it up
+        self.wakeup_socket, self._wakeup_writer = socket.socketpair()
+        self.wakeup_socket.setblocking(False)
+
+    def add(self, transport, peername, outbound=False):
+        conn = Connection(transport, peername, outbound)
+        with self._lock:
+            self._clients[conn.client_id] = conn
+            self._by_transport[transport] = conn
+        return conn
+
+    def adopt(self, conn):
+        """Use conn for messages to the peer on the other end, unless there already is a connection."""
+        if conn.identity is not None:
+            return
+
+        identity = self.identify(conn.peername[0])
+        with self._lock:
+            current = self._peers.get(identity)
+            if current is None or current.dead:
+                self._peers[identity] = conn
+                conn.identity = identity
+
+    def remove(self, conn):
+        """Evict a dead connection and close it."""
+        with self._lock:
+            conn.dead = True
+            self._clients.pop(conn.client_id, None)
+            self._by_transport.pop(conn.transport, None)
+            if conn.identity is not None and self._peers.get(conn.identity) is conn:
+                del self._peers[conn.identity]
+
+        self._drop_replies(conn)
+
+        try:
+            conn.transport.close()
+        except Exception:
+            pass
+
+    def get(self, transport):
+        return self._by_transport.get(transport)
+
+    def connections(self):
+        with self._lock:
+            return list(self._clients.values())
+
+    def report(self):
+        """Per-peer connect, send and error counts."""
+        report = {}
+        for (identity, s) in list(self.stats.items()):
+            report[identity] = s.as_dict()
+            if identity in self._queues:
+                report[identity]['queued'] = self._queues[identity].qsize()
+        return report
+
+    def _lookup(self, name):
+        if name is None:
+            return None, None
+
+        if ':' in name:  # a client connection, these are never opened by us
+            return None, self._clients.get(name)
+
+        identity = self.identify(name)
+        conn = self._peers.get(identity)
+        return identity, (conn if conn is not None and not conn.dead else None)
+
+    def _backing_off(self, stats):
+        return time.time() < stats.retry_at
+
+    def _connect_failed(self, identity, stats, error):
+        stats.errors += 1
+        stats.failures += 1
+        stats.retry_at = time.time() + min(self.backoff_base * 2 ** (stats.failures - 1), self.backoff_max)
+        print("Error creating connection to %s: %s" % (identity, error))
+
+    def _connected(self, identity, stats, transport, peername):
+        stats.connects += 1
+        stats.failures = 0
+        stats.retry_at = 0
+
+        conn = self.add(transport, peername, outbound=True)
+        conn.identity = identity
+        with self._lock:
+            self._peers[identity] = conn
+        return conn
+
+    def _connect(self, identity):
+        stats = self.stats[identity]
+        if self._backing_off(stats):
+            return None
+
+        source = (self.source_ip, 0) if self.source_ip else None
+        try:
+            s = socket.create_connection((identity, self.port), self.connect_timeout, source)
+        except Exception as e:
+            self._connect_failed(identity, stats, e)
+            return None
+
+        s.settimeout(self.send_timeout)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # as asyncio does, frames are not held back by Nagle
+        conn = self._connected(identity, stats, s, s.getpeername())
+        self._wakeup_writer.send(b'\x00')
+        return conn
+
+    def send(self, name, msg):
+        """Queue msg for a node (hostname or IP), or send it to a client (client_id).
+
+        Returns False if the message was dropped: the client is gone, the peer
+        is backing off after failed connects or its queue is full.
+        """
+        identity, conn = self._lookup(name)
+        if identity is None:
+            return conn is not None and self._send_to_client(conn, msg)
+
+        stats = self.stats[identity]
+        if self._backing_off(stats):
+            return False
+
+        return self._enqueue(identity, stats, msg)
+
+    def _send_to_client(self, conn, msg):
+        with self._lock:
+            if conn.dead:
+                return False
+
+            if conn.pending is None:
+                conn.pending = deque()
+            if len(conn.pending) >= self.queue_size:  # the client stopped reading
+                self.stats['clients'].errors += 1
+                return False
+            conn.pending.append(msg)
+
+            if conn.writing:
+                return True
+            conn.writing = True
+
+            if self._ready is None:
+                self._ready = queue.Queue()
+                for _ in range(self.client_writers):
+                    threading.Thread(target=self._client_write_loop, name='client writer', daemon=True).start()
+
+        self._ready.put(conn)
+        return True
+
+    def _drop_replies(self, conn):
+        with self._lock:
+            if conn.pending is not None:
+                self.stats['clients'].errors += len(conn.pending)
+                conn.pending.clear()
+
+    def _client_write_loop(self):
+        """Client writer thread. Writes the replies waiting for a connection in one go, then
+        puts the connection back in line if more came in meanwhile."""
+        stats = self.stats['clients']
+        while True:
+            conn = self._ready.get()
+            with self._lock:
+                msgs = list(conn.pending)
+                conn.pending.clear()
+                if conn.dead or not msgs:
+                    conn.writing = False
+                    continue
+
+            try:
+                conn.transport.sendall(b''.join(msgs))
+            except Exception as e:
+                print("Error sending to %s: %s" % (conn.client_id, e))
+                stats.errors += len(msgs)
+                self._shutdown(conn)
+                self._drop_replies(conn)
+            else:
+                stats.sends += len(msgs)
+
+            self._ready.put(conn)
+
+    def _shutdown(self, conn):
+        """Mark conn as dead. The select loop evicts it once it reads EOF."""
+        conn.dead = True
+        try:
+            conn.transport.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+
+    def _enqueue(self, identity, stats, msg):
+        q = self._queues.get(identity)
+        if q is None:
+            q = self._queues[identity] = queue.Queue(self.queue_size)
+            threading.Thread(target=self._write_loop, args=(identity, q), daemon=True).start()
+
+        try:
+            q.put_nowait(msg)
+        except queue.Full:
+            stats.errors += 1
+            return False
+        return True
+
+    def _drop_queued(self, stats, q):
+        while True:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                return
+            stats.errors += 1
+
+    def _write_loop(self, identity, q):
+        """Writer thread of a single peer."""
+        stats = self.stats[identity]
+        while True:
+            msg = q.get()
+
+            conn = self._lookup(identity)[1] or self._connect(identity)
+            if conn is None:  # peer is down, drop what is queued for it
+                stats.errors += 1
+                self._drop_queued(stats, q)
+                continue
+
+            try:
+                conn.transport.sendall(msg)
+            except Exception as e:
+                print("Error sending to %s: %s" % (identity, e))
+                stats.errors += 1
+                self._shutdown(conn)
+                continue
+
+            stats.sends += 1
+
+
+class AsyncConnectionPool(ConnectionPool):
+    """ConnectionPool for asyncio mode. Every peer has a writer task instead of a thread,
+    connects don't block the loop and writes to a slow peer only wait on its own drain()."""
+
+    def __init__(self, serve, *args, **kwargs):
+        """:param serve: coroutine function run with (reader, conn) for every connection we open"""
+        super(AsyncConnectionPool, self).__init__(*args, **kwargs)
+        self.serve = serve
+
+    async def _open(self, identity, stats):
+        source = (self.source_ip, 0) if self.source_ip else None
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(identity, self.port, local_addr=source), self.connect_timeout)
+        except Exception as e:
+            self._connect_failed(identity, stats, e)
+            return None
+
+        conn = self._connected(identity, stats, writer, writer.get_extra_info('peername'))
+        asyncio.ensure_future(self.serve(reader, conn))
+        return conn
+
+    def _send_to_client(self, conn, msg):
+        if conn.dead or conn.transport.is_closing():
+            return False
+
+        if conn.pending is None:
+            conn.pending = asyncio.Queue(self.queue_size)
+            asyncio.ensure_future(self._client_write_loop(conn))
+
+        try:
+            conn.pending.put_nowait(msg)
+        except asyncio.QueueFull:  # the client stopped reading
+            self.stats['clients'].errors += 1
+            return False
+        return True
+
+    def _drop_replies(self, conn):
+        if conn.pending is not None:
+            self._drop_queued(self.stats['clients'], conn.pending)
+            conn.pending.put_nowait(None)  # ends the writer task
+
+    async def _client_write_loop(self, conn):
+        """Writer task of a single client connection, ends once the connection is removed."""
+        stats = self.stats['clients']
+        while True:
+            msg = await conn.pending.get()
+            if msg is None or conn.dead:
+                return
+
+            try:
+                conn.transport.write(msg)
+                await conn.transport.drain()
+            except Exception as e:
+                print("Error sending to %s: %s" % (conn.client_id, e))
+                stats.errors += 1
+                self.remove(conn)
+                return
+
+            stats.sends += 1
+
+    def _enqueue(self, identity, stats, msg):
+        q = self._queues.get(identity)
+        if q is None:
+            q = self._queues[identity] = asyncio.Queue(self.queue_size)
+            asyncio.ensure_future(self._write_loop(identity, q))
+
+        try:
+            q.put_nowait(msg)
+        except asyncio.QueueFull:
+            stats.errors += 1
+            return False
+        return True
+
+    def _drop_queued(self, stats, q):
+        while not q.empty():
+            q.get_nowait()
+            stats.errors += 1
+
+    async def _write_loop(self, identity, q):
+        """Writer task of a single peer."""
+        stats = self.stats[identity]
+        while True:
+            msg = await q.get()
+
+            conn = self._lookup(identity)[1]
+            if conn is None or conn.transport.is_closing():
+                conn = None if self._backing_off(stats) else await self._open(identity, stats)
+
+            if conn is None:  # peer is down, drop what is queued for it
+                stats.errors += 1
+                self._drop_queued(stats, q)
+                continue
+
+            try:
+                conn.transport.write(msg)
+                await conn.transport.drain()
+            except Exception as e:
+                print("Error sending to %s: %s" % (identity, e))
+                stats.errors += 1
+                self.remove(conn)
+                continue
+
+            stats.sends += 1
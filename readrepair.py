@@ -0,0 +1,96 @@
+"""Read repair.
+
+When a get has the answers of every replica (or its timer expired), the
+coordinator compares what each replica returned with the frontier of all the
+answers. A replica that is missing a frontier version gets it, sent as a 0x05
+transfer message with transfer id 0, which is not acknowledged. Versions are
+compared by clock only: two replicas with different values under the same
+clock would otherwise swap them on every read.
+
+Repairs wait in a bounded queue and are sent every interval seconds, at most
+rows_per_sec versions per second: a flush sends rows_per_sec * interval
+versions, splitting a repair of more versions over several flushes. Repairs
+that do not fit in the queue are dropped, anti-entropy catches up with them.
+"""
+import json
+from collections import deque
+
+import messages
+import vclock
+
+
+class ReadRepair(object):
+
+    def __init__(self, scheduler, send, store_local, local_host, rows_per_sec=1000, max_queued=10000, interval=0.1):
+        """
+        :param send: send(hosts, frame), returns the hosts it failed to send to
+        :param store_local: store_local(key, versions), repairs this node's own copy
+        :param local_host: the name this node's answers are recorded under
+        """
+        self.scheduler = scheduler
+        self.send = send
+        self.store_local = store_local
+        self.local_host = local_host
+        self.rows_per_sec = rows_per_sec
+        self.interval = max(interval, 1.0 / rows_per_sec)  # at least one version per flush
+
+        self._queue = deque(maxlen=max_queued)  # (host, key, versions)
+        self._timer = None
+
+        self.repaired = 0
+        self.dropped = 0
+        self._recent = deque()  # (time, rows) of the flushes of the last second
+
+    def check(self, key, responses):
+        """Queue repairs for the replicas whose answer misses frontier versions.
+        responses maps each replica to the versions it returned."""
+        frontier = vclock.frontier(version for versions in responses.values() for version in versions)
+        for (host, versions) in responses.items():
+            clocks = set(json.dumps(clock, sort_keys=True) for (clock, _) in versions)
+            missing = [version for version in frontier if json.dumps(version[0], sort_keys=True) not in clocks]
+            if missing:
+                if len(self._queue) == self._queue.maxlen:
+                    self.dropped += 1
+                self._queue.append((host, key, missing))
+
+        if self._queue and self._timer is None:
+            self._timer = self.scheduler.call_later(self.interval, self._flush)
+
+    def _flush(self):
+        self._timer = None
+        batches = {}  # host : [key, versions] items
+        budget = max(1, int(self.rows_per_sec * self.interval))
+        while self._queue and budget > 0:
+            (host, key, versions) = self._queue[0]
+            if len(versions) > budget:  # the rest goes with the next flush
+                self._queue[0] = (host, key, versions[budget:])
+                versions = versions[:budget]
+            else:
+                self._queue.popleft()
+            budget -= len(versions)
+            batches.setdefault(host, []).append([key, versions])
+
+        rows = 0
+        for (host, items) in batches.items():
+            if host == self.local_host:
+                for (key, versions) in items:
+                    self.store_local(key, versions)
+            elif self.send([host], messages.transfer(0, 0, items)):
+                continue
+            rows += sum(len(versions) for (_, versions) in items)
+
+        self._count(rows)
+        if self._queue:
+            self._timer = self.scheduler.call_later(self.interval, self._flush)
+
+    def _count(self, rows):
+        self.repaired += rows
+        if rows:
+            self._recent.append((self.scheduler.clock(), rows))
+
+    def stats(self):
+        """Rows repaired in total and over the last second"""
+        while self._recent and self._recent[0][0] < self.scheduler.clock() - 1.0:
+            self._recent.popleft()
+        return {'repaired': self.repaired, 'rows_per_sec': sum(rows for (_, rows) in self._recent),
+                'queued': len(self._queue), 'dropped': self.dropped}
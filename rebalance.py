@@ -0,0 +1,218 @@
+"""Moving data to the hosts that gain ranges when membership changes.
+
+When the ring changes, every stored key whose preference list gained hosts
+is sent to them. Of the hosts that held the key before the change and are
+still members, the first in the old preference list sends it, so every key
+is sent once even if its coordinator was removed.
+
+The keys to move are collected with one scan of the storage engine, walked
+scan_batch versions at a time from the scheduler so requests are served in
+between. Their versions are read and sent a chunk at a time (up to chunk_bytes of values,
+0x05 transfer messages), and the next chunk only goes out once every target
+acknowledged the last one after committing it. Chunks are spaced so the
+transfer stays under bytes_per_sec, the node serves requests in between.
+
+Progress (the ring before and after the change and the last acknowledged key)
+is kept in a JSON file, a restarted node resumes after the last acknowledged
+key. Keys stay on the hosts that lose them, anti-entropy and reads ignore them.
+"""
+import itertools
+import json
+import os
+import time
+
+import messages
+from ring import Ring
+
+
+class Rebalancer(object):
+
+    def __init__(self, db, scheduler, send, hostname, vnode_count, replica_count, progress_path,
+                 chunk_bytes=256 << 10, bytes_per_sec=4 << 20, ack_timeout=5.0, max_attempts=3, scan_batch=5000):
+        """
+        :param send: send(hosts, frame), returns the hosts it failed to send to
+        :param scan_batch: versions looked at per step of the scan
+        :param ack_timeout: seconds to wait for the acknowledgements of a chunk before sending it again
+        :param max_attempts: sends of a chunk before the hosts that did not acknowledge it are skipped
+        """
+        self.db = db
+        self.scheduler = scheduler
+        self.send = send
+        self.hostname = hostname
+        self.vnode_count = vnode_count
+        self.replica_count = replica_count
+        self.progress_path = progress_path
+        self.chunk_bytes = chunk_bytes
+        self.bytes_per_sec = bytes_per_sec
+        self.ack_timeout = ack_timeout
+        self.max_attempts = max_attempts
+        self.scan_batch = scan_batch
+
+        self.progress = None  # {'id', 'old', 'new', 'after'} of the running transfer
+        self._scanning = None  # while the plan is made: (versions left to scan, old ring, new ring, key : plan item)
+        self._plan = []  # [key, size, targets] left to send, sorted by key
+        self._chunk = None  # [plan items, size, hosts waiting to acknowledge, attempts] in flight
+        self._seq = 0
+        self._timer = None
+
+        self.sent_bytes = 0
+        self.remaining_bytes = 0
+        self._started = None
+
+    def start(self, old_hosts, new_hosts):
+        """Start moving data for a ring change from old_hosts to new_hosts"""
+        if self.progress is not None:
+            # a change during a transfer, move everything from the first ring to the latest
+            old_hosts = self.progress['old']
+
+        self._begin({'id': int(time.time() * 1000), 'old': sorted(old_hosts), 'new': sorted(new_hosts),
+                     'after': None})
+
+    def resume(self):
+        """Continue the transfer of a previous run, if any"""
+        try:
+            with open(self.progress_path, 'r') as f:
+                progress = json.load(f)
+        except FileNotFoundError:
+            return
+
+        print("Resuming rebalancing after key %r" % progress['after'])
+        self._begin(progress)
+
+    def _ring(self, hosts):
+        ring = Ring(vnode_count=self.vnode_count, replica_count=self.replica_count)
+        for host in hosts:
+            ring[host] = host
+        return ring
+
+    def _begin(self, progress):
+        if self._timer is not None:
+            self._timer.cancel()
+        self.progress = progress
+        self._chunk = None
+        self._plan = []
+        self.remaining_bytes = self.sent_bytes = 0
+        self._started = time.monotonic()
+
+        self._scanning = (iter(self.db.scan_versions()), self._ring(progress['old']), self._ring(progress['new']), {})
+        self._timer = self.scheduler.call_later(0, self._scan_step)
+
+    def _scan_step(self):
+        """Add the next scan_batch versions to the plan, start sending once all are in"""
+        (versions, old_ring, new_ring, items) = self._scanning
+        after, members = self.progress['after'], set(self.progress['new'])
+        taken = 0
+        for (key, _, size) in itertools.islice(versions, self.scan_batch):
+            taken += 1
+            if key in items:
+                if items[key] is not None:
+                    items[key][1] += size
+                continue
+            items[key] = None
+            if after is not None and key <= after:
+                continue
+
+            old = old_ring.lookup(key).preference
+            senders = [host for host in old if host in members]
+            if not senders or senders[0] != self.hostname:
+                continue
+
+            targets = [host for host in new_ring.lookup(key).preference if host not in old]
+            if targets:
+                items[key] = [key, size, targets]
+
+        if taken == self.scan_batch:
+            self._timer = self.scheduler.call_later(0, self._scan_step)
+            return
+
+        self._scanning = None
+        self._plan = sorted((item for item in items.values() if item is not None), key=lambda item: item[0])
+        self.remaining_bytes = sum(item[1] for item in self._plan)
+        if not self._plan:
+            self._finish()
+            return
+
+        print("Rebalancing: %d keys, %d bytes to move" % (len(self._plan), self.remaining_bytes))
+        self._save()
+        self._send_chunk()
+
+    def _save(self):
+        with open(self.progress_path, 'w') as f:
+            json.dump(self.progress, f)
+
+    def _send_chunk(self):
+        self._timer = None
+        if not self._plan:
+            self._finish()
+            return
+
+        if self._chunk is None:
+            count, size = 0, 0
+            while count < len(self._plan) and (not count or size + self._plan[count][1] <= self.chunk_bytes):
+                size += self._plan[count][1]
+                count += 1
+
+            self._seq += 1
+            hosts = set(host for item in self._plan[:count] for host in item[2])
+            self._chunk = [count, size, hosts, 0]
+
+        count, size, hosts, attempts = self._chunk
+        if attempts >= self.max_attempts:
+            print("Rebalancing: no acknowledgement from %s, skipping them" % ", ".join(sorted(hosts)))
+            hosts.clear()
+            self._acked()
+            return
+        self._chunk[3] += 1
+
+        for host in hosts:
+            items = [[key, self.db.getFile(key)] for (key, _, targets) in self._plan[:count] if host in targets]
+            self.send([host], messages.transfer(self.progress['id'], self._seq, items))
+
+        self._timer = self.scheduler.call_later(self.ack_timeout, self._send_chunk)
+
+    def handle_ack(self, transfer_id, seq, host):
+        """A host committed chunk seq of transfer transfer_id"""
+        if self.progress is None or transfer_id != self.progress['id'] or seq != self._seq or self._chunk is None:
+            return
+
+        self._chunk[2].discard(host)
+        if not self._chunk[2]:
+            self._timer.cancel()
+            self._acked()
+
+    def _acked(self):
+        count, size = self._chunk[0], self._chunk[1]
+        self.progress['after'] = self._plan[count - 1][0]
+        del self._plan[:count]
+        self._chunk = None
+        self._save()
+
+        self.sent_bytes += size
+        self.remaining_bytes -= size
+        stats = self.stats()
+        print("Rebalancing: %.1f KB/s, %d bytes in %d keys left" % (
+            stats['bytes_per_sec'] / 1024.0, stats['remaining_bytes'], stats['remaining_keys']))
+
+        # keep the average rate under bytes_per_sec
+        delay = self.sent_bytes / float(self.bytes_per_sec) - (time.monotonic() - self._started)
+        self._timer = self.scheduler.call_later(max(delay, 0), self._send_chunk)
+
+    def _finish(self):
+        self._scanning = None
+        if self.sent_bytes:
+            print("Rebalancing done, moved %d bytes in %.1fs" % (self.sent_bytes, time.monotonic() - self._started))
+        self.progress = None
+        self._plan = []
+        try:
+            os.remove(self.progress_path)
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        if self.progress is None:
+            return None
+
+        elapsed = time.monotonic() - self._started
+        return {'sent_bytes': self.sent_bytes, 'remaining_bytes': self.remaining_bytes,
+                'remaining_keys': len(self._plan),
+                'bytes_per_sec': self.sent_bytes / elapsed if elapsed > 0 else 0.0}
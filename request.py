@@ -1,17 +1,24 @@
+import itertools
 import time
 
 
 class Request(object):
+    """An ongoing get or put, or one forwarded to the key's coordinator (for_get/for_put)"""
 
-    def __init__(self, rtype, args, sendBackTo, previous_request=None):
+    __slots__ = ('time_created', 'req_id', 'type', 'sendBackTo', 'forward_id', 'responses', 'responded',
+                 'callback', 'forwardedTo', 'hash', 'value', 'context')
 
-        # timestamp the request, need this to reference it later
+    def __init__(self, rtype, args, sendBackTo, forward_id=None):
+
+        # timestamp the request, used to drop stale forwarded requests
         self.time_created = time.time()
+        self.req_id = None  # assigned by RequestRegistry.add, need this to reference it later
         self.type = rtype
         self.sendBackTo = sendBackTo
+        self.forward_id = forward_id  # id of the request at the node that forwarded it to us, gets the result
         self.responses = {}
-        self.previous_request = previous_request
-        self.responded=False
+        self.responded = False
+        self.callback = None  # callback(key, result) instead of a response message, see MultiRequest
 
         if rtype == 'put':
             self.forwardedTo = None
@@ -33,3 +40,80 @@ class Request(object):
             self.hash = args[1]
             self.value = None
             self.context = None
+
+
+class MultiRequest(object):
+    """Results of the keys of a multi-key get or put, collected as they come in.
+
+    on_done(results) runs once, when every key has a result or when finish is
+    called, the keys without a result then get the error passed to finish.
+    """
+
+    def __init__(self, keys, on_done):
+        self.pending = set(keys)
+        self.results = {}
+        self.on_done = on_done
+        self.timer = None
+        self.sub_requests = {}  # id of a sub-request sent to another coordinator : (its items, its timer)
+
+    def add(self, key, result):
+        if key in self.pending:
+            self.pending.discard(key)
+            self.results[key] = result
+            if not self.pending:
+                self.finish()
+
+    def add_many(self, results):
+        for (key, result) in results.items():
+            self.add(key, result)
+
+    def finish(self, error="Error"):
+        if self.on_done is None:
+            return
+
+        for key in self.pending:
+            self.results[key] = error
+        self.pending.clear()
+        if self.timer is not None:
+            self.timer.cancel()
+
+        on_done, self.on_done = self.on_done, None
+        on_done(self.results)
+
+
+class RegistryFull(Exception):
+    pass
+
+
+class RequestRegistry(object):
+    """Ongoing requests keyed by a request id that is unique on this node.
+
+    The id is carried in storeFile/getFile and their responses, so finding the
+    request for a response is a dict lookup.
+    """
+
+    def __init__(self, max_in_flight=10000):
+        self.max_in_flight = max_in_flight
+        self._requests = {}
+        self._ids = itertools.count(1)
+
+    def __len__(self):
+        return len(self._requests)
+
+    def __contains__(self, req_id):
+        return req_id in self._requests
+
+    def add(self, request):
+        """Assign the next request id to request and track it. Raises RegistryFull at max_in_flight."""
+        if len(self._requests) >= self.max_in_flight:
+            raise RegistryFull("%d requests in flight" % len(self._requests))
+
+        request.req_id = next(self._ids)
+        self._requests[request.req_id] = request
+        return request.req_id
+
+    def get(self, req_id):
+        return self._requests.get(req_id)
+
+    def remove(self, req_id):
+        return self._requests.pop(req_id, None)
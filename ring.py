@@ -1,19 +1,37 @@
 import socket
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from hashlib import md5
 import bisect
 
 
+HASH_SPACE = 2 ** 128  # md5
+
+# where a key goes: its coordinator, its replicas, and both as the preference list
+Route = namedtuple('Route', ['coordinator', 'replicas', 'preference'])
+
+
 class Ring(object):
+    """Consistent hash ring of hostnames.
+
+    Every node owns vnode_count tokens (virtual nodes) on the ring. A key
+    belongs to the first token at or after its hash, the node of that token
+    coordinates it. The replicas of a key are the next distinct hosts walking
+    clockwise from there, so a host is never in a key's preference list twice.
+    Every node of a cluster must use the same vnode_count.
+
+    The route of every token range is computed when membership changes and
+    kept in an immutable table, a lookup is one hash and one bisect and
+    returns a Route shared by all keys of the range.
+    """
 
     def __init__(self, vnode_count=1, replica_count=0):
         """Create a new Ring.
 
-        :param vnode_count: number of virtual nodes.
+        :param vnode_count: number of virtual nodes (tokens) per node.
         :param replica_count: number of replicas for each key
         """
 
-        self.vnode_count = 1  # for now, only 1 vnode is supported
+        self.vnode_count = vnode_count
         self.replica_count = replica_count
 
         # maps node_id to corresponding virtual nodes (stored as set)
@@ -25,7 +43,10 @@ class Ring(object):
         self.ip_to_hostname = {}
         self.hostname_to_ip = {}
 
-        self._generate_hash = lambda key: int(md5(key.encode('utf-8')).hexdigest(), 16)
+        # sorted tokens and the Route of the range ending at each, replaced as a whole by _rebuild
+        self._table = ((), ())
+
+        self._generate_hash = lambda key: int.from_bytes(md5(key.encode('utf-8')).digest(), 'big')
         self._generate_vnode_ids = lambda node_id: (node_id + '_' + str(i) for i in range(self.vnode_count))
 
     def __setitem__(self, node_id, hostname):
@@ -40,18 +61,36 @@ class Ring(object):
 
             self._vnode_mapping[node_id].add(vnode_hash)
 
+        self._rebuild()
+
     def __delitem__(self, node_id):
         """Remove a node, given its id."""
 
-        vnode_hashes = self._vnode_mapping.get(node_id, None)
+        vnode_hashes = self._vnode_mapping.pop(node_id, None)
         if not vnode_hashes:
-            raise ValueError("Node id not in the ring" % node_id)
+            raise ValueError("Node id %r not in the ring" % node_id)
 
         for vnode_hash in vnode_hashes:
             del self._nodes[vnode_hash]
             index = bisect.bisect_left(self._vnode_hashes, vnode_hash)
             del self._vnode_hashes[index]
 
+        self._rebuild()
+
+    def _rebuild(self):
+        """Recompute the routing table after a membership change"""
+        routes = []
+        for index in range(len(self._vnode_hashes)):
+            preference = []
+            for host in self._walk_hosts(index):
+                preference.append(host)
+                if len(preference) == self.replica_count + 1:
+                    break
+            preference = tuple(preference)
+            routes.append(Route(preference[0], preference[1:], preference))
+
+        self._table = (tuple(self._vnode_hashes), tuple(routes))
+
     def _get_nearest_hash_index(self, key_hash):
         """Given a hash value, returns the index of nearest hash in _vnode_hashes."""
 
@@ -69,17 +108,44 @@ class Ring(object):
         hash, returns the lowest hashed node.
 
         """
-        key_hash = self._generate_hash(key)
-        hash_index = self._get_nearest_hash_index(key_hash)
-        return self._nodes[self._vnode_hashes[hash_index]]
+        return self.lookup(key).coordinator
+
+    def lookup(self, key):
+        """Route of a key"""
+        tokens, routes = self._table
+        index = bisect.bisect(tokens, int.from_bytes(md5(key.encode('utf-8')).digest(), 'big'))
+        return routes[index if index < len(tokens) else 0]
+
+    def key_position(self, key):
+        """Hash of a key on the ring"""
+        return self._generate_hash(key)
+
+    def lookup_many(self, keys):
+        """Routes of many keys, in the order of keys"""
+        tokens, routes = self._table
+        n = len(tokens)
+        found = []
+        for key in keys:
+            index = bisect.bisect(tokens, int.from_bytes(md5(key.encode('utf-8')).digest(), 'big'))
+            found.append(routes[index if index < n else 0])
+        return found
 
     def __len__(self):
-        return len(self._nodes) // self.vnode_count  # to account for vnode_count
+        return len(self._vnode_mapping)
 
     def __contains__(self, node_id):
-        vnode_ids = list(self._generate_vnode_ids(node_id))
-
-        return self._generate_hash(vnode_ids[0]) in self._nodes
+        return node_id in self._vnode_mapping
+
+    def _walk_hosts(self, hash_index):
+        """Distinct hosts clockwise from the vnode at hash_index, that one's host first"""
+        seen = set()
+        for x in range(hash_index, hash_index + len(self._vnode_hashes)):
+            host = self._nodes[self._vnode_hashes[x % len(self._vnode_hashes)]]
+            if host not in seen:
+                seen.add(host)
+                yield host
+                if len(seen) == len(self._vnode_mapping):
+                    return
 
     # Helper functions to expose stable API
     def add_node(self, node_hostname):
@@ -95,54 +161,86 @@ class Ring(object):
         return self.__delitem__(node_hostname)
 
     def get_node_for_key(self, key):
-        return self.__getitem__(key)
+        return self.lookup(key).coordinator
 
-    def get_replicas_for_key(self, key):
-        key_hash = self._generate_hash(key)
-        hash_index = self._get_nearest_hash_index(key_hash)
+    def get_preference_list(self, key, extra=0):
+        """Coordinator and replicas of a key, followed by up to extra hosts for hinted handoff"""
+        if not extra:
+            return self.lookup(key).preference
 
-        replica_list = []  # Only contains replicas, not the main node. len = self.replica_count
-        for x in range(hash_index + 1, hash_index + self.replica_count + 1):
-            index = x % len(self._vnode_hashes)  # wrap around the list
-            replica_list.append(self._nodes[self._vnode_hashes[index]])
+        hash_index = self._get_nearest_hash_index(self._generate_hash(key))
+        hosts = []
+        for host in self._walk_hosts(hash_index):
+            hosts.append(host)
+            if len(hosts) == self.replica_count + 1 + extra:
+                break
+        return tuple(hosts)
 
-        return replica_list
+    def get_replicas_for_key(self, key):
+        # Only contains replicas, not the main node. len = self.replica_count, less in a small ring
+        return self.lookup(key).replicas
 
     def get_all_hosts(self):
-        return set(self._nodes.values())
+        return set(self._vnode_mapping)
+
+    def get_handoff_nodes(self, key, count):
+        """Up to count hosts after the preference list of key, they hold hints for failed replicas"""
+        return list(self.get_preference_list(key, extra=count)[self.replica_count + 1:])
 
     def get_handoff_node(self, node_ip):
+        """Next host clockwise from the first token of a node"""
         hostname = self.ip_to_hostname[node_ip]
-        # hostname = node_ip
-        vnode_ids = list(self._generate_vnode_ids(hostname))
-
-        index = self._get_nearest_hash_index(self._generate_hash(vnode_ids[0]))
-        handoff_index = (index + self.replica_count) % len(self._vnode_hashes)
-
-        return self._nodes[self._vnode_hashes[handoff_index]]
+        index = bisect.bisect_left(self._vnode_hashes, min(self._vnode_mapping[hostname]))
+        hosts = list(self._walk_hosts(index))
+        return hosts[1] if len(hosts) > 1 else hostname
 
     def get_key_range(self, hostname):
-        vnode_id = list(self._generate_vnode_ids(hostname))[0]
-        index = self._get_nearest_hash_index(self._generate_hash(vnode_id))
-
-        start_key = self._vnode_hashes[index-2]
-        end_key = self._vnode_hashes[index-1]
-
-        return start_key, end_key
+        """Hash ranges (start, end] of the keys hostname coordinates, one per token, sorted"""
+        ranges = []
+        for token in sorted(self._vnode_mapping.get(hostname, ())):
+            index = bisect.bisect_left(self._vnode_hashes, token)
+            ranges.append((self._vnode_hashes[index - 1], token))
+        return ranges
+
+    def get_replicated_ranges(self, hostname):
+        """Hash ranges (start, end] hostname holds a copy of, as coordinator or replica,
+        each with the preference list of the range"""
+        tokens, routes = self._table
+        return [(tokens[index - 1], token, routes[index].preference)
+                for (index, token) in enumerate(tokens) if hostname in routes[index].preference]
+
+    @staticmethod
+    def _range_size(start, end):
+        return (end - start) % HASH_SPACE or HASH_SPACE  # a single token owns the whole ring
+
+    def load_report(self):
+        """Per host: token count, percent of the key space it coordinates and
+        percent of the key space it holds a copy of (coordinator or replica)"""
+        report = {host: {'tokens': len(tokens), 'owned': 0.0, 'replicated': 0.0}
+                  for (host, tokens) in self._vnode_mapping.items()}
+
+        tokens, routes = self._table
+        for (index, token) in enumerate(tokens):
+            share = 100.0 * self._range_size(tokens[index - 1], token) / HASH_SPACE
+            report[routes[index].coordinator]['owned'] += share
+            for host in routes[index].preference:
+                report[host]['replicated'] += share
+
+        return report
 
 
 if __name__ == '__main__':
-    # to make these cases work, comment lines 86-88, 115. Uncomment 116.
+    # hostnames that do not resolve are added without add_node
 
-    r = Ring(vnode_count=1, replica_count=3)
+    r = Ring(vnode_count=32, replica_count=3)
 
-    r.add_node("node1.hostname")
-    r.add_node("node2.hostname")
-    r.add_node("node3.hostname")
-    r.add_node("node4.hostname")
-    r.add_node("node5.hostname")
-    r.add_node("node6.hostname")
-    r.add_node("node7.hostname")
+    r["node1.hostname"] = "node1.hostname"
+    r["node2.hostname"] = "node2.hostname"
+    r["node3.hostname"] = "node3.hostname"
+    r["node4.hostname"] = "node4.hostname"
+    r["node5.hostname"] = "node5.hostname"
+    r["node6.hostname"] = "node6.hostname"
+    r["node7.hostname"] = "node7.hostname"
 
     # print node arrangement:
     print("ring structure:")
@@ -151,13 +249,12 @@ if __name__ == '__main__':
         print(s, r._nodes[s])
     print('\n')
 
-    print("range for node1:", r.get_key_range("node1.hostname"))
-    print("range for node2:", r.get_key_range("node2.hostname"))
-    print("range for node3:", r.get_key_range("node3.hostname"))
-    print("range for node4:", r.get_key_range("node4.hostname"))
-    print("range for node5:", r.get_key_range("node5.hostname"))
-    print("range for node6:", r.get_key_range("node6.hostname"))
-    print("range for node7:", r.get_key_range("node7.hostname"))
+    print("ranges of node1:", r.get_key_range("node1.hostname")[:3], "...")
+
+    print("load distribution:")
+    for (host, load) in sorted(r.load_report().items()):
+        print("%-16s %3d tokens %6.2f%% owned %6.2f%% replicated" % (host, load['tokens'], load['owned'], load['replicated']))
+    print('\n')
 
     # # Try inserting a key
     # print("for key1...")
@@ -203,7 +300,7 @@ if __name__ == '__main__':
 
     print(r.get_all_hosts())
 
-    r.remove_node("node1.hostname")
+    del r["node1.hostname"]
     print(r.get_all_hosts())
 
     # print node arrangement:
@@ -0,0 +1,89 @@
+import heapq
+import itertools
+import time
+
+
+class TimerHandle(object):
+
+    def __init__(self, when, callback, args, kwargs):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+        self._scheduler = None
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            if self._scheduler is not None:
+                self._scheduler._cancelled += 1
+
+
+class Scheduler(object):
+    """Heap of timeouts, run by the node's event loop.
+
+    Callbacks run from run_due(), i.e. on the thread that processes messages.
+    Cancelling only marks the handle, cancelled handles are dropped when they
+    reach the top of the heap or when they make up most of it.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._heap = []
+        self._seq = itertools.count()  # tie breaker, handles are not comparable
+        self._cancelled = 0
+
+        # called with the new deadline whenever the earliest deadline moves up
+        self.on_reschedule = None
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        """Run callback(*args, **kwargs) after delay seconds. Returns a handle that can be cancelled."""
+        handle = TimerHandle(self.clock() + delay, callback, args, kwargs)
+        handle._scheduler = self
+
+        earliest = self._heap[0][0] if self._heap else None
+        heapq.heappush(self._heap, (handle.when, next(self._seq), handle))
+
+        if self.on_reschedule is not None and (earliest is None or handle.when < earliest):
+            self.on_reschedule(handle.when)
+
+        return handle
+
+    def _discard_cancelled(self):
+        if self._cancelled > 512 and self._cancelled > len(self._heap) // 2:
+            self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+            self._cancelled -= 1
+
+    def next_deadline(self):
+        """Clock time of the earliest pending callback, None if there is none."""
+        self._discard_cancelled()
+        return self._heap[0][0] if self._heap else None
+
+    def next_timeout(self):
+        """Seconds until the earliest pending callback, None if there is none."""
+        deadline = self.next_deadline()
+        return None if deadline is None else max(0, deadline - self.clock())
+
+    def run_due(self):
+        """Run every callback whose deadline has passed. Callbacks scheduled by
+        those, even without a delay, wait for the next call: a long job that
+        reschedules itself with call_later(0, ...) lets the loop handle I/O in between."""
+        now = self.clock()
+        last = next(self._seq)
+        while self._heap and self._heap[0][0] <= now and self._heap[0][1] < last:
+            handle = heapq.heappop(self._heap)[2]
+            if handle.cancelled:
+                self._cancelled -= 1
+                continue
+
+            handle._scheduler = None  # a late cancel() must not touch the count
+            handle.callback(*handle.args, **handle.kwargs)
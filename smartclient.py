@@ -0,0 +1,139 @@
+"""Client library that sends every key straight to its coordinator.
+
+The client fetches the membership ring from a node (0x14 ringRequest) and
+hashes keys with the same Ring the nodes use, so a clientPut or clientGet goes
+to the node that coordinates the key instead of being forwarded there by the
+node it reached. A node that does not coordinate the key, because the ring changed
+since it was fetched, answers with a 0x15 redirect. The client then fetches
+the ring from that node and retries at the new coordinator.
+
+When the coordinator cannot be reached the request is sent as a command to
+another node of the key's preference list, which forwards it as client.py
+requests are.
+
+    client = SmartClient(['node1', 'node2'], 13337)
+    client.put('key', 'value', {})
+    versions = client.get('key')
+"""
+import json
+import socket
+
+import messages
+from ring import Ring
+
+
+class SmartClient(object):
+
+    def __init__(self, seeds, port, timeout=10.0, max_redirects=3):
+        """
+        :param seeds: hostnames of nodes to fetch the ring from
+        :param timeout: seconds to wait for an answer, a command forwarded past a dead coordinator takes several
+        :param max_redirects: redirects followed before giving up on a request
+        """
+        self.seeds = list(seeds)
+        self.port = port
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+
+        self.ring = None
+        self._sockets = {}  # host : connected socket
+        self.redirects = 0
+        self.fallbacks = 0
+        self.refresh()
+
+    def put(self, key, value, context=None):
+        """Store value under key. Returns the value, or "Error" if too few replicas stored it."""
+        context = context or {}
+        (code, data) = self._request(key, messages.putMessage(key, value, context),
+                                     'put %s %s %s' % (key, json.dumps(context, separators=(',', ':')), value))
+        return data[1] if code == b'\x30' else data  # else an error message
+
+    def get(self, key):
+        """Versions of key as [clock, value] pairs, None or "Error" if too few replicas answered"""
+        (code, data) = self._request(key, messages.getMessage(key), 'get %s' % key)
+        return data[1] if code == b'\x40' else data
+
+    def refresh(self, host=None):
+        """Fetch the ring from host, or from the first seed or known node that answers"""
+        known = sorted(self.ring.get_all_hosts()) if self.ring else []
+        for node in ([host] if host else []) + self.seeds + known:
+            try:
+                (code, data) = self._call(node, messages.ringRequest())
+            except (OSError, messages.ProtocolError):
+                continue
+            if code != b'\x41' or not data[2]:  # not a member of a ring yet
+                continue
+
+            (vnode_count, replica_count, hosts) = data
+            ring = Ring(vnode_count=vnode_count, replica_count=replica_count)
+            for h in hosts:
+                ring.add_node(h)
+            self.ring = ring
+            return
+
+        raise ConnectionError("No node sent its membership ring")
+
+    def close(self):
+        for s in self._sockets.values():
+            s.close()
+        self._sockets.clear()
+
+    def _request(self, key, msg, command):
+        """Send msg to the coordinator of key, following redirects. Returns (message code, message)."""
+        for _ in range(self.max_redirects + 1):
+            preference = self.ring.lookup(key).preference
+            try:
+                (code, data) = self._call(preference[0], msg)
+            except OSError:
+                return self._fall_back(preference[1:], command)
+
+            if code != b'\x15':
+                return (code, data)
+
+            self.redirects += 1
+            self.refresh(preference[0])
+
+        raise ConnectionError("Too many redirects for %r" % key)
+
+    def _fall_back(self, hosts, command):
+        """Send a command to the first of hosts that answers, the node forwards it to the coordinator"""
+        for host in hosts:
+            try:
+                (code, data) = self._call(host, messages.client_message(command))
+            except OSError:
+                continue
+            self.fallbacks += 1
+            return (code, data)
+
+        raise ConnectionError("No replica of the key answered")
+
+    def _call(self, host, msg):
+        """Send msg to host and wait for one frame. Returns (message code, message)."""
+        s = self._sockets.get(host)
+        try:
+            if s is None:
+                s = socket.create_connection((host, self.port), timeout=self.timeout)
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self._sockets[host] = s
+            s.sendall(msg)
+
+            header = self._recv_exactly(s, 5)
+            frame = header + self._recv_exactly(s, messages._get_payload_len(header[1:5]))
+        except OSError:
+            # the connection is unusable, a late answer on it must not be taken for the next one
+            self._sockets.pop(host, None)
+            if s is not None:
+                s.close()
+            raise
+
+        return messages._unpack_message(frame)
+
+    @staticmethod
+    def _recv_exactly(s, n):
+        data = b''
+        while len(data) < n:
+            chunk = s.recv(n - len(data))
+            if not chunk:
+                raise ConnectionResetError("Connection closed by node")
+            data += chunk
+        return data
@@ -9,11 +9,19 @@
 Table format
 
 CREATE TABLE storage (
-    id int primary key autoincrement,
-    hash text not null,
-    version int not null,
-    file blob not null
+    id INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL,          -- sha1 of the key, indexed
+    key TEXT NOT NULL,
+    version TEXT NOT NULL,       -- vector clock as JSON
+    written_at REAL NOT NULL,    -- unix time of the write
+    file BLOB NOT NULL
 );
+CREATE INDEX storage_hash ON storage (hash);
+
+PRAGMA user_version holds SCHEMA_VERSION. Databases of the first schema
+(hash holding the key itself, version as a python dict literal, no index) are
+migrated in place when opened, keeping only the versions of a key that no
+later version of it descends from, as writes do.
 
 Vector clocks in DB are dictionaries of counters where the keys are server
 names that lead the commit and the values indicate the number of times that
@@ -27,6 +35,11 @@ Ordering of versions in the database:
     the count for the leader by one before storing the (hash,version,blob) in
     the database.
 
+    Only the concurrent versions of a key (siblings) are kept. A write deletes
+    every stored version its clock descends from, in the same transaction, and
+    is not stored at all if a stored version descends from it. Of two versions
+    with the same clock the later write wins.
+
     When a value is read from the database, a hash is provided and the get
     function returns a list of (clock,value) pairs for each row of the database
     sorted in descending order of occurence, that is the first row(s) (if concurrent write)
@@ -35,191 +48,442 @@ Ordering of versions in the database:
 This means we will need only change the get protocol. We will need to send back
 a whole list of responses (like peer bootstrap) instead of just 1.
 
+Clock comparisons are done by vclock.py.
+
+StorageEngine holds what every engine shares. Storage keeps the versions in the
+SQLite table above, LogStorage (logstore.py) in append-only segment files.
+
 There is also function in here called mergeClocks which takes two vector clocks and
 returns a dict with the maximum value for each key in both clocks
 i.e.  [s1:1,s2:1]+[s1:2]=[s1:2,s2:1]
 """
 
+import ast
 import hashlib
+import json
 import sqlite3 as sql
-from copy import deepcopy
+import time
+from collections import OrderedDict
+
+import vclock
 
 
 def h(fname):
     return hashlib.sha1(fname.encode('utf-8')).hexdigest()
 
 
-def toUni(hash_digest):
-    # return u''.join([u'{:02x}'.format(ord(c)) for c in hash_digest])
-    return hash_digest
+SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
 
+SCHEMA_VERSION = 2
 
-class Storage(object):
 
-    def __init__(self, table_path):
-        # conn = sql.connect( ''.join([D['fileDir'],'indexDB_',str(os.getpid()),'.db']) )
-        conn = sql.connect(table_path)
+def clock_to_json(clock):
+    return json.dumps(clock, separators=(',', ':'))
 
-        c = conn.cursor()
 
-        # c.execute('''DROP TABLE IF EXISTS storage;''')
+class VersionCache(object):
+    """LRU cache of key hash : sorted version list, bounded by an estimate of its size in bytes"""
 
-        c.execute('''CREATE TABLE IF NOT EXISTS storage (
-                id INT PRIMARY KEY,
-                hash TEXT NOT NULL,
-                version TEXT NOT NULL,
-                file BLOB NOT NULL
-            );''')
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key hash : (versions, size), least recently used first
 
-        conn.commit()
+    @staticmethod
+    def entry_size(key_hash, versions):
+        # rough python object overhead of a list of [clock dict, bytes] pairs
+        return 100 + len(key_hash) + sum(120 + len(value) + 100 * len(clock) for (clock, value) in versions)
 
-        self.db = conn
+    def get(self, key_hash):
+        entry = self._entries.get(key_hash)
+        if entry is None:
+            self.misses += 1
+            return None
 
-    # hash of file, server leading the write, prev_version, file blob
-    def storeFile(self, hash_digest, writer, prev_version, file):
-        if prev_version is None:
-            version = {writer: 1}
-        elif writer in prev_version:
-            version = deepcopy(prev_version)
-            version[writer] += 1
-        else:
-            version = deepcopy(prev_version)
-            version[writer] = 1
+        self.hits += 1
+        self._entries.move_to_end(key_hash)
+        return entry[0]
 
-        c = self.db.cursor()
-
-        uHash = toUni(hash_digest)
+    def peek(self, key_hash):
+        """Versions of key_hash, without counting a hit or miss or refreshing it"""
+        entry = self._entries.get(key_hash)
+        return entry[0] if entry is not None else None
 
-        # print("Storing file: ", uHash, version, file)
+    def put(self, key_hash, versions):
+        self.discard(key_hash)
 
-        c.execute('''INSERT INTO storage (hash, version, file) VALUES (?,?,?);''',
-                  (uHash,'%s' % version, file.encode('utf-8')))
-
-        self.db.commit()
-
-    # returns a list of sorted clock,value pairs for each matching
-    # row in the database
-    def getFile(self, hash_digest):
-        c = self.db.cursor()
-        uHash = toUni(hash_digest)
-        c.execute('''SELECT * FROM storage WHERE hash=?;''', (uHash,))
-        rows = c.fetchall()
-
-        return self.sortData([[eval('%s' % (r[2])), r[3]] for r in rows]) if rows is not None else None
-
-    # remove all instances of a given hash from the db
-    def remFile(self, hash_digest):
-        c = self.db.cursor()
-        uHash = toUni(hash_digest)
-        c.execute('''DELETE FROM storage WHERE hash=?;''', (uHash,))
-        self.db.commit()
+        size = self.entry_size(key_hash, versions)
+        if size > self.max_bytes:
+            return
+
+        self._entries[key_hash] = (versions, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.bytes -= evicted
+            self.evictions += 1
+
+    def discard(self, key_hash):
+        entry = self._entries.pop(key_hash, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def stats(self):
+        return {'entries': len(self._entries), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class StorageEngine(object):
+    """Versioned key value store, the parts shared by every storage engine.
+
+    With a commit_window writes are group committed: they are made durable
+    together commit_window seconds after the first of them or once
+    commit_count writes are waiting. Callers pass on_commit to learn when that
+    happened, e.g. to send an ack. Grouping needs a scheduler to run the window
+    timer; without a window every write commits on its own.
+
+    With cache_bytes set, the sorted versions of recently read keys are kept in
+    a VersionCache that writes update in place.
+
+    on_change, when set, is called as on_change(key, added, removed) with the
+    clocks of the versions a write or delete added and removed.
+
+    Engines implement _write, _read, _delete, _scan and _sync.
+    """
+
+    def __init__(self, commit_window=0, commit_count=64, scheduler=None, cache_bytes=0):
+        self.commit_window = commit_window if scheduler is not None else 0
+        self.commit_count = commit_count
+        self.scheduler = scheduler
+        self._on_commit = []  # callbacks of the writes waiting for the group commit
+        self._commit_timer = None
+
+        self.cache = VersionCache(cache_bytes) if cache_bytes > 0 else None
+        self.on_change = None
+
+    def _write(self, key, key_hash, version, data):
+        """Store a version unless a stored one descends from it, see the module docstring.
+        Returns the clocks of the versions it replaced, None if it was not stored."""
+        raise NotImplementedError
+
+    def _read(self, key, key_hash):
+        """Unsorted [clock, value] pairs of the key"""
+        raise NotImplementedError
+
+    def _delete(self, key, key_hash):
+        """Returns the clocks of the deleted versions"""
+        raise NotImplementedError
+
+    def _scan(self):
+        """(key, clock, value size) of every stored version"""
+        raise NotImplementedError
+
+    def _sync(self):
+        """Make every write so far durable"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    # positions of the stored clocks the new one replaces,
+    # None if a stored clock descends from it
+    def _supersede(self, version, stored):
+        stale = []
+        for (i, clock) in enumerate(stored):
+            order = vclock.compare(version, clock)
+            if order == 0 or order == 1:
+                stale.append(i)
+            elif order == -1:
+                return None
+        return stale
+
+    # key of file, server leading the write, prev_version, file blob
+    # on_commit runs once the write is committed
+    # commit=False leaves the write uncommitted until a later commit(), on_commit runs after that one
+    def storeFile(self, key, writer, prev_version, file, on_commit=None, commit=True):
+        version = dict(prev_version) if prev_version else {}
+        version[writer] = version.get(writer, 0) + 1
+
+        # print("Storing file: ", key, version, file)
+
+        self._store_version(key, h(key), version, file.encode('utf-8'))
+        if commit:
+            self.commit(on_commit)
+        elif on_commit is not None:
+            self._on_commit.append(on_commit)
+
+    # store [clock, value] pairs as they are, e.g. versions copied from another replica
+    def storeVersions(self, key, versions, on_commit=None, commit=True):
+        key_hash = h(key)
+        for (clock, data) in versions:
+            self._store_version(key, key_hash, clock, data)
+        if commit:
+            self.commit(on_commit)
+        elif on_commit is not None:
+            self._on_commit.append(on_commit)
+
+    def _store_version(self, key, key_hash, version, data):
+        removed = self._write(key, key_hash, version, data)
+        if removed is None:
+            return
+
+        cached = self.cache.peek(key_hash) if self.cache is not None else None
+        if cached is not None:  # same frontier as the engine's
+            kept = [v for v in cached if vclock.compare(version, v[0]) not in (0, 1)]
+            self.cache.put(key_hash, self.sortData(kept + [[version, data]]))
+
+        if self.on_change is not None:
+            self.on_change(key, [version], removed)
+
+    # commit the writes made so far, on_commit runs after the commit
+    # group commit only schedules it, see the class docstring
+    def commit(self, on_commit=None):
+        self._on_commit.append(on_commit)
+
+        if not self.commit_window or len(self._on_commit) >= self.commit_count:
+            self.flush()
+        elif self._commit_timer is None:
+            self._commit_timer = self.scheduler.call_later(self.commit_window, self.flush)
+
+    # commit now and run the callbacks of every write it covers
+    def flush(self):
+        if self._commit_timer is not None:
+            self._commit_timer.cancel()
+            self._commit_timer = None
+
+        self._sync()
+
+        callbacks, self._on_commit = self._on_commit, []
+        for callback in callbacks:
+            if callback is not None:
+                callback()
+
+    # returns a list of sorted clock,value pairs for each stored version
+    def getFile(self, key):
+        key_hash = h(key)
+        if self.cache is not None:
+            versions = self.cache.get(key_hash)
+            if versions is not None:
+                return list(versions)
+
+        versions = self.sortData(self._read(key, key_hash))
+        if self.cache is not None:
+            self.cache.put(key_hash, versions)
+            return list(versions)
+        return versions
+
+    # remove all versions of a given key
+    def remFile(self, key, on_commit=None):
+        key_hash = h(key)
+        if self.cache is not None:
+            self.cache.discard(key_hash)
+
+        removed = self._delete(key, key_hash)
+        if removed and self.on_change is not None:
+            self.on_change(key, [], removed)
+        self.commit(on_commit)
+
+    def scan_versions(self):
+        """(key, clock, value size) of every stored version in no particular order, read as it goes"""
+        return self._scan()
+
+    # yields (key, [clocks], total size of the values) for every stored key, sorted by key
+    def scan(self):
+        key, clocks, size = None, [], 0
+        for (k, clock, length) in sorted(self._scan(), key=lambda version: version[0]):
+            if k != key:
+                if clocks:
+                    yield key, clocks, size
+                key, clocks, size = k, [], 0
+            clocks.append(clock)
+            size += length
+        if clocks:
+            yield key, clocks, size
+
+    def cache_stats(self):
+        return self.cache.stats() if self.cache is not None else None
 
     # returns 1 if val2 -> val1
     # otherwise 0
     def compare_clocks(self, val1, val2):
-        vec1 = deepcopy(val1[0])  # duplicate dictionaries
-        vec2 = deepcopy(val2[0])
-        # make sure both dictionaries have same key set
-        for key in val1[0].keys():
-            if key not in val2[0]:
-                vec2[key] = 0;
-
-        for key in val2[0].keys():
-            if key not in val1[0]:
-                vec2[key] = 0;
-
-            # convert to tuple list for sorting
-        vec1 = list(vec1.items())
-        vec2 = list(vec2.items())
-        # sort key/val pairs by server name
-        vec1.sort(key=(lambda x: x[0]))
-        vec2.sort(key=(lambda x: x[0]))
-
-        isGT = True  # all vals are gte to the second clock
-        isStrict = False  # at least one val is strictly greater
-
-        for vc1, vc2 in zip(vec1, vec2):
-            if vc1 < vc2:
-                isGT = False
-            if vc1 > vc2:
-                isStrict = True
-
-        return 1 if isGT and isStrict else 0
+        return 1 if vclock.compare(val1[0], val2[0]) == 1 else 0
 
     # returns the ordered pair such that if val1->val2 then (val2, val1)
     # else if val2->val1 then (val1, val2) else (val1, val2)
     def compare_and_swap(self, val1, val2):
-        return [val1, val2] if self.compare_clocks(val1, val2) else (
-            [val2, val1] if self.compare_clocks(val2, val1) else [val1, val2]
-        )
+        return [val2, val1] if self.compare_clocks(val2, val1) else [val1, val2]
 
-    # bubble sort for vector clocks
     # Sorts list of (clock, value) pairs in descending order of occurance
     def sortData(self, values):
-        for i in range(len(values))[::-1]:
-            for j in range(i):
-                values[j], values[j + 1] = self.compare_and_swap(values[j], values[j + 1])
-
-        return values
+        return vclock.newest_first(values)
 
     # merge together the vector clocks of two concurrent versions of data
     # such that each clock value is the max of the prev two
     # this will rejoin the branches of the version history
     def mergeClocks(self, clock1, clock2):
-        comb_clock = deepcopy(clock1)
-        for serv, clock in clock2.items():
-            if serv in comb_clock:
-                comb_clock[serv] = max(comb_clock[serv], clock)
-            else:
-                comb_clock[serv] = clock
-        return comb_clock
+        return vclock.merge(clock1, clock2)
+
+
+class Storage(StorageEngine):
+    """Storage engine on a SQLite table, see the module docstring.
+
+    The database runs in WAL mode, group commits share one transaction.
+    """
+
+    def __init__(self, table_path, synchronous='FULL', commit_window=0, commit_count=64, scheduler=None,
+                 cache_bytes=0):
+        StorageEngine.__init__(self, commit_window=commit_window, commit_count=commit_count, scheduler=scheduler,
+                               cache_bytes=cache_bytes)
+
+        # conn = sql.connect( ''.join([D['fileDir'],'indexDB_',str(os.getpid()),'.db']) )
+        conn = sql.connect(table_path)
+
+        if synchronous.upper() not in SYNCHRONOUS_LEVELS:
+            raise ValueError("synchronous must be one of %s" % ", ".join(SYNCHRONOUS_LEVELS))
+
+        conn.execute('PRAGMA journal_mode=WAL;')
+        conn.execute('PRAGMA synchronous=%s;' % synchronous.upper())
+
+        self.db = conn
+
+        if conn.execute('PRAGMA user_version;').fetchone()[0] < SCHEMA_VERSION:
+            self._create_schema()
+
+    def _create_schema(self):
+        c = self.db.cursor()
+        c.execute('BEGIN;')  # a failed migration leaves the old table untouched
+
+        old_columns = [r[1] for r in c.execute('PRAGMA table_info(storage);')]
+        if old_columns:
+            print("Migrating %d rows to storage schema %d" % (
+                c.execute('SELECT COUNT(*) FROM storage;').fetchone()[0], SCHEMA_VERSION))
+            c.execute('ALTER TABLE storage RENAME TO storage_v1;')
+
+        c.execute('''CREATE TABLE storage (
+                id INTEGER PRIMARY KEY,
+                hash TEXT NOT NULL,
+                key TEXT NOT NULL,
+                version TEXT NOT NULL,
+                written_at REAL NOT NULL,
+                file BLOB NOT NULL
+            );''')
+        c.execute('CREATE INDEX storage_hash ON storage (hash);')
+
+        if old_columns:
+            # the first schema kept the key in the hash column and the clock as a dict literal
+            self.db.create_function('sha1', 1, h)
+            self.db.create_function('clock_json', 1, lambda v: clock_to_json(ast.literal_eval(v)))
+            c.execute('''INSERT INTO storage (hash, key, version, written_at, file)
+                         SELECT sha1(hash), hash, clock_json(version), ?, file FROM storage_v1 ORDER BY rowid;''',
+                      (time.time(),))
+            c.execute('DROP TABLE storage_v1;')
+
+            # the first schema kept every version, drop the ones the write path (_write) would have
+            # replaced: a later version of the same key descends from them
+            obsolete = []
+            key, kept = None, []  # (id, clock) of the versions of key that survive so far
+            for (row_id, k, version) in c.execute('''SELECT id, key, version FROM storage WHERE key IN
+                                                       (SELECT key FROM storage GROUP BY key HAVING COUNT(*) > 1)
+                                                     ORDER BY key, id;''').fetchall():
+                if k != key:
+                    key, kept = k, []
+                clock = json.loads(version)
+                stale = self._supersede(clock, [c for (_, c) in kept])
+                if stale is None:
+                    obsolete.append(row_id)
+                    continue
+                obsolete += [kept[i][0] for i in stale]
+                kept = [entry for (i, entry) in enumerate(kept) if i not in stale] + [(row_id, clock)]
+            c.executemany('DELETE FROM storage WHERE id=?;', [(row_id,) for row_id in obsolete])
+
+        c.execute('PRAGMA user_version=%d;' % SCHEMA_VERSION)
+        self.db.commit()
+
+    def _write(self, key, key_hash, version, data):
+        c = self.db.cursor()
+        rows = c.execute('''SELECT id, version FROM storage WHERE hash=? AND key=?;''', (key_hash, key)).fetchall()
+
+        clocks = [json.loads(r[1]) for r in rows]
+        stale = self._supersede(version, clocks)
+        if stale is None:
+            return None
+
+        c.executemany('''DELETE FROM storage WHERE id=?;''', [(rows[i][0],) for i in stale])
+        c.execute('''INSERT INTO storage (hash, key, version, written_at, file) VALUES (?,?,?,?,?);''',
+                  (key_hash, key, clock_to_json(version), time.time(), data))
+        return [clocks[i] for i in stale]
+
+    def _read(self, key, key_hash):
+        c = self.db.cursor()
+        c.execute('''SELECT version, file FROM storage WHERE hash=? AND key=?;''', (key_hash, key))
+        return [[json.loads(r[0]), r[1]] for r in c.fetchall()]
+
+    def _delete(self, key, key_hash):
+        c = self.db.cursor()
+        removed = c.execute('''SELECT version FROM storage WHERE hash=? AND key=?;''', (key_hash, key)).fetchall()
+        c.execute('''DELETE FROM storage WHERE hash=? AND key=?;''', (key_hash, key))
+        return [json.loads(r[0]) for r in removed]
+
+    def _scan(self):
+        for (key, version, length) in self.db.execute('''SELECT key, version, length(file) FROM storage;'''):
+            yield key, json.loads(version), length
+
+    def _sync(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
 
 
 if __name__ == '__main__':
     db = Storage(':memory:')
 
-    db.storeFile(h('testFile'), 's1', None, 'This is a test file 0')
+    db.storeFile('testFile', 's1', None, 'This is a test file 0')
 
     # concurrent write operations by s1 and s2
-    prev = db.getFile(h('testFile'))[0][0]
+    prev = db.getFile('testFile')[0][0]
 
-    print(db.getFile(h('testFile')))
+    print(db.getFile('testFile'))
 
-    db.storeFile(h('testFile'), 's1', prev, 'This is a test file 1')
-    db.storeFile(h('testFile'), 's2', prev, 'This is a test file 2')
+    db.storeFile('testFile', 's1', prev, 'This is a test file 1')
+    db.storeFile('testFile', 's2', prev, 'This is a test file 2')
 
-    results = db.getFile(h('testFile'))
+    results = db.getFile('testFile')
     prev = db.mergeClocks(results[0][0], results[1][0])
 
     # store version that was reconciled by client
-    db.storeFile(h('testFile'), 's3', prev, 'This is a test file 3')
+    db.storeFile('testFile', 's3', prev, 'This is a test file 3')
 
-    prev = db.getFile(h('testFile'))[0][0]
+    prev = db.getFile('testFile')[0][0]
 
-    db.storeFile(h('testFile'), 's1', prev, 'This is a test file 4')
+    db.storeFile('testFile', 's1', prev, 'This is a test file 4')
 
-    prev = db.getFile(h('testFile'))[0][0]
+    prev = db.getFile('testFile')[0][0]
 
-    db.storeFile(h('testFile'), 's2', prev, 'This is a test file 5')
+    db.storeFile('testFile', 's2', prev, 'This is a test file 5')
 
-    prev = db.getFile(h('testFile'))[0][0]
+    prev = db.getFile('testFile')[0][0]
 
-    db.storeFile(h('testFile'), 's2', prev, 'This is a test file 6')
+    db.storeFile('testFile', 's2', prev, 'This is a test file 6')
 
-    prev = db.getFile(h('testFile'))[0][0]
+    prev = db.getFile('testFile')[0][0]
 
-    db.storeFile(h('testFile'), 's1', prev, 'This is a test file 7')
+    db.storeFile('testFile', 's1', prev, 'This is a test file 7')
 
-    prev = db.getFile(h('testFile'))[0][0]
+    prev = db.getFile('testFile')[0][0]
 
-    db.storeFile(h('testFile'), 's4', prev, 'This is a test file 8')
+    db.storeFile('testFile', 's4', prev, 'This is a test file 8')
 
-    prev = db.getFile(h('testFile'))[0][0]
+    prev = db.getFile('testFile')[0][0]
 
-    db.storeFile(h('testFile'), 's4', prev, 'This is a test file 9')
+    db.storeFile('testFile', 's4', prev, 'This is a test file 9')
 
-    print(db.getFile(h('testFile')))
+    print(db.getFile('testFile'))
 
-    db.remFile(h('testFile'))
+    db.remFile('testFile')
 
-    print(db.getFile(h('testFile')))
+    print(db.getFile('testFile'))
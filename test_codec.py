@@ -0,0 +1,128 @@
+import struct
+import unittest
+
+import codec
+import messages
+
+CLOCK = {'172.18.0.2': 3, '172.18.0.3': 1}
+VERSIONS = [[dict(CLOCK, **{'172.18.0.4': i}), bytes([97 + i]) * 20] for i in range(3)]
+
+# a value of each field kind
+SAMPLES = {
+    'u8': 7,
+    'u32': 70000,
+    'u64': 2 ** 40,
+    'u128': 2 ** 100 + 5,
+    'f64': 1700000000.5,
+    'u32s': [0, 1, 2 ** 32 - 1],
+    'u128s': [0, 2 ** 128 - 1],
+    'str': 'user:1234 é',
+    'bytes': b'\x00\xff' * 10,
+    'strs': ['a', '', 'c'],
+    'blobs': [b'', b'xyz'],
+    'clock': CLOCK,
+    'versions': VERSIONS,
+    'result': VERSIONS[:1],
+    'any': [['key', VERSIONS], None, True, -5, 1.5, ('t',), {'k': {1, 2}}],
+}
+
+# other values of the kinds whose encoding has several cases
+EDGE_CASES = {
+    'clock': [None, {}],
+    'versions': [[], VERSIONS[:1], [[{}, b'']], [[{'n%d' % i: 70000 for i in range(300)}, b'x'], [{'a': 1}, b'']]],
+    'result': [None, 'Error', [], VERSIONS],
+}
+
+
+def decoded(fields):
+    return fields[0] if len(fields) == 1 else (tuple(fields) if fields else None)
+
+
+class TestMessages(unittest.TestCase):
+
+    def test_round_trip_every_schema(self):
+        for (message_type, schema) in messages.MESSAGE_SCHEMAS.items():
+            fields = [SAMPLES[kind] for kind in schema]
+            frame = messages._pack_message(message_type, *fields)
+            self.assertEqual(messages._unpack_message(frame), (message_type, decoded(fields)), message_type)
+            self.assertEqual(messages._get_payload_len(frame[1:5]), len(frame) - 5)
+
+    def test_round_trip_edge_cases(self):
+        for (message_type, schema) in messages.MESSAGE_SCHEMAS.items():
+            for (i, kind) in enumerate(schema):
+                for value in EDGE_CASES.get(kind, []):
+                    fields = [SAMPLES[k] for k in schema]
+                    fields[i] = value
+                    frame = messages._pack_message(message_type, *fields)
+                    self.assertEqual(messages._unpack_message(frame)[1], decoded(fields), (message_type, value))
+
+    def test_fast_messages_match_schema_encoding(self):
+        for (message_type, schema) in messages.MESSAGE_SCHEMAS.items():
+            if message_type not in messages._FAST_PACKERS:
+                continue
+            fields = [SAMPLES[kind] for kind in schema]
+            frame = messages._pack_message(message_type, *fields)
+            self.assertEqual(frame, messages._pack_fields(message_type, fields), message_type)
+            self.assertEqual(messages._decode_v2(message_type, memoryview(frame)), decoded(fields))
+
+    def test_version_1_frames(self):
+        # getFileResponse and responseForForwardedReq as a node of protocol version 1 sent them
+        table = b'a\x00b'
+        versions_v1 = (b'\x00\x00\x00\x01' + b'\x00\x02' + b'\x00\x03' + table +
+                       b'\x00\x02' + b'\x00\x00\x00\x01' + b'\x00\x00\x00\x05\x00\x00\x00\x07' + b'\x00\x00\x00\x02xy')
+        payload = b'\x01' + b'\x00\x00\x00\x01k' + versions_v1 + b'\x00' * 7 + b'\x09'
+        frame = b'\x80' + len(payload).to_bytes(4, 'big') + payload
+        self.assertEqual(messages._unpack_message(frame), (b'\x80', ('k', [[{'a': 5, 'b': 7}, b'xy']], 9)))
+
+        payload = b'\x01' + b'\x00' * 7 + b'\x03' + b'\x01' + b's\x00\x00\x00\x05Error'
+        frame = b'\xa0' + len(payload).to_bytes(4, 'big') + payload
+        self.assertEqual(messages._unpack_message(frame), (b'\xa0', (3, 1, 'Error')))
+
+    def test_truncated_frames_raise_protocol_error(self):
+        for (message_type, schema) in messages.MESSAGE_SCHEMAS.items():
+            frame = messages._pack_message(message_type, *[SAMPLES[kind] for kind in schema])
+            for end in range(len(frame)):
+                try:
+                    messages._unpack_message(frame[:end])
+                except messages.ProtocolError:
+                    pass
+
+    def test_unknown_version_and_type(self):
+        frame = bytearray(messages.getFile('k', 1))
+        frame[5] = 99
+        self.assertRaises(messages.ProtocolError, messages._unpack_message, bytes(frame))
+        self.assertRaises(messages.ProtocolError, messages._unpack_message, b'\x77\x00\x00\x00\x01\x02')
+
+    def test_split_frames_keeps_partial_frame(self):
+        frames = [messages.getFile('a', 1), messages.okMessage(1, 2)]
+        buf = bytearray(b''.join(frames) + frames[0][:7])
+        self.assertEqual(messages._split_frames(buf), frames)
+        self.assertEqual(bytes(buf), frames[0][:7])
+
+    def test_split_frames_rejects_invalid_lengths(self):
+        for length in (b'\xff\xff\xff\xfb', b'\x00\x00\x00\x00', struct.pack('!I', messages.MAX_FRAME + 1)):
+            buf = bytearray(b'\x08' + length + b'\x02')
+            self.assertRaises(messages.ProtocolError, messages._split_frames, buf)
+            self.assertRaises(messages.ProtocolError, messages._get_payload_len, length)
+        self.assertEqual(messages._get_payload_len(struct.pack('!I', messages.MAX_FRAME)), messages.MAX_FRAME)
+
+
+class TestValidClock(unittest.TestCase):
+
+    def test_valid(self):
+        for clock in (None, {}, CLOCK, {'a': 0, 'b': codec.MAX_COUNTER - 1}):
+            self.assertTrue(codec.valid_clock(clock), clock)
+
+    def test_invalid(self):
+        for clock in ([1], 'a', {'a': -1}, {'a': codec.MAX_COUNTER}, {'a': 2 ** 33}, {'a': 1.0}, {'a': True},
+                      {'a': '1'}, {1: 1}, {'a\x00b': 1}, {'\ud800': 1}):
+            self.assertFalse(codec.valid_clock(clock), clock)
+
+    def test_valid_clock_encodes_after_increment(self):
+        clock = {'a': codec.MAX_COUNTER - 1}
+        clock['a'] += 1
+        self.assertEqual(messages._unpack_message(messages.storeFile('k', 'v', clock, 1))[1][2], clock)
+
+
+if __name__ == '__main__':
+    unittest.main()
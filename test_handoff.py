@@ -0,0 +1,277 @@
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+import unittest
+from collections import defaultdict
+
+import messages
+from handoff import HandoffStore, HintLog
+from scheduler import Scheduler
+
+
+class TestHintLog(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'node2.log')
+        self.offset_path = os.path.join(self.dir, 'node2.offset')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self):
+        return HintLog(self.path, fsync=False)
+
+    def fill(self, count, value=b'value'):
+        log = self.open()
+        for n in range(count):
+            log.append('key%d' % n, {'n1': n + 1}, value)
+        log.close()
+
+    def keys(self, log, max_hints=1000):
+        return [key for (key, _) in log.read(max_hints)[0]]
+
+    def saved_offset(self):
+        with open(self.offset_path) as f:
+            return int(f.read())
+
+    def test_replay_after_restart(self):
+        self.fill(5)
+        log = self.open()
+        try:
+            self.assertEqual(log.count, 5)
+            self.assertEqual(log.pending_bytes, os.path.getsize(self.path))
+            items, end = log.read(2)
+            self.assertEqual(items, [['key0', [[{'n1': 1}, b'value']]], ['key1', [[{'n1': 2}, b'value']]]])
+            self.assertEqual(self.keys(log), ['key%d' % n for n in range(5)])
+        finally:
+            log.close()
+
+    def test_torn_tail_is_truncated(self):
+        self.fill(5)
+        size = os.path.getsize(self.path)
+        with open(self.path, 'r+b') as f:
+            f.truncate(size - 3)
+
+        log = self.open()
+        self.assertEqual(log.count, 4)
+        self.assertEqual(os.path.getsize(self.path), log.size)
+        log.append('after', {'n1': 9}, b'x')
+        log.close()
+
+        log = self.open()
+        try:
+            self.assertEqual(self.keys(log), ['key0', 'key1', 'key2', 'key3', 'after'])
+        finally:
+            log.close()
+
+    def test_corrupt_record_ends_the_log(self):
+        self.fill(5)
+        log = self.open()
+        third = log.read(2)[1]
+        log.close()
+        with open(self.path, 'r+b') as f:  # flip a byte of the value of key2
+            f.seek(third + 20)
+            byte = f.read(1)
+            f.seek(third + 20)
+            f.write(bytes([byte[0] ^ 0xff]))
+
+        log = self.open()
+        try:
+            self.assertEqual(log.count, 2)
+            self.assertEqual(self.keys(log), ['key0', 'key1'])
+            self.assertEqual(os.path.getsize(self.path), third)
+        finally:
+            log.close()
+
+    def test_checkpoint_saves_the_offset(self):
+        self.fill(5)
+        log = self.open()
+        end = log.read(2)[1]
+        log.checkpoint(end, 2)
+        self.assertEqual(self.saved_offset(), end)
+        self.assertEqual(log.count, 3)
+        self.assertEqual(self.keys(log), ['key2', 'key3', 'key4'])
+        log.close()
+
+        log = self.open()
+        try:
+            self.assertEqual(log.offset, end)
+            self.assertEqual(log.count, 3)
+            self.assertEqual(self.keys(log), ['key2', 'key3', 'key4'])
+        finally:
+            log.close()
+
+    def test_checkpoint_of_everything_empties_the_log(self):
+        self.fill(3)
+        log = self.open()
+        log.checkpoint(log.read(10)[1], 3)
+        self.assertEqual((log.count, log.offset, log.size), (0, 0, 0))
+        self.assertEqual(self.saved_offset(), 0)
+        self.assertEqual(os.path.getsize(self.path), 0)
+        log.append('next', {'n1': 1}, b'x')
+        log.close()
+
+        log = self.open()
+        try:
+            self.assertEqual(self.keys(log), ['next'])
+        finally:
+            log.close()
+
+    def test_offset_past_the_end(self):
+        # the log was emptied after the offset was saved
+        self.fill(3)
+        with open(self.offset_path, 'w') as f:
+            f.write(str(os.path.getsize(self.path) + 100))
+        log = self.open()
+        try:
+            self.assertEqual(log.offset, 0)
+            self.assertEqual(log.count, 3)
+        finally:
+            log.close()
+
+    def test_rewrite_after_most_was_delivered(self):
+        # checkpoints past 4 MB and half the log rewrite it from the offset
+        self.fill(80, b'v' * (64 << 10))
+        log = self.open()
+        size = log.size
+        end = log.read(70)[1]
+        log.checkpoint(end, 70)
+        self.assertEqual(self.saved_offset(), 0)
+        self.assertEqual(log.offset, 0)
+        self.assertEqual(log.size, size - end)
+        self.assertEqual(os.path.getsize(self.path), size - end)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+        self.assertEqual(self.keys(log), ['key%d' % n for n in range(70, 80)])
+        log.append('after', {'n1': 1}, b'x')
+        log.close()
+
+        log = self.open()
+        try:
+            self.assertEqual(log.count, 11)
+            self.assertEqual(self.keys(log), ['key%d' % n for n in range(70, 80)] + ['after'])
+        finally:
+            log.close()
+
+
+class TestHandoffStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.now = 0.0
+        self.scheduler = Scheduler(clock=lambda: self.now)
+        self.sent = []
+        self.failing = set()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def send(self, hosts, frame):
+        self.sent.append((hosts[0], messages._unpack_message(frame)[1]))
+        return [host for host in hosts if host in self.failing]
+
+    def open(self, **kwargs):
+        return HandoffStore(self.dir, self.scheduler, self.send, fsync=False, **kwargs)
+
+    def advance(self, seconds):
+        self.now += seconds
+        self.scheduler.run_due()
+
+    def test_delivery_and_ack(self):
+        store = self.open(batch_size=2)
+        store.add('a', {'n1': 1}, b'1', ['node2'])
+        store.add('b', {'n1': 1}, b'2', ['node2'])
+        store.add('c', {'n1': 1}, b'3', ['node2'])
+        self.advance(0)
+
+        self.assertEqual(len(self.sent), 1)
+        (host, (transfer_id, seq, items)) = self.sent[0]
+        self.assertEqual(host, 'node2')
+        self.assertEqual([item[0] for item in items], ['a', 'b'])
+        self.assertTrue(store.handle_ack(transfer_id, seq, 'node2'))
+        self.assertFalse(store.handle_ack(transfer_id, seq, 'node2'))
+        self.advance(0)
+
+        (_, (transfer_id, seq, items)) = self.sent[1]
+        self.assertEqual([item[0] for item in items], ['c'])
+        self.assertTrue(store.handle_ack(transfer_id, seq, 'node2'))
+        self.assertEqual(store.stats()['hosts'], {})
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_restart_resumes_from_the_offset(self):
+        store = self.open(batch_size=2)
+        for key in 'abc':
+            store.add(key, {'n1': 1}, b'x', ['node2'])
+        self.advance(0)
+        (_, (transfer_id, seq, _)) = self.sent[0]
+        store.handle_ack(transfer_id, seq, 'node2')
+        for log in store.logs.values():
+            log.close()
+
+        self.sent = []
+        self.open(batch_size=2)
+        self.advance(0)
+        self.assertEqual([item[0] for item in self.sent[0][1][2]], ['c'])
+
+    def test_failed_delivery_backs_off(self):
+        self.failing.add('node2')
+        store = self.open(min_backoff=1.0, max_backoff=4.0)
+        store.add('a', {'n1': 1}, b'x', ['node2'])
+        self.advance(0)
+        self.assertEqual(len(self.sent), 1)
+        self.advance(0.5)
+        self.assertEqual(len(self.sent), 1)
+        self.advance(0.5)
+        self.assertEqual(len(self.sent), 2)
+        self.advance(2)
+        self.assertEqual(len(self.sent), 3)
+
+        self.failing.clear()
+        self.advance(4)
+        (_, (transfer_id, seq, items)) = self.sent[-1]
+        self.assertEqual([item[0] for item in items], ['a'])
+        self.assertTrue(store.handle_ack(transfer_id, seq, 'node2'))
+        self.assertEqual(store.stats()['hosts'], {})
+
+    def test_migrate_pickle_file(self):
+        def store_file_v0(name, value, context, stamp):  # storeFile of the first protocol
+            data = pickle.dumps((name, value, context, stamp))
+            return b'\x07' + struct.pack('!i', len(data)) + data
+
+        old = defaultdict(set)
+        old['10.0.0.2'].add(store_file_v0('a', 'one', None, 1.5))
+        old['10.0.0.2'].add(store_file_v0('b', 'two', {'10.0.0.1': 1, '10.0.0.3': 2}, 2.5))
+        old['10.0.0.3'].add(store_file_v0('a', 'one', None, 1.5))
+        old['10.0.0.3'].add(b'\x07\x00\x00\x00\x03bad')
+        pickle_path = os.path.join(self.dir, 'node1.pickle')
+        with open(pickle_path, 'wb') as f:
+            f.write(pickle.dumps(old))
+
+        store = self.open(batch_size=10)
+        store.migrate(pickle_path, '10.0.0.1')
+        self.assertFalse(os.path.exists(pickle_path))
+        self.assertEqual({host: stats['hints'] for (host, stats) in store.stats()['hosts'].items()},
+                         {'10.0.0.2': 2, '10.0.0.3': 1})
+        self.advance(0)
+        sent = {host: sorted(items) for (host, (_, _, items)) in self.sent}
+        self.assertEqual(sent, {
+            '10.0.0.2': [['a', [[{'10.0.0.1': 1}, b'one']]], ['b', [[{'10.0.0.1': 2, '10.0.0.3': 2}, b'two']]]],
+            '10.0.0.3': [['a', [[{'10.0.0.1': 1}, b'one']]]],
+        })
+
+    def test_cap_drops_the_oldest_hints(self):
+        store = self.open(max_bytes=1000)
+        for n in range(10):
+            store.add('key%d' % n, {'n1': 1}, b'v' * 200, ['node2'])
+        self.assertGreater(store.shed, 0)
+        self.assertLessEqual(store.stats()['hosts']['node2']['bytes'], 1000)
+        self.advance(0)
+        keys = [item[0] for item in self.sent[0][1][2]]
+        self.assertEqual(keys[-1], 'key9')
+        self.assertNotIn('key0', keys)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import messages
+from merkle import MerkleIndex, MerkleTree, version_digest
+from node import Node
+from pool import Connection
+from ring import HASH_SPACE, Ring
+
+
+class TestMerkleTree(unittest.TestCase):
+
+    def test_leaves_split_the_range(self):
+        tree = MerkleTree(100, 100 + 1024, depth=2)
+        self.assertEqual([tree.leaf_of(p) for p in (100, 355, 356, 612, 868, 1123)], [0, 0, 1, 2, 3, 3])
+
+        # a range that wraps around the top of the hash space
+        tree = MerkleTree(HASH_SPACE - 512, 512, depth=1)
+        self.assertEqual([tree.leaf_of(p) for p in (HASH_SPACE - 100, 0, 1, 511)], [0, 1, 1, 1])
+
+    def test_update_and_remove(self):
+        tree = MerkleTree(0, HASH_SPACE, depth=3)
+        tree.update('a', 10, {'n1': 1}, True)
+        tree.update('a', 10, {'n2': 1}, True)
+        self.assertEqual(tree.hashes[0], version_digest('a', {'n1': 1}) ^ version_digest('a', {'n2': 1}))
+        self.assertEqual(tree.leaf_keys(tree.first_leaf), ['a'])
+
+        tree.update('a', 10, {'n1': 1}, False)
+        self.assertEqual(tree.key_digests([tree.first_leaf]), {'a': version_digest('a', {'n2': 1})})
+        tree.update('a', 10, {'n2': 1}, False)
+        self.assertEqual(tree.hashes, [0] * len(tree.hashes))
+        self.assertEqual(tree.leaf_keys(tree.first_leaf), [])
+
+    def test_diff(self):
+        one, other = MerkleTree(0, HASH_SPACE, depth=2), MerkleTree(0, HASH_SPACE, depth=2)
+        for tree in (one, other):
+            tree.update('a', 1, {'n1': 1}, True)
+            tree.update('b', HASH_SPACE - 1, {'n1': 1}, True)
+        other.update('b', HASH_SPACE - 1, {'n1': 2}, True)
+
+        self.assertEqual(one.diff([0], other.hashes[:1]), ([0], []))
+        children = list(one.children(0))
+        self.assertEqual(one.diff(children, [other.hashes[i] for i in children]), ([2], []))
+        leaves = list(one.children(2))
+        self.assertEqual(one.diff(leaves, [other.hashes[i] for i in leaves]), ([], [6]))
+
+        digests = other.key_digests([6])
+        self.assertEqual(one.diff_keys([6], list(digests), list(digests.values())), ['b'])
+        self.assertEqual(one.diff_keys([6], [], []), ['b'])  # the other replica has no keys there
+        self.assertEqual(one.diff_keys([4], [], []), [])
+
+
+class TestMerkleIndex(unittest.TestCase):
+
+    def test_trees_of_the_replicated_ranges(self):
+        ring = Ring(vnode_count=8, replica_count=1)
+        for host in ('n1', 'n2', 'n3'):
+            ring[host] = host
+        index = MerkleIndex(ring, 'n1', depth=4)
+        index.rebuild([])
+
+        self.assertEqual(sorted(index.trees), sorted((start, end) for (start, end, _) in ring.get_replicated_ranges('n1')))
+        for n in range(300):
+            key = 'key%d' % n
+            tree = index.tree_of(ring.key_position(key))
+            self.assertEqual(tree is not None, 'n1' in ring.get_preference_list(key), key)
+            if tree is not None:
+                self.assertIn('n1', index.preference[(tree.start, tree.end)])
+
+    def test_apply_and_rebuild_agree(self):
+        ring = Ring(vnode_count=8, replica_count=1)
+        for host in ('n1', 'n2', 'n3'):
+            ring[host] = host
+        stored = [('key%d' % n, [{'n1': n % 3 + 1}], 0) for n in range(200)]
+
+        index = MerkleIndex(ring, 'n1', depth=4)
+        index.rebuild([])
+        for (key, clocks, _) in stored:
+            index.apply(key, [{'n1': 9}], [])
+            index.apply(key, clocks, [{'n1': 9}])
+        rebuilt = MerkleIndex(ring, 'n1', depth=4)
+        rebuilt.rebuild(stored)
+        self.assertEqual({r: tree.hashes for (r, tree) in index.trees.items()},
+                         {r: tree.hashes for (r, tree) in rebuilt.trees.items()})
+
+
+class Network(object):
+    """Pools of nodes in one process, frames are delivered by pump()"""
+
+    def __init__(self):
+        self.nodes = {}
+        self.queue = []
+        self.sent = []  # (message type, message) of every frame
+
+    def pool(self, hostname):
+        network = self
+
+        class Pool(object):
+            def send(self, name, msg):
+                network.queue.append((hostname, name, msg))
+                return True
+
+            def adopt(self, conn):
+                pass
+
+        return Pool()
+
+    def pump(self):
+        while self.queue:
+            (source, target, msg) = self.queue.pop(0)
+            self.sent.append(messages._unpack_message(msg))
+            self.nodes[target]._receive(msg, Connection(None, (source, 13337)))
+
+
+class TestAntiEntropy(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.network = Network()
+        hosts = ('127.0.0.1', '127.0.0.2')
+        for host in hosts:
+            node = Node(True, host, host, tcp_port=0, synchronous='OFF', anti_entropy_interval=1000,
+                        sloppy_Qsize=2, read_repair_rate=0)
+            node.pool = self.network.pool(host)
+            self.network.nodes[host] = node
+        for (host, node) in self.network.nodes.items():
+            for other in hosts:
+                if other not in node.membership_ring:
+                    node.membership_ring.add_node(other)
+            node.merkle.rebuild(node.db.scan())
+
+    def tearDown(self):
+        for node in self.network.nodes.values():
+            node.tcp_socket.close()
+            node.db.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def contents(self, node):
+        return {key: sorted(map(repr, node.db.getFile(key))) for (key, _, _) in node.db.scan()}
+
+    def test_replicas_converge(self):
+        a, b = self.network.nodes['127.0.0.1'], self.network.nodes['127.0.0.2']
+        for n in range(2000):
+            for node in (a, b):
+                node.db.storeFile('key%d' % n, 'w', None, 'v%d' % n)
+        a.db.storeFile('only-a', 'w', None, 'x')
+        b.db.storeFile('only-b', 'w', None, 'y')
+        b.db.storeFile('key7', 'w', {'w': 1}, 'newer')
+        a.db.storeFile('key8', 'other', None, 'sibling')
+        b.db.remFile('key9')  # lost on b
+
+        a.anti_entropy()
+        self.network.pump()
+
+        self.assertEqual(self.contents(a), self.contents(b))
+        self.assertEqual(a.db.getFile('key7'), [[{'w': 2}, b'newer']])
+        self.assertEqual(len(b.db.getFile('key8')), 2)
+        self.assertEqual(a.db.getFile('only-b'), [[{'w': 1}, b'y']])
+
+        # only the versions of the keys that differ were sent
+        versions = [key for (message_type, message) in self.network.sent if message_type == b'\x0F'
+                    for (key, _) in message[4]]
+        self.assertEqual(sorted(versions), ['key7', 'key7', 'key8', 'key8', 'key9', 'only-a', 'only-b'])
+
+        # in sync now, one more round only exchanges the root hash of each range
+        self.network.sent = []
+        a.anti_entropy()
+        self.network.pump()
+        self.assertEqual([message_type for (message_type, _) in self.network.sent], [b'\x0E'] * len(a.merkle.trees))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import codec
+import messages
+from node import Node
+from pool import Connection
+from test_codec import SAMPLES
+
+
+class FakePool(object):
+    """Records the frames a node sends instead of opening connections"""
+
+    def __init__(self):
+        self.sent = []
+        self.down = set()
+
+    def send(self, name, msg):
+        if name in self.down:
+            return False
+        self.sent.append((name, messages._unpack_message(msg)))
+        return True
+
+    def adopt(self, conn):
+        pass
+
+    def report(self):
+        return {}
+
+
+class NodeTestCase(unittest.TestCase):
+    """A one node cluster on 127.0.0.1 in a temporary directory, with a FakePool"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.node = Node(True, '127.0.0.1', '127.0.0.1', tcp_port=0, synchronous='OFF', anti_entropy_interval=0,
+                         sloppy_Qsize=1, sloppy_R=1, sloppy_W=1, batch_window=0)
+        self.node.pool = self.pool = FakePool()
+        self.now = time.monotonic()
+        self.node.scheduler.clock = lambda: self.now
+        self.node.scheduler.run_due()
+        self.client = Connection(None, ('127.0.0.1', 40000))
+
+    def tearDown(self):
+        self.node.tcp_socket.close()
+        self.node.db.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def receive(self, frame, conn=None):
+        self.node._receive(frame, conn or self.client)
+
+    def advance(self, seconds):
+        self.now += seconds
+        self.node.scheduler.run_due()
+
+    def replies(self):
+        """Client responses sent since the last call"""
+        replies = [message for (_, (message_type, message)) in self.pool.sent if message_type == b'\x0B']
+        self.pool.sent = []
+        return replies
+
+
+class TestMalformedFrames(NodeTestCase):
+
+    def assert_alive(self):
+        self.receive(messages.client_message('put k null v'))
+        self.receive(messages.client_message('get k'))
+        self.assertEqual(self.pool.sent[-1], ('127.0.0.1:40000', (b'\x40', ('k', [[{'127.0.0.1': 1}, b'v']]))))
+
+    def test_messages_without_a_handler_are_dropped(self):
+        for message_type in (b'\x02', b'\x09', b'\x0B', b'\x15', b'\x30', b'\x40', b'\x41'):
+            schema = messages.MESSAGE_SCHEMAS[message_type]
+            self.receive(messages._pack_message(message_type, *[SAMPLES[kind] for kind in schema]))
+        self.receive(b'\x77\x00\x00\x00\x01\x02')
+        self.assert_alive()
+
+    def test_fields_of_the_wrong_shape_are_dropped(self):
+        for message_type in (b'\x05', b'\x0F', b'\x13', b'\x21', b'\x31'):
+            schema = messages.MESSAGE_SCHEMAS[message_type]
+            for value in (None, 5, ['x'], [[None]], {'k': 1}):
+                fields = [value if kind == 'any' else SAMPLES[kind] for kind in schema]
+                self.receive(messages._pack_message(message_type, *fields))
+        self.assert_alive()
+
+    def test_undecodable_frames_are_dropped(self):
+        def frame(message_type, any_payload):
+            payload = bytes([messages.PROTOCOL_VERSION]) + b'\x00' * 8 + any_payload
+            return message_type + len(payload).to_bytes(4, 'big') + payload
+
+        nested = b'l\x00\x00\x00\x01' * (codec.MAX_DEPTH + 2) + b'N'
+        list_key = b'd\x00\x00\x00\x01' + b'l\x00\x00\x00\x00' + b'N'
+        list_in_set = b'S\x00\x00\x00\x01' + b'l\x00\x00\x00\x00'
+        for payload in (nested, list_key, list_in_set, b'\x99'):
+            for message_type in (b'\x21', b'\x13'):
+                self.assertRaises(messages.ProtocolError, messages._unpack_message, frame(message_type, payload))
+                self.receive(frame(message_type, payload))
+
+        for payload in (messages.ringRequest(), messages.okMessage(1, 2)):  # not storeFile/getFile frames
+            self.receive(messages.batch([payload]))
+            self.receive(messages.batchResponse([payload]))
+        self.assert_alive()
+
+    def test_bad_commands_are_answered(self):
+        self.receive(messages.client_message(''))
+        self.receive(messages.client_message('nope'))
+        self.receive(messages.client_message('put k'))
+        self.receive(messages.client_message('get'))
+        self.assertEqual(self.replies(), ["User input empty", "Invalid command",
+                                          "Error: Invalid operands\nInput: (<key>,<prev version>,<value>)",
+                                          "Error: key required"])
+        self.assert_alive()
+
+
+class TestMultiKey(NodeTestCase):
+    """mget and mput over three coordinators, node2 and node3 only exist in the ring"""
+
+    def setUp(self):
+        NodeTestCase.setUp(self)
+        ring = self.node.membership_ring
+        ring['node2'] = 'node2'
+        ring['node3'] = 'node3'
+        keys = ['key%d' % n for n in range(100)]
+        self.keys = {host: [key for key in keys if ring[key] == host][:2] for host in ('127.0.0.1', 'node2', 'node3')}
+        self.peer = Connection(None, ('10.0.0.2', 13337))
+
+    def sub_requests(self):
+        """(coordinator, id, items) of the mget/mput messages sent since the last call"""
+        sent = [(name, message) for (name, (message_type, message)) in self.pool.sent if message_type in (b'\x12', b'\x13')]
+        self.pool.sent = [item for item in self.pool.sent if item[1][0] not in (b'\x12', b'\x13')]
+        return sorted((name, multi_id, items) for (name, (multi_id, items)) in sent)
+
+    def test_mget_with_partial_answers(self):
+        mine, node2, node3 = self.keys['127.0.0.1'], self.keys['node2'], self.keys['node3']
+        self.receive(messages.client_message('put %s null local' % mine[0]))
+        self.receive(messages.client_message('mget ' + ' '.join(mine + node2 + node3)))
+
+        (sub2, sub3) = self.sub_requests()
+        self.assertEqual(sub2[0::2], ('node2', node2))
+        self.assertEqual(sub3[0::2], ('node3', node3))
+
+        # node2 answers for one of its keys and times out the other, node3 answers in full
+        self.receive(messages.mgetResponse(sub2[1], {node2[0]: [[{'n2': 1}, b'two']], node2[1]: "Error: timed out"}), self.peer)
+        self.receive(messages.mgetResponse(sub3[1], {key: [] for key in node3}), self.peer)
+        results = self.replies()[-1]
+        self.assertEqual(results, {mine[0]: [[{'127.0.0.1': 1}, b'local']], mine[1]: [],
+                                   node2[0]: [[{'n2': 1}, b'two']], node2[1]: "Error: timed out",
+                                   node3[0]: [], node3[1]: []})
+
+        self.advance(10)  # the answered sub-requests do not time out
+        self.assertEqual(self.sub_requests(), [])
+        self.assertEqual(self.replies(), [])
+
+    def test_silent_coordinator_keys_are_coordinated_here(self):
+        node2, node3 = self.keys['node2'], self.keys['node3']
+        items = ' '.join('%s null v-%s' % (key, key) for key in node2 + node3)
+        self.receive(messages.client_message('mput ' + items))
+        (sub2, sub3) = self.sub_requests()
+        self.receive(messages.mputResponse(sub3[1], {key: 'v-' + key for key in node3}), self.peer)
+
+        # node2 never answers
+        self.advance(self.node.request_timelimit)
+        self.assertEqual(self.replies(), [])
+        self.advance(1)
+        # node2 is still sent its copies, it may only be slow
+        self.assertEqual([name for (name, (message_type, _)) in self.pool.sent if message_type == b'\x07'], ['node2'] * 2)
+        results = self.replies()[-1]
+        self.assertEqual(results, {key: 'v-' + key for key in node2 + node3})
+        self.assertEqual(self.node.db.getFile(node2[0]), [[{'127.0.0.1': 1}, ('v-' + node2[0]).encode()]])
+        self.assertEqual(self.node.db.getFile(node3[0]), [])  # node3 stored it
+
+        # a late answer of node2 is dropped
+        self.receive(messages.mputResponse(sub2[1], {node2[0]: 'late'}), self.peer)
+        self.assertEqual(self.replies(), [])
+
+    def test_unreachable_coordinator_keys_are_coordinated_at_once(self):
+        self.pool.down.add('node2')
+        node2 = self.keys['node2']
+        self.receive(messages.client_message('mget ' + ' '.join(node2)))
+        self.assertEqual(self.sub_requests(), [])
+        self.assertEqual(self.replies()[-1], {key: [] for key in node2})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+import asyncio
+import queue
+import socket
+import threading
+import time
+import unittest
+
+from pool import AsyncConnectionPool, ConnectionPool
+
+
+def closed_port():
+    """A local port nothing listens on"""
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.005)
+
+
+class BlockingSocket(object):
+    """A client socket whose sendall waits until release()"""
+
+    def __init__(self, blocked=True):
+        self.data = []
+        self._released = threading.Event()
+        if not blocked:
+            self._released.set()
+
+    def sendall(self, msg):
+        self._released.wait()
+        self.data.append(msg)
+
+    def release(self):
+        self._released.set()
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        self._released.set()
+
+
+class PoolTestCase(unittest.TestCase):
+
+    def pool(self, cls, *args, **kwargs):
+        pool = cls(*args, **kwargs)
+        self.addCleanup(pool.wakeup_socket.close)
+        self.addCleanup(pool._wakeup_writer.close)
+        return pool
+
+
+class TestBackoff(PoolTestCase):
+
+    def test_failed_connects_back_off_exponentially(self):
+        pool = self.pool(ConnectionPool, closed_port(), lambda name: name, backoff_base=0.5, backoff_max=3.0)
+        stats = pool.stats['127.0.0.1']
+        delays = []
+        for _ in range(5):
+            stats.retry_at = 0
+            self.assertIsNone(pool._connect('127.0.0.1'))
+            delays.append(round(stats.retry_at - time.time(), 1))
+        self.assertEqual(delays, [0.5, 1.0, 2.0, 3.0, 3.0])
+        self.assertEqual(stats.failures, 5)
+
+        # no connect is tried while backing off, sends are dropped at once
+        self.assertIsNone(pool._connect('127.0.0.1'))
+        self.assertEqual(stats.errors, 5)
+        self.assertFalse(pool.send('127.0.0.1', b'msg'))
+        self.assertNotIn('127.0.0.1', pool._queues)
+
+    def test_connect_resets_the_backoff(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        pool = self.pool(ConnectionPool, listener.getsockname()[1], lambda name: name)
+        stats = pool.stats['127.0.0.1']
+        stats.failures, stats.retry_at = 3, time.time() - 1
+
+        conn = pool._connect('127.0.0.1')
+        self.addCleanup(pool.remove, conn)
+        self.assertIs(pool._lookup('127.0.0.1')[1], conn)
+        self.assertEqual((stats.failures, stats.retry_at, stats.connects), (0, 0, 1))
+
+
+class TestQueues(PoolTestCase):
+
+    def test_full_peer_queue_drops_messages(self):
+        pool = self.pool(ConnectionPool, closed_port(), lambda name: name, queue_size=2)
+        pool._queues['10.0.0.2'] = queue.Queue(2)  # no writer thread drains it
+        self.assertEqual([pool.send('10.0.0.2', b'%d' % n) for n in range(4)], [True, True, False, False])
+        self.assertEqual(pool.stats['10.0.0.2'].errors, 2)
+        self.assertEqual(pool.report()['10.0.0.2']['queued'], 2)
+
+    def test_full_client_queue_drops_replies(self):
+        pool = self.pool(ConnectionPool, closed_port(), lambda name: name, queue_size=3)
+        client = BlockingSocket()
+        conn = pool.add(client, ('127.0.0.1', 40000))
+
+        self.assertTrue(pool.send(conn.client_id, b'a'))
+        wait_for(lambda: not conn.pending)  # a writer thread is in sendall
+        self.assertEqual([pool.send(conn.client_id, msg) for msg in (b'b', b'c', b'd', b'e')], [True, True, True, False])
+        self.assertEqual(pool.stats['clients'].errors, 1)
+
+        client.release()
+        wait_for(lambda: len(client.data) == 2)
+        self.assertEqual(client.data, [b'a', b'bcd'])
+        self.assertEqual(pool.stats['clients'].sends, 4)
+
+    def test_clients_share_the_writer_threads(self):
+        pool = self.pool(ConnectionPool, closed_port(), lambda name: name, client_writers=2)
+        stuck = pool.add(BlockingSocket(), ('127.0.0.1', 40000))
+        clients = [BlockingSocket(blocked=False) for _ in range(20)]
+        conns = [pool.add(client, ('127.0.0.1', 40001 + n)) for (n, client) in enumerate(clients)]
+
+        self.assertTrue(pool.send(stuck.client_id, b'x'))
+        for _ in range(3):
+            for conn in conns:
+                self.assertTrue(pool.send(conn.client_id, b'y'))
+
+        # a client that stopped reading does not hold back the others
+        wait_for(lambda: all(b''.join(client.data) == b'yyy' for client in clients))
+        self.assertEqual(len([t for t in threading.enumerate() if t.name == 'client writer']), 2)
+
+        pool.remove(stuck)
+        self.assertFalse(pool.send(stuck.client_id, b'x'))
+
+
+class StreamWriter(object):
+    """A client StreamWriter whose drain() waits until release()"""
+
+    def __init__(self):
+        self.data = []
+        self.released = asyncio.Event()
+        self.closed = False
+
+    def write(self, msg):
+        self.data.append(msg)
+
+    async def drain(self):
+        await self.released.wait()
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+class TestAsyncClientReplies(PoolTestCase):
+
+    def test_replies_wait_for_drain(self):
+        async def run():
+            pool = self.pool(AsyncConnectionPool, None, closed_port(), lambda name: name, queue_size=2)
+            writer = StreamWriter()
+            conn = pool.add(writer, ('127.0.0.1', 40000))
+
+            self.assertEqual([pool.send(conn.client_id, msg) for msg in (b'a', b'b', b'c')], [True, True, False])
+            await asyncio.sleep(0)
+            self.assertEqual(writer.data, [b'a'])  # b waits until a is drained
+            self.assertTrue(pool.send(conn.client_id, b'd'))
+            self.assertFalse(pool.send(conn.client_id, b'e'))
+
+            writer.released.set()
+            for _ in range(5):
+                await asyncio.sleep(0)
+            self.assertEqual(writer.data, [b'a', b'b', b'd'])
+            self.assertEqual((pool.stats['clients'].sends, pool.stats['clients'].errors), (3, 2))
+
+            pool.remove(conn)
+            self.assertFalse(pool.send(conn.client_id, b'f'))
+
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
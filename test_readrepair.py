@@ -0,0 +1,90 @@
+import unittest
+
+import messages
+from readrepair import ReadRepair
+from scheduler import Scheduler
+
+
+class TestReadRepair(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.scheduler = Scheduler(clock=lambda: self.now)
+        self.sent = []  # (host, [key, versions] items)
+        self.stored = []  # (key, versions)
+        self.failing = set()
+
+    def send(self, hosts, frame):
+        (transfer_id, seq, items) = messages._unpack_message(frame)[1]
+        self.assertEqual((transfer_id, seq), (0, 0))
+        self.sent.append((hosts[0], items))
+        return [host for host in hosts if host in self.failing]
+
+    def repair(self, **kwargs):
+        return ReadRepair(self.scheduler, self.send, lambda key, versions: self.stored.append((key, versions)),
+                          'me', **kwargs)
+
+    def advance(self, seconds):
+        self.now += seconds
+        self.scheduler.run_due()
+
+    def versions_sent(self):
+        count = sum(len(versions) for (_, items) in self.sent for (_, versions) in items)
+        self.sent = []
+        return count
+
+    def test_missing_versions_are_sent(self):
+        repair = self.repair()
+        new, old, other = [{'a': 2}, b'new'], [{'a': 1}, b'old'], [{'b': 1}, b'other']
+        repair.check('k', {'n1': [new], 'n2': [old], 'n3': [new, other], 'me': []})
+        self.advance(0.1)
+        self.assertEqual(sorted(self.sent), [('n1', [['k', [other]]]), ('n2', [['k', [new, other]]])])
+        self.assertEqual(self.stored, [('k', [new, other])])
+        self.assertEqual(repair.stats()['repaired'], 5)
+
+    def test_same_clock_is_not_repaired(self):
+        repair = self.repair()
+        repair.check('k', {'n1': [[{'a': 1}, b'x']], 'n2': [[{'a': 1}, b'y']]})
+        self.advance(1)
+        self.assertEqual(self.sent, [])
+
+    def test_budget_counts_versions(self):
+        repair = self.repair(rows_per_sec=100, interval=0.1)
+        many = [[{'w%d' % i: 1}, b'v'] for i in range(25)]
+        repair.check('big', {'n1': many, 'n2': []})
+        repair.check('small', {'n1': many[:1], 'n2': many[:1], 'n3': []})
+
+        counts = []
+        for _ in range(4):
+            self.advance(0.1)
+            counts.append(self.versions_sent())
+        self.assertEqual(counts, [10, 10, 6, 0])
+        self.assertEqual(repair.stats()['queued'], 0)
+
+    def test_low_rate_flushes_less_often(self):
+        repair = self.repair(rows_per_sec=2, interval=0.1)
+        repair.check('k', {'n1': [[{'w%d' % i: 1}, b'v'] for i in range(4)], 'n2': []})
+        sent = []
+        for _ in range(10):
+            self.advance(0.25)
+            sent.append(self.versions_sent())
+        self.assertEqual(sent, [0, 1, 0, 1, 0, 1, 0, 1, 0, 0])
+
+    def test_failed_sends_are_not_counted(self):
+        self.failing.add('n2')
+        repair = self.repair()
+        repair.check('k', {'n1': [[{'a': 1}, b'x']], 'n2': []})
+        self.advance(0.1)
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(repair.stats()['repaired'], 0)
+
+    def test_full_queue_drops_repairs(self):
+        repair = self.repair(max_queued=2)
+        for n in range(5):
+            repair.check('k%d' % n, {'n1': [[{'a': 1}, b'x']], 'n2': []})
+        self.assertEqual(repair.stats()['dropped'], 3)
+        self.assertEqual(repair.stats()['queued'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
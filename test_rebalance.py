@@ -0,0 +1,150 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import messages
+from rebalance import Rebalancer
+from ring import Ring
+from scheduler import Scheduler
+from storage import Storage
+
+OLD = ['n1', 'n2', 'n3']
+NEW = ['n1', 'n2', 'n3', 'n4']
+KEYS = ['key%03d' % n for n in range(300)]
+
+
+def make_ring(hosts):
+    ring = Ring(vnode_count=8, replica_count=1)
+    for host in hosts:
+        ring[host] = host
+    return ring
+
+
+class TestRebalancer(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = Storage(os.path.join(self.dir, 'node.db'), synchronous='OFF')
+        for key in KEYS:
+            self.db.storeFile(key, 'w', None, 'v-' + key)
+        self.progress_path = os.path.join(self.dir, 'node.rebalance')
+
+        self.now = 0.0
+        self.scheduler = Scheduler(clock=lambda: self.now)
+        self.sent = []  # (host, transfer id, seq, keys)
+        self.failing = set()
+
+        # the keys n1 sends: it is the first old holder still a member and n4 gained them
+        old_ring, new_ring = make_ring(OLD), make_ring(NEW)
+        self.expected = [key for key in KEYS if old_ring.get_preference_list(key)[0] == 'n1'
+                         and 'n4' in new_ring.get_preference_list(key)]
+        self.assertTrue(len(self.expected) > 5)
+        self.db.storeFile(self.expected[0], 'other', None, 'sibling')
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def send(self, hosts, frame):
+        (transfer_id, seq, items) = messages._unpack_message(frame)[1]
+        self.sent.extend((host, transfer_id, seq, [key for (key, _) in items]) for host in hosts)
+        return [host for host in hosts if host in self.failing]
+
+    def rebalancer(self, **kwargs):
+        kwargs.setdefault('scan_batch', 50)
+        return Rebalancer(self.db, self.scheduler, self.send, 'n1', 8, 1, self.progress_path, **kwargs)
+
+    def advance(self, seconds=0):
+        self.now += seconds
+        self.scheduler.run_due()
+
+    def plan(self, rebalancer):
+        """Run the scan steps until the first chunk goes out, returns the number of steps"""
+        steps = 0
+        while not self.sent and rebalancer.progress is not None:
+            self.advance()
+            steps += 1
+        return steps
+
+    def ack(self, rebalancer):
+        """Acknowledge the chunk sent last, returns its keys"""
+        (host, transfer_id, seq, keys) = self.sent.pop(0)
+        self.assertEqual(self.sent, [])
+        rebalancer.handle_ack(transfer_id, seq, host)
+        self.advance(1)  # past the pause that keeps the rate under bytes_per_sec
+        return keys
+
+    def test_scan_is_walked_in_steps(self):
+        rebalancer = self.rebalancer()
+        rebalancer.start(OLD, NEW)
+        self.assertEqual(self.sent, [])
+        self.assertEqual(rebalancer.stats()['remaining_keys'], 0)
+
+        # 301 versions, 50 per step
+        self.assertEqual(self.plan(rebalancer), 7)
+        self.assertEqual(rebalancer.stats()['remaining_keys'], len(self.expected))
+
+    def test_gained_keys_are_sent_once_in_order(self):
+        rebalancer = self.rebalancer(chunk_bytes=64)
+        rebalancer.start(OLD, NEW)
+        self.plan(rebalancer)
+
+        keys, chunks = [], 0
+        while self.sent:
+            self.assertEqual(self.sent[0][0], 'n4')
+            keys.extend(self.ack(rebalancer))
+            chunks += 1
+        self.assertEqual(keys, self.expected)
+        self.assertTrue(chunks > 1)
+        self.assertIsNone(rebalancer.stats())
+        self.assertFalse(os.path.exists(self.progress_path))
+
+    def test_siblings_are_sent_with_their_key(self):
+        rebalancer = self.rebalancer()
+        rebalancer.start(OLD, NEW)
+        self.plan(rebalancer)
+        self.assertEqual(rebalancer._plan[0][:2], [self.expected[0], len('v-' + self.expected[0]) + len('sibling')])
+
+    def test_resume_after_the_last_acknowledged_key(self):
+        rebalancer = self.rebalancer(chunk_bytes=64)
+        rebalancer.start(OLD, NEW)
+        self.plan(rebalancer)
+        transfer_id = self.sent[0][1]
+        chunk = self.ack(rebalancer)
+        self.sent = []
+
+        # a restart before the next chunk is acknowledged
+        self.scheduler = Scheduler(clock=lambda: self.now)
+        resumed = self.rebalancer(chunk_bytes=1 << 20)
+        resumed.resume()
+        self.plan(resumed)
+        (_, resumed_id, _, rest) = self.sent.pop(0)
+        self.assertEqual(resumed_id, transfer_id)
+        self.assertEqual(chunk + rest, self.expected)
+
+    def test_unacknowledged_chunks_are_sent_again_then_skipped(self):
+        rebalancer = self.rebalancer(ack_timeout=5.0, max_attempts=3)
+        rebalancer.start(OLD, NEW)
+        self.plan(rebalancer)
+        self.assertEqual(len(self.sent), 1)
+
+        self.advance(5.0)
+        self.advance(5.0)
+        self.assertEqual([seq for (_, _, seq, _) in self.sent], [1, 1, 1])
+        self.advance(5.0)  # skipped after the third send
+        self.advance(1)
+        self.assertEqual(len(self.sent), 3)
+        self.assertIsNone(rebalancer.progress)
+        self.assertFalse(os.path.exists(self.progress_path))
+
+    def test_nothing_to_move(self):
+        rebalancer = self.rebalancer()
+        rebalancer.start(OLD, OLD)
+        self.plan(rebalancer)
+        self.assertEqual(self.sent, [])
+        self.assertIsNone(rebalancer.progress)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+from request import MultiRequest
+
+
+class FakeTimer(object):
+    cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TestMultiRequest(unittest.TestCase):
+
+    def setUp(self):
+        self.done = []
+        self.multi = MultiRequest(['a', 'b', 'c'], self.done.append)
+
+    def test_done_when_every_key_has_a_result(self):
+        self.multi.add('a', 1)
+        self.multi.add_many({'b': 2})
+        self.assertEqual(self.done, [])
+        self.multi.add('c', 3)
+        self.assertEqual(self.done, [{'a': 1, 'b': 2, 'c': 3}])
+
+    def test_results_of_other_or_finished_keys_are_ignored(self):
+        self.multi.add('a', 1)
+        self.multi.add('a', 'late')
+        self.multi.add_many({'x': 0, 'b': 2, 'c': 3})
+        self.assertEqual(self.done, [{'a': 1, 'b': 2, 'c': 3}])
+
+    def test_finish_gives_missing_keys_the_error(self):
+        self.multi.timer = timer = FakeTimer()
+        self.multi.add('b', 2)
+        self.multi.finish("Error: timed out")
+        self.assertEqual(self.done, [{'a': "Error: timed out", 'b': 2, 'c': "Error: timed out"}])
+        self.assertTrue(timer.cancelled)
+        self.assertEqual(self.multi.pending, set())
+
+    def test_on_done_runs_once(self):
+        self.multi.add_many({'a': 1, 'b': 2, 'c': 3})
+        self.multi.finish()
+        self.multi.add('a', 'again')
+        self.assertEqual(len(self.done), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
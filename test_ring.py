@@ -0,0 +1,125 @@
+import unittest
+
+from ring import Ring
+
+HOSTS = ['node%d' % n for n in range(1, 8)]
+KEYS = ['key%d' % n for n in range(500)]
+
+
+def make_ring(vnode_count, replica_count, hosts=HOSTS):
+    ring = Ring(vnode_count=vnode_count, replica_count=replica_count)
+    for host in hosts:
+        ring[host] = host  # no DNS lookup, unlike add_node
+    return ring
+
+
+class TestPreferenceList(unittest.TestCase):
+
+    def test_distinct_hosts_coordinator_first(self):
+        for vnode_count in (1, 4, 32):
+            ring = make_ring(vnode_count, 2)
+            for key in KEYS:
+                preference = ring.get_preference_list(key)
+                self.assertEqual(len(preference), 3)
+                self.assertEqual(len(set(preference)), 3)
+                self.assertEqual(preference[0], ring.get_node_for_key(key))
+                self.assertEqual(preference[0], ring[key])
+                self.assertEqual(tuple(ring.get_replicas_for_key(key)), preference[1:])
+
+    def test_lookup_matches_preference_list(self):
+        ring = make_ring(32, 2)
+        routes = ring.lookup_many(KEYS)
+        for (key, route) in zip(KEYS, routes):
+            self.assertEqual(route, ring.lookup(key))
+            self.assertEqual(route.preference, ring.get_preference_list(key))
+            self.assertEqual(route.coordinator, route.preference[0])
+            self.assertEqual(route.replicas, route.preference[1:])
+
+    def test_coordinator_owns_the_key_range(self):
+        ring = make_ring(32, 2)
+        for key in KEYS[:100]:
+            position = ring.key_position(key)
+            ranges = ring.get_key_range(ring[key])
+            self.assertTrue(any(start < position <= end or (start > end and (position > start or position <= end))
+                                for (start, end) in ranges))
+
+    def test_small_ring(self):
+        ring = make_ring(32, 2, HOSTS[:2])
+        for key in KEYS[:50]:
+            self.assertEqual(sorted(ring.get_preference_list(key)), HOSTS[:2])
+            self.assertEqual(ring.get_handoff_nodes(key, 2), [])
+
+    def test_one_token_keeps_the_first_placement(self):
+        # one token per node is node_0, the placement of rings without vnodes
+        ring = make_ring(1, 0)
+        tokens = sorted((ring.key_position(host + '_0'), host) for host in HOSTS)
+        for key in KEYS[:50]:
+            position = ring.key_position(key)
+            expected = next((host for (token, host) in tokens if token >= position), tokens[0][1])
+            self.assertEqual(ring[key], expected)
+
+
+class TestHandoffNodes(unittest.TestCase):
+
+    def test_handoff_nodes_follow_the_preference_list(self):
+        for vnode_count in (1, 32):
+            ring = make_ring(vnode_count, 2)
+            for key in KEYS[:100]:
+                preference = ring.get_preference_list(key)
+                handoff = ring.get_handoff_nodes(key, 2)
+                self.assertEqual(len(handoff), 2)
+                self.assertFalse(set(handoff) & set(preference))
+                self.assertEqual(len(set(handoff)), 2)
+                self.assertEqual(ring.get_preference_list(key, extra=2), preference + tuple(handoff))
+
+    def test_handoff_nodes_are_limited_by_the_ring(self):
+        ring = make_ring(32, 2)
+        for key in KEYS[:50]:
+            self.assertEqual(len(ring.get_handoff_nodes(key, 10)), len(HOSTS) - 3)
+
+    def test_handoff_node_of_a_host(self):
+        ring = make_ring(32, 2)
+        for host in HOSTS:
+            ring.ip_to_hostname[host] = host
+        for host in HOSTS:
+            self.assertIn(ring.get_handoff_node(host), HOSTS)
+            self.assertNotEqual(ring.get_handoff_node(host), host)
+
+
+class TestMembership(unittest.TestCase):
+
+    def test_remove_and_add(self):
+        ring = make_ring(32, 2)
+        before = {key: ring.get_preference_list(key) for key in KEYS}
+
+        del ring['node3']
+        self.assertNotIn('node3', ring)
+        self.assertEqual(len(ring), len(HOSTS) - 1)
+        for key in KEYS:
+            preference = ring.get_preference_list(key)
+            self.assertNotIn('node3', preference)
+            self.assertEqual(len(set(preference)), 3)
+            if 'node3' not in before[key]:
+                self.assertEqual(preference, before[key])
+
+        ring['node3'] = 'node3'
+        self.assertEqual({key: ring.get_preference_list(key) for key in KEYS}, before)
+
+    def test_errors(self):
+        ring = make_ring(4, 1)
+        with self.assertRaises(ValueError):
+            ring['node1'] = 'node1'
+        with self.assertRaises(ValueError):
+            del ring['missing']
+
+    def test_load_report(self):
+        ring = make_ring(32, 2)
+        report = ring.load_report()
+        self.assertEqual(sorted(report), HOSTS)
+        self.assertAlmostEqual(sum(load['owned'] for load in report.values()), 100.0)
+        self.assertAlmostEqual(sum(load['replicated'] for load in report.values()), 300.0)
+        self.assertTrue(all(load['tokens'] == 32 for load in report.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+
+from scheduler import Scheduler
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.scheduler = Scheduler(clock=lambda: self.now)
+        self.ran = []
+
+    def advance(self, seconds):
+        self.now += seconds
+        self.scheduler.run_due()
+
+    def test_callbacks_run_in_deadline_order(self):
+        for (delay, name) in ((3, 'c'), (1, 'a'), (2, 'b1'), (2, 'b2'), (0, 'now')):
+            self.scheduler.call_later(delay, self.ran.append, name)
+        self.assertEqual(len(self.scheduler), 5)
+
+        self.advance(0)
+        self.assertEqual(self.ran, ['now'])
+        self.advance(1.5)
+        self.assertEqual(self.ran, ['now', 'a'])
+        self.advance(10)
+        self.assertEqual(self.ran, ['now', 'a', 'b1', 'b2', 'c'])  # same deadline: in scheduling order
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_arguments_are_passed(self):
+        self.scheduler.call_later(1, lambda *args, **kwargs: self.ran.append((args, kwargs)), 1, 2, key='k')
+        self.advance(1)
+        self.assertEqual(self.ran, [((1, 2), {'key': 'k'})])
+
+    def test_cancel(self):
+        first = self.scheduler.call_later(1, self.ran.append, 'first')
+        self.scheduler.call_later(2, self.ran.append, 'second')
+        first.cancel()
+        first.cancel()
+        self.assertEqual(len(self.scheduler), 1)
+
+        self.advance(5)
+        self.assertEqual(self.ran, ['second'])
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_cancel_after_running(self):
+        handle = self.scheduler.call_later(1, self.ran.append, 'x')
+        self.advance(1)
+        handle.cancel()
+        self.scheduler.call_later(1, self.ran.append, 'y')
+        self.assertEqual(len(self.scheduler), 1)
+
+    def test_cancelled_handles_are_dropped_in_bulk(self):
+        handles = [self.scheduler.call_later(n, self.ran.append, n) for n in range(1, 1201)]
+        for handle in handles[:-1]:
+            handle.cancel()
+        self.assertEqual(len(self.scheduler), 1)
+        self.assertEqual(self.scheduler.next_deadline(), self.now + 1200)
+        self.assertEqual(len(self.scheduler._heap), 1)
+
+    def test_next_timeout(self):
+        self.assertIsNone(self.scheduler.next_timeout())
+        later = self.scheduler.call_later(5, self.ran.append, 'later')
+        soon = self.scheduler.call_later(2, self.ran.append, 'soon')
+        self.assertEqual(self.scheduler.next_timeout(), 2)
+
+        soon.cancel()
+        self.assertEqual(self.scheduler.next_timeout(), 5)
+        self.now += 7
+        self.assertEqual(self.scheduler.next_timeout(), 0)  # overdue
+        later.cancel()
+        self.assertIsNone(self.scheduler.next_timeout())
+
+    def test_on_reschedule_when_the_earliest_deadline_moves_up(self):
+        deadlines = []
+        self.scheduler.on_reschedule = deadlines.append
+        self.scheduler.call_later(5, self.ran.append, 'a')
+        self.scheduler.call_later(7, self.ran.append, 'b')
+        self.scheduler.call_later(5, self.ran.append, 'c')
+        self.scheduler.call_later(1, self.ran.append, 'd')
+        self.assertEqual(deadlines, [105, 101])
+
+    def test_callbacks_scheduled_while_running_wait_for_the_next_run(self):
+        def step(n):
+            self.ran.append(n)
+            if n < 3:
+                self.scheduler.call_later(0, step, n + 1)
+
+        self.scheduler.call_later(0, step, 1)
+        self.scheduler.call_later(0, self.ran.append, 'other')
+        self.advance(0)
+        self.assertEqual(self.ran, [1, 'other'])
+        self.advance(0)
+        self.advance(0)
+        self.assertEqual(self.ran, [1, 'other', 2, 3])
+        self.assertIsNone(self.scheduler.next_timeout())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from logstore import LogStorage
+from storage import Storage
+
+
+class TestStorageMigration(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'node.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def first_schema(self, rows):
+        """A database of the first schema holding (key, clock, value) rows in write order"""
+        db = sqlite3.connect(self.path)
+        db.execute('CREATE TABLE storage (id INT PRIMARY KEY, hash TEXT NOT NULL, version TEXT NOT NULL, '
+                   'file BLOB NOT NULL);')
+        for (key, clock, value) in rows:
+            db.execute('INSERT INTO storage (hash, version, file) VALUES (?,?,?);', (key, '%s' % clock, value))
+        db.commit()
+        db.close()
+
+    def test_migration_drops_superseded_versions(self):
+        self.first_schema([
+            ('a', {'n1': 1}, b'a1'), ('a', {'n1': 2}, b'a2'),  # overwritten
+            ('b', {'n1': 1}, b'b1'), ('b', {'n2': 1}, b'b2'),  # concurrent
+            ('c', {'n1': 3}, b'c3'), ('c', {'n1': 1}, b'c1'),  # an older version written after a newer one
+            ('d', {'n1': 1}, b'd1'), ('d', {'n1': 1}, b'd2'),  # same clock, the later write wins
+            ('e', {'n1': 1, 'n2': 1}, b'e1'), ('e', {'n1': 2}, b'e2'), ('e', {'n1': 2, 'n2': 1}, b'e3'),
+        ])
+        db = Storage(self.path)
+        try:
+            self.assertEqual(db.getFile('a'), [[{'n1': 2}, b'a2']])
+            self.assertEqual(sorted(db.getFile('b'), key=lambda v: v[1]), [[{'n1': 1}, b'b1'], [{'n2': 1}, b'b2']])
+            self.assertEqual(db.getFile('c'), [[{'n1': 3}, b'c3']])
+            self.assertEqual(db.getFile('d'), [[{'n1': 1}, b'd2']])
+            self.assertEqual(db.getFile('e'), [[{'n1': 2, 'n2': 1}, b'e3']])
+            self.assertEqual([(key, len(clocks)) for (key, clocks, _) in db.scan()],
+                             [('a', 1), ('b', 2), ('c', 1), ('d', 1), ('e', 1)])
+        finally:
+            db.close()
+
+
+class TestLogStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'node.segments')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self):
+        # segments of a few records, compaction only when asked for
+        return LogStorage(self.path, synchronous='OFF', segment_bytes=512, compaction_ratio=2)
+
+    def fill(self, db):
+        """Writes, overwrites, siblings and deletes. Returns the versions of every key."""
+        for n in range(20):
+            db.storeFile('key%d' % n, 'n1', None, 'v%d' % n)
+        for n in range(0, 20, 2):  # overwritten
+            db.storeFile('key%d' % n, 'n1', {'n1': 1}, 'w%d' % n)
+        db.storeFile('key1', 'n2', None, 'sibling')
+        for n in range(15, 20):
+            db.remFile('key%d' % n)
+        return {'key%d' % n: db.getFile('key%d' % n) for n in range(20)}
+
+    def segments(self):
+        return sorted(os.listdir(self.path))
+
+    def test_replay_after_restart(self):
+        db = self.open()
+        expected = self.fill(db)
+        db.close()
+
+        self.assertGreater(len(self.segments()), 1)
+        db = self.open()
+        try:
+            self.assertEqual({key: db.getFile(key) for key in expected}, expected)
+            self.assertEqual(db.getFile('key16'), [])
+            self.assertEqual(len(db.getFile('key1')), 2)
+            self.assertEqual([key for (key, _, _) in db.scan()], sorted('key%d' % n for n in range(15)))
+        finally:
+            db.close()
+
+    def test_torn_tail_is_truncated(self):
+        db = self.open()
+        expected = self.fill(db)
+        db.storeFile('last', 'n1', None, 'x' * 100)
+        db.close()
+
+        last = os.path.join(self.path, self.segments()[-1])
+        size = os.path.getsize(last)
+        with open(last, 'r+b') as f:  # the last write was torn
+            f.truncate(size - 10)
+
+        db = self.open()
+        try:
+            self.assertEqual(db.getFile('last'), [])
+            self.assertEqual({key: db.getFile(key) for key in expected}, expected)
+            db.storeFile('after', 'n1', None, 'y')
+        finally:
+            db.close()
+
+        db = self.open()
+        try:
+            self.assertEqual(db.getFile('after'), [[{'n1': 1}, b'y']])
+            self.assertEqual({key: db.getFile(key) for key in expected}, expected)
+        finally:
+            db.close()
+
+    def test_corrupt_record_ends_its_segment(self):
+        db = self.open()
+        db.storeFile('a', 'n1', None, 'first')
+        db.storeFile('b', 'n1', None, 'second')
+        db.close()
+
+        segment = os.path.join(self.path, self.segments()[-1])
+        with open(segment, 'r+b') as f:  # flip a byte of the value of b
+            f.seek(os.path.getsize(segment) - 2)
+            f.write(b'X')
+
+        db = self.open()
+        try:
+            self.assertEqual(db.getFile('a'), [[{'n1': 1}, b'first']])
+            self.assertEqual(db.getFile('b'), [])
+        finally:
+            db.close()
+
+    def test_replay_after_compaction(self):
+        db = self.open()
+        expected = self.fill(db)
+        before = self.segments()
+        self.assertGreater(db.compact(force=True), 0)
+        self.assertLess(len(self.segments()), len(before))
+        self.assertEqual({key: db.getFile(key) for key in expected}, expected)
+        db.storeFile('key0', 'n1', {'n1': 2}, 'after')
+        expected['key0'] = db.getFile('key0')
+        db.close()
+
+        db = self.open()
+        try:
+            self.assertEqual({key: db.getFile(key) for key in expected}, expected)
+        finally:
+            db.close()
+
+    def test_interrupted_compaction(self):
+        db = self.open()
+        expected = self.fill(db)
+        db.close()
+
+        # the compaction replaced the last sealed segment, then stopped before removing the others
+        saved = {name: open(os.path.join(self.path, name), 'rb').read() for name in self.segments()}
+        db = self.open()
+        db.compact(force=True)
+        db.close()
+        compacted = self.segments()
+        removed = [name for name in saved if name not in compacted]
+        self.assertTrue(removed)
+        for name in removed:
+            with open(os.path.join(self.path, name), 'wb') as f:
+                f.write(saved[name])
+        with open(os.path.join(self.path, compacted[-1] + '.compact'), 'wb') as f:
+            f.write(b'unfinished')
+
+        db = self.open()
+        try:
+            self.assertEqual({key: db.getFile(key) for key in expected}, expected)
+            self.assertEqual(self.segments(), compacted)
+        finally:
+            db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+
+import vclock
+
+
+class TestCompare(unittest.TestCase):
+
+    def test_orders(self):
+        self.assertEqual(vclock.compare({'a': 1}, {'a': 1}), 0)
+        self.assertEqual(vclock.compare({'a': 2}, {'a': 1}), 1)
+        self.assertEqual(vclock.compare({'a': 1}, {'a': 2}), -1)
+        self.assertEqual(vclock.compare({'a': 1, 'b': 1}, {'a': 1}), 1)
+        self.assertEqual(vclock.compare({'a': 1}, {'a': 1, 'b': 1}), -1)
+        self.assertIsNone(vclock.compare({'a': 1}, {'b': 1}))
+        self.assertIsNone(vclock.compare({'a': 2, 'b': 1}, {'a': 1, 'b': 2}))
+
+    def test_missing_entries_count_as_zero(self):
+        self.assertEqual(vclock.compare({'a': 1, 'b': 0}, {'a': 1}), 0)
+        self.assertEqual(vclock.compare({}, {'a': 0}), 0)
+        self.assertEqual(vclock.compare({}, {'a': 1}), -1)
+        self.assertTrue(vclock.descends({'a': 1}, {'a': 1, 'b': 0}))
+        self.assertFalse(vclock.descends({'a': 1}, {'b': 1}))
+
+    def test_unrelated_ids_do_not_matter(self):
+        # comparing clocks of few entries does not depend on other ids ever seen
+        for i in range(1000):
+            vclock.compare({'n%d' % i: 1}, {})
+        self.assertEqual(vclock.compare({'x': 2, 'y': 1}, {'x': 1, 'y': 1}), 1)
+
+    def test_freeze(self):
+        self.assertEqual(vclock.freeze({'a': 1, 'b': 2}), vclock.freeze({'b': 2, 'a': 1}))
+        self.assertEqual(vclock.freeze({'a': 1, 'b': 0}), vclock.freeze({'a': 1}))
+        self.assertNotEqual(vclock.freeze({'a': 1}), vclock.freeze({'a': 2}))
+
+    def test_merge(self):
+        self.assertEqual(vclock.merge({'a': 1, 'b': 3}, {'a': 2, 'c': 1}), {'a': 2, 'b': 3, 'c': 1})
+
+
+class TestFrontier(unittest.TestCase):
+
+    def test_dominated_versions_are_dropped(self):
+        versions = [[{'a': 1}, b'old'], [{'a': 2}, b'new'], [{'a': 1, 'b': 1}, b'other']]
+        self.assertEqual(sorted(vclock.frontier(versions), key=lambda v: v[1]),
+                         [[{'a': 2}, b'new'], [{'a': 1, 'b': 1}, b'other']])
+
+    def test_concurrent_versions_are_kept(self):
+        versions = [[{'a': 2, 'b': 1}, b'x'], [{'a': 1, 'b': 2}, b'y'], [{'c': 1}, b'z']]
+        self.assertEqual(sorted(vclock.frontier(versions), key=lambda v: v[1]), versions)
+
+    def test_duplicates_of_replicas_are_returned_once(self):
+        replica = [[{'a': 2}, b'x'], [{'b': 1}, b'y']]
+        result = vclock.frontier(replica + [list(v) for v in replica] + [[{'a': 1}, b'old']])
+        self.assertEqual(sorted(result, key=lambda v: v[1]), replica)
+
+    def test_same_clock_different_values_are_kept(self):
+        versions = [[{'a': 1}, b'x'], [{'a': 1}, b'y'], [{'a': 1}, b'x']]
+        self.assertEqual(sorted(vclock.frontier(versions), key=lambda v: v[1]), [[{'a': 1}, b'x'], [{'a': 1}, b'y']])
+
+    def test_empty(self):
+        self.assertEqual(vclock.frontier([]), [])
+        self.assertEqual(vclock.frontier(iter([[{}, b'']])), [[{}, b'']])
+
+    def test_many_siblings(self):
+        base = {'a': 3, 'b': 2}
+        siblings = [[dict(base, **{'w%d' % i: 1}), b'v%d' % i] for i in range(64)]
+        versions = [[base, b'ancestor']] + siblings * 3
+        self.assertEqual(sorted(vclock.frontier(versions), key=lambda v: v[1]), sorted(siblings, key=lambda v: v[1]))
+
+    def test_newest_first(self):
+        versions = [[{'a': 1}, b'1'], [{'a': 1, 'b': 2}, b'3'], [{'a': 2}, b'2']]
+        self.assertEqual([v[1] for v in vclock.newest_first(versions)], [b'3', b'2', b'1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
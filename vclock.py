@@ -0,0 +1,85 @@
+"""Vector clocks.
+
+Clocks travel, are stored and are compared as dicts of node id : counter,
+missing entries count as 0. A comparison only looks at the entries of the two
+clocks, so its cost does not depend on how many node ids exist: contexts
+sent by clients can name any id.
+"""
+
+
+def descends(clock1, clock2):
+    """True if clock1 has seen everything clock2 has, i.e. clock1 >= clock2 entry by entry"""
+    for (node_id, counter) in clock2.items():
+        if counter > clock1.get(node_id, 0):
+            return False
+    return True
+
+
+def compare(clock1, clock2):
+    """Order of two clocks: 1 if clock1 descends from clock2, -1 for the
+    reverse, 0 if they are equal and None if they are concurrent"""
+    ge = le = True
+    for (node_id, c1) in clock1.items():
+        c2 = clock2.get(node_id, 0)
+        if c1 > c2:
+            le = False
+        elif c1 < c2:
+            ge = False
+    for (node_id, c2) in clock2.items():
+        if c2 and node_id not in clock1:
+            ge = False
+
+    if ge:
+        return 0 if le else 1
+    return -1 if le else None
+
+
+def freeze(clock):
+    """Hashable form of a clock, equal for equal clocks"""
+    return frozenset(item for item in clock.items() if item[1])
+
+
+def merge(clock1, clock2):
+    """Dict clock with the max of each entry of two dict clocks"""
+    merged = dict(clock1)
+    for (node_id, counter) in clock2.items():
+        if merged.get(node_id, 0) < counter:
+            merged[node_id] = counter
+    return merged
+
+
+def frontier(versions):
+    """The versions no other version descends from.
+
+    versions is an iterable of [dict clock, value] pairs, e.g. the results of
+    several replicas. Duplicates (same clock and value) are returned once,
+    versions with the same clock but different values are all kept.
+
+    Replicas mostly return the same versions, so they are grouped by clock
+    first and only distinct clocks are compared. A clock can only descend from
+    one with a larger counter total, so going from the largest total down each
+    clock is only compared with the ones kept before it.
+    """
+    distinct = {}  # frozen clock : [versions with that clock and different values]
+    for version in versions:
+        same = distinct.setdefault(freeze(version[0]), [])
+        if all(v[1] != version[1] for v in same):
+            same.append(version)
+
+    kept = []
+    for same in sorted(distinct.values(), key=lambda same: sum(same[0][0].values()), reverse=True):
+        clock = same[0][0]
+        if not any(descends(other[0][0], clock) for other in kept):
+            kept.append(same)
+
+    return [version for same in kept for version in same]
+
+
+def newest_first(versions):
+    """Sort [dict clock, value] pairs so a version comes before every version it descends from.
+
+    A descendant has a larger counter total than its ancestors, so sorting on
+    the total is enough. Concurrent versions keep their order.
+    """
+    versions.sort(key=lambda version: sum(version[0].values()), reverse=True)
+    return versions